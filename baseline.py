@@ -1,13 +1,274 @@
 import argparse
+import importlib.util
 import json
+import os
+import signal
+import threading
+from itertools import islice
 from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional
 
 import yaml
 from loguru import logger
 
+from models.columnar import ColumnarWriter, is_columnar_file
+from models.data_parallel import DataParallelModel
+from models.inference_server import InferenceClient, InferenceServer
+from models.profiling import profiler
+from models.result_cache import ResultCache
 from models.user_config import Models
 
 
+def iter_jsonl(file_path) -> Iterator[Dict]:
+    """Lazily read the rows of a JSONL file."""
+    with open(file_path) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def stream_predictions(model, rows: Iterable[Dict], chunk_size: int,
+                       result_cache: Optional[ResultCache] = None) -> Iterator[
+    Dict]:
+    """
+    Generate predictions chunk by chunk, so that memory stays bounded. With a
+    result cache, only the rows of a chunk that are not cached are generated.
+    """
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            break
+        if result_cache is None:
+            yield from model.generate_predictions(chunk)
+            continue
+        cached = result_cache.get_many(chunk)
+        pending_rows = [row for row, result in zip(chunk, cached)
+                        if result is None]
+        new_results = (model.generate_predictions(pending_rows)
+                       if pending_rows else [])
+        yield from merge_cached_results(chunk, cached, new_results,
+                                        result_cache)
+
+
+def merge_cached_results(rows: List[Dict], cached: List[Optional[Dict]],
+                         new_results: Iterable[Dict],
+                         result_cache: ResultCache) -> Iterator[Dict]:
+    """
+    Yield the results of `rows` in order, taking the new results (generated
+    for the rows that were not cached) in turn and caching them.
+    """
+    new_results = iter(new_results)
+    for row, result in zip(rows, cached):
+        if result is None:
+            result = next(new_results)
+            result_cache.put(row, result)
+        yield result
+
+
+def load_model(config: dict, num_workers: int = 1, devices=None,
+               shard_size: int = 64, server: Optional[str] = None):
+    """
+    Load the configured model, or one per worker process, or connect to the
+    server that has it loaded.
+    """
+    if server:
+        client = InferenceClient(server)
+        if client.model_name != config["model"]:
+            logger.warning(f"The server runs `{client.model_name}`, not "
+                           f"`{config['model']}` of the configuration.")
+        return client
+    if num_workers > 1:
+        return DataParallelModel(config, num_workers, devices=devices,
+                                 shard_size=shard_size)
+    if devices:
+        config = {**config, "device": devices[0]}
+    with profiler.span("load_model", model=config["model"]):
+        m = Models.get_model(config["model"])
+        return m(config)
+
+
+def serve(config: dict, model, host: str, port: int,
+          unix_socket: Optional[str], max_batch_size: int, max_wait_ms: float):
+    """Serve the predictions of the model until interrupted."""
+    server = InferenceServer(model, model_name=config["model"], host=host,
+                             port=port, unix_socket=unix_socket,
+                             max_batch_size=max_batch_size,
+                             max_wait=max_wait_ms / 1000)
+
+    # Shut down cleanly on SIGTERM too, so the caches are saved
+    def stop(signum, frame):
+        threading.Thread(target=server.shutdown).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+    logger.info("Server statistics: " + format_stats(server.batcher.stats()))
+
+
+def dry_run(config: dict, input_file, output_file, resume: bool = False,
+            use_result_cache: bool = True):
+    """
+    Check the configuration and input file and report what would be
+    predicted, without loading the model or writing any file.
+    """
+    model_path = Models.get_model_path(config["model"])
+    if importlib.util.find_spec(model_path.split(":")[0]) is None:
+        raise ValueError(f"Model `{model_path}` not found.")
+    logger.info(f"Model: `{config['model']}` ({model_path}).")
+
+    rows = list(iter_jsonl(input_file))
+    logger.info(f"Input: {len(rows):,} rows in `{input_file}`.")
+
+    if resume and Path(output_file).exists():
+        done_keys = set()
+        try:
+            for row in iter_jsonl(output_file):
+                done_keys.add(CheckpointWriter.row_key(row))
+        except json.JSONDecodeError:
+            # An incomplete last row would be truncated when resuming
+            pass
+        rows = [row for row in rows
+                if CheckpointWriter.row_key(row) not in done_keys]
+        logger.info(f"Resuming: {len(rows):,} rows left to predict.")
+
+    num_cached = 0
+    if (use_result_cache and config.get("result_cache_file")
+            and Path(config["result_cache_file"]).exists()):
+        result_cache = ResultCache(config["result_cache_file"], config)
+        num_cached = sum(result is not None
+                         for result in result_cache.get_many(rows))
+        result_cache.close()
+
+    logger.info(f"Would predict {len(rows) - num_cached:,} rows "
+                f"({num_cached:,} cached) into `{output_file}`.")
+
+
+def format_stats(stats: dict) -> str:
+    return ", ".join(
+        f"{name}={value:.1%}" if name == "hit_rate" else f"{name}={value:,}"
+        for name, value in stats.items()
+    )
+
+
+def close_model(model):
+    """Report the disambiguation statistics of the model and close it."""
+    disambiguator = getattr(model, "disambiguator", None)
+    if disambiguator is not None:
+        logger.info("Disambiguation statistics: "
+                    + format_stats(disambiguator.stats()))
+    model.close()
+
+
+def write_profile(trace_file):
+    profiler.write_trace(trace_file)
+    logger.info(f"Saved the trace to `{trace_file}`. Profile:\n"
+                + profiler.summary())
+
+
+class CheckpointWriter:
+    """
+    Writes result rows to a JSONL file and periodically checkpoints them.
+
+    A checkpoint flushes and syncs the output file, then atomically replaces a
+    sidecar file (`<output>.ckpt`) that records how many bytes and rows of the
+    output are complete. When resuming, anything written after the last
+    checkpoint is truncated, so a crash mid-write cannot leave a corrupt file.
+    """
+
+    def __init__(self, output_file, resume: bool = False,
+                 checkpoint_every: int = 0, flush_every_row: bool = False):
+        self.output_file = Path(output_file)
+        self.checkpoint_file = self.output_file.with_name(
+            self.output_file.name + ".ckpt")
+        self.checkpoint_every = checkpoint_every
+        self.flush_every_row = flush_every_row
+
+        # The keys of the rows recovered when resuming. The rows written by
+        # this run are not tracked, so that memory stays bounded and rows with
+        # repeated keys are all written
+        self.resumed_keys = frozenset()
+        self.num_rows = 0
+        self._rows_since_checkpoint = 0
+
+        if resume and self.output_file.exists():
+            self._recover()
+            self._mode = "a"
+        else:
+            self._mode = "w"
+        # Opened on the first write, so that a run that fails before (e.g.
+        # while loading the model) leaves an existing output file intact
+        self._file = None
+
+    @staticmethod
+    def row_key(row: Dict):
+        return row.get("SubjectEntityID"), row.get("Relation")
+
+    def _open(self):
+        if self._file is None:
+            if self._mode == "w":
+                self.checkpoint_file.unlink(missing_ok=True)
+            self._file = open(self.output_file, self._mode)
+        return self._file
+
+    def write(self, result: Dict):
+        self._open().write(json.dumps(result) + "\n")
+        if self.flush_every_row:
+            self._file.flush()
+        self.num_rows += 1
+        self._rows_since_checkpoint += 1
+        if 0 < self.checkpoint_every <= self._rows_since_checkpoint:
+            self.checkpoint()
+
+    def checkpoint(self):
+        with profiler.span("checkpoint", rows=self.num_rows):
+            self._open().flush()
+            os.fsync(self._file.fileno())
+
+            tmp_file = self.checkpoint_file.with_name(
+                self.checkpoint_file.name + ".tmp")
+            with open(tmp_file, "w") as f:
+                json.dump({
+                    "offset": self._file.tell(),
+                    "rows": self.num_rows,
+                }, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_file, self.checkpoint_file)
+            self._rows_since_checkpoint = 0
+
+    def close(self):
+        self.checkpoint()
+        self._file.close()
+        # The output is complete, the checkpoint is no longer needed
+        self.checkpoint_file.unlink(missing_ok=True)
+
+    def _recover(self):
+        """Truncate the output to the last checkpoint and load the done rows."""
+        if self.checkpoint_file.exists():
+            with open(self.checkpoint_file) as f:
+                offset = json.load(f)["offset"]
+        else:
+            # No checkpoint: keep every complete line of the file
+            with open(self.output_file, "rb") as f:
+                data = f.read()
+            offset = data.rfind(b"\n") + 1
+
+        with open(self.output_file, "r+b") as f:
+            f.truncate(offset)
+
+        resumed_keys = set()
+        for row in iter_jsonl(self.output_file):
+            resumed_keys.add(self.row_key(row))
+            self.num_rows += 1
+        self.resumed_keys = frozenset(resumed_keys)
+        logger.info(f"Resuming after {self.num_rows:,} completed rows.")
+
+
 def main():
     parser = argparse.ArgumentParser(description="Run Baseline Models")
 
@@ -20,17 +281,124 @@ def main():
     parser.add_argument(
         "-i", "--input_file",
         type=str,
-        required=True,
+        required=False,
         help="Path to the input file"
     )
     parser.add_argument(
         "-o", "--output_file",
         type=str,
         required=False,
-        help="Path to the output file"
+        help="Path to the output file: JSONL, or a columnar Arrow (.arrow, "
+             ".feather) or Parquet (.parquet) file"
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Read the input lazily and write each result as soon as it is "
+             "ready, keeping memory bounded"
+    )
+    parser.add_argument(
+        "--chunk_size",
+        type=int,
+        default=1024,
+        help="Number of input rows per chunk in streaming mode"
+    )
+    parser.add_argument(
+        "--checkpoint_every",
+        type=int,
+        default=0,
+        help="Generate predictions in chunks and checkpoint the output file "
+             "every N rows (0 disables checkpointing)"
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Resume from the existing output file, skipping the rows that "
+             "are already done"
+    )
+    parser.add_argument(
+        "--num_workers",
+        type=int,
+        default=1,
+        help="Number of worker processes, each with its own model instance "
+             "pinned to a device and/or a disjoint set of CPU cores"
+    )
+    parser.add_argument(
+        "--devices",
+        type=str,
+        nargs="+",
+        help="Devices assigned to the workers in turn, e.g. `cuda:0 cuda:1` "
+             "(default: the model's own choice)"
+    )
+    parser.add_argument(
+        "--shard_size",
+        type=int,
+        default=64,
+        help="Number of input rows per shard handed to a worker"
+    )
+    parser.add_argument(
+        "--serve",
+        action="store_true",
+        help="Load the model once and serve predictions to local clients "
+             "(see --server) until interrupted, instead of reading an input "
+             "file"
+    )
+    parser.add_argument(
+        "--host",
+        type=str,
+        default="127.0.0.1",
+        help="Loopback address to serve on"
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=8765,
+        help="Port to serve on"
+    )
+    parser.add_argument(
+        "--unix_socket",
+        type=str,
+        help="Serve on this Unix socket instead of a TCP port"
+    )
+    parser.add_argument(
+        "--max_batch_size",
+        type=int,
+        default=64,
+        help="Maximum number of rows of concurrent requests that the server "
+             "predicts in one batch"
+    )
+    parser.add_argument(
+        "--max_wait_ms",
+        type=float,
+        default=10.0,
+        help="Maximum time the server waits for more rows before predicting "
+             "a batch"
+    )
+    parser.add_argument(
+        "--server",
+        type=str,
+        help="Send the rows to a running server, e.g. `http://127.0.0.1:8765` "
+             "or `unix:/path/to/socket`, instead of loading the model"
+    )
+    parser.add_argument(
+        "--profile",
+        type=str,
+        nargs="?",
+        const="",
+        help="Time every stage of the run and write a Chrome trace (viewable "
+             "in Perfetto) to the given file (default: next to the output "
+             "file), plus a summary table to the log"
+    )
+    parser.add_argument(
+        "--dry_run",
+        action="store_true",
+        help="Check the configuration and input, and report how many rows "
+             "would be predicted, without loading the model"
     )
 
     args = parser.parse_args()
+    if not args.input_file and (args.dry_run or not args.serve):
+        parser.error("the following arguments are required: -i/--input_file")
 
     # Load the configuration file
     logger.info(f"Loading the YAML configuration file `{args.config_file}`...")
@@ -46,24 +414,127 @@ def main():
         file_name = Path(args.config_file).stem
         output_file = output_dir / f"{file_name}.jsonl"
 
-    # Load the input file
-    logger.info(f"Loading the input file `{input_file}`...")
-    with open(input_file) as f:
-        input_rows = [json.loads(line) for line in f]
-    logger.info(f"Loaded {len(input_rows):,} rows.")
+    if is_columnar_file(output_file) and (args.resume
+                                          or args.checkpoint_every > 0):
+        parser.error("--resume and --checkpoint_every need a JSONL output "
+                     "file")
+    if (args.resume and config.get("raw_outputs_file")
+            and Path(output_file).exists()):
+        # The raw outputs of the rows done by the earlier run are lost when
+        # the raw outputs file is written again
+        parser.error("--resume cannot be used with `raw_outputs_file`; "
+                     "start a new run to save the raw outputs of all rows")
 
-    # Load the model
-    m = Models.get_model(config["model"])
-    model = m(config)
+    if args.dry_run:
+        dry_run(config, input_file, output_file, resume=args.resume,
+                use_result_cache=not args.server)
+        return
 
-    # Generate predictions
-    results = model.generate_predictions(input_rows)
+    if args.profile is not None:
+        profiler.enable()
+        if args.num_workers > 1:
+            logger.warning("Only the main process is profiled; the stages "
+                           "inside the worker processes are not traced.")
+
+    if args.serve:
+        model = load_model(config, args.num_workers, args.devices,
+                           args.shard_size)
+        serve(config, model, args.host, args.port, args.unix_socket,
+              args.max_batch_size, args.max_wait_ms)
+        close_model(model)
+        if args.profile is not None:
+            write_profile(args.profile or f"{output_file}.trace.json")
+        return
+
+    # Open the output file, recovering the completed rows when resuming
+    resumed_keys = frozenset()
+    if is_columnar_file(output_file):
+        writer = ColumnarWriter(output_file)
+    else:
+        writer = CheckpointWriter(
+            output_file,
+            resume=args.resume,
+            checkpoint_every=args.checkpoint_every,
+            flush_every_row=args.stream,
+        )
+        resumed_keys = writer.resumed_keys
+
+    def is_pending(row: Dict) -> bool:
+        return CheckpointWriter.row_key(row) not in resumed_keys
+
+    # Reuse the results of rows whose model, prompt and settings are unchanged
+    result_cache = None
+    if config.get("result_cache_file") and args.server:
+        # The results depend on the server's configuration, not on this one
+        logger.warning("Not using the result cache with --server.")
+    elif config.get("result_cache_file"):
+        result_cache = ResultCache(config["result_cache_file"], config)
+
+    model = None
+    if args.stream:
+        # Load the model
+        model = load_model(config, args.num_workers, args.devices,
+                           args.shard_size, server=args.server)
+
+        # Generate predictions lazily, chunk by chunk
+        logger.info(f"Streaming the input file `{input_file}`...")
+        results = stream_predictions(
+            model, filter(is_pending, iter_jsonl(input_file)),
+            args.chunk_size, result_cache)
+    else:
+        # Load the input file
+        logger.info(f"Loading the input file `{input_file}`...")
+        with profiler.span("read_input"), open(input_file) as f:
+            input_rows = [json.loads(line) for line in f]
+        logger.info(f"Loaded {len(input_rows):,} rows.")
+        if resumed_keys:
+            input_rows = list(filter(is_pending, input_rows))
+            logger.info(f"{len(input_rows):,} rows left to predict.")
+
+        # Look up the cached results first
+        cached = [None] * len(input_rows)
+        pending_rows = input_rows
+        if result_cache is not None:
+            cached = result_cache.get_many(input_rows)
+            pending_rows = [row for row, result in zip(input_rows, cached)
+                            if result is None]
+            logger.info(f"{len(input_rows) - len(pending_rows):,} results "
+                        f"found in the result cache.")
+
+        # Load the model, unless every result is cached
+        if pending_rows:
+            model = load_model(config, args.num_workers, args.devices,
+                               args.shard_size, server=args.server)
+
+        # Generate predictions, in chunks when checkpointing
+        if not pending_rows:
+            results = []
+        elif args.checkpoint_every > 0:
+            results = stream_predictions(model, pending_rows,
+                                         args.checkpoint_every)
+        else:
+            results = model.generate_predictions(pending_rows)
+        if result_cache is not None:
+            results = merge_cached_results(input_rows, cached, results,
+                                           result_cache)
 
     # Save the results
     logger.info(f"Saving the results to `{output_file}`...")
-    with open(output_file, "w+") as f:
-        for result in results:
-            f.write(json.dumps(result) + "\n")
+    for result in results:
+        writer.write(result)
+    writer.close()
+    logger.info(f"Saved {writer.num_rows:,} rows.")
+
+    # Report the cache and disambiguation statistics
+    if result_cache is not None:
+        logger.info("Result cache statistics: "
+                    + format_stats(result_cache.stats()))
+        result_cache.close()
+    if model is not None:
+        close_model(model)
+
+    if args.profile is not None:
+        write_profile(args.profile or f"{output_file}.trace.json")
 
     logger.info("Done!")
 
@@ -0,0 +1,524 @@
+"""
+Benchmarks of the prediction and evaluation pipeline.
+
+Prediction runs with tiny random BERT and GPT-2 models built offline and a stub
+disambiguator; evaluation runs on synthetic prediction files scaled up from
+the validation data. Every benchmark runs in a fresh process, so that its peak
+RSS is its own. Run from the repository root:
+
+    python -m benchmarks.run_benchmarks
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from pathlib import Path
+from typing import Dict, List
+
+from loguru import logger
+
+from baseline import iter_jsonl, stream_predictions
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+
+# Metrics compared against the baseline, with whether higher is better
+COMPARED_METRICS = {
+    "rows_per_sec": True,
+    "prompt_tokens_per_sec": True,
+    "generated_tokens_per_sec": True,
+    "batch_latency_ms.p50": False,
+    "batch_latency_ms.p90": False,
+    "batch_latency_ms.p99": False,
+    "disambiguation_latency_ms.p50": False,
+    "disambiguation_latency_ms.p99": False,
+    "stage_latency_ms.read": False,
+    "stage_latency_ms.score": False,
+    "stage_latency_ms.results_table": False,
+    "peak_rss_mb": False,
+}
+# Metrics whose regression fails the run; latency percentiles are too noisy
+# on shared machines and are only reported
+GATED_METRICS = {
+    "rows_per_sec",
+    "prompt_tokens_per_sec",
+    "generated_tokens_per_sec",
+    "peak_rss_mb",
+}
+
+
+class StubDisambiguator:
+    """
+    Stands in for the Wikidata disambiguator: every label resolves to a
+    deterministic ID, optionally after a simulated latency per new label.
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.seen = set()
+        self.call_latencies = []
+
+    def lookup(self, item, relation=None) -> str:
+        return self.lookup_many([item], relation)[item]
+
+    def lookup_many(self, items, relation=None, desc=None) -> Dict[str, str]:
+        start_time = time.perf_counter()
+        items = set(items)
+        new_items = items - self.seen
+        self.seen.update(new_items)
+        if self.latency > 0:
+            time.sleep(self.latency * len(new_items))
+        results = {item: f"Q{sum(map(ord, str(item))) % 10_000}"
+                   for item in items}
+        self.call_latencies.append(time.perf_counter() - start_time)
+        return results
+
+    def stats(self) -> dict:
+        return {"calls": len(self.call_latencies)}
+
+    def close(self):
+        pass
+
+
+def percentiles(values: List[float], scale: float = 1.0) -> Dict[str, float]:
+    if not values:
+        return {}
+    values = sorted(values)
+
+    def percentile(q):
+        return values[min(len(values) - 1, int(q / 100 * len(values)))]
+
+    return {f"p{q}": round(percentile(q) * scale, 3) for q in (50, 90, 99)}
+
+
+def peak_rss_mb() -> float:
+    # The high-water mark of this process image; `ru_maxrss` would include
+    # the peak of the parent that the process was forked from
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    # `ru_maxrss` is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        peak /= 1024
+    return round(peak / 1024, 1)
+
+
+def build_tiny_models(work_dir: Path, seed: int = 0) -> Dict[str, Path]:
+    """
+    Build a tiny random BERT and GPT-2, with tokenizers trained on the
+    challenge data, unless they already exist.
+    """
+    bert_dir = work_dir / "tiny-bert"
+    gpt2_dir = work_dir / "tiny-gpt2"
+    if (bert_dir / "config.json").exists() and (
+            gpt2_dir / "config.json").exists():
+        return {"bert": bert_dir, "gpt2": gpt2_dir}
+
+    import torch
+    from tokenizers import Tokenizer, decoders, models, normalizers, \
+        pre_tokenizers, processors, trainers
+    from transformers import BertConfig, BertForMaskedLM, GPT2Config, \
+        GPT2LMHeadModel, PreTrainedTokenizerFast
+
+    logger.info(f"Building tiny models in `{work_dir}`...")
+    texts = []
+    for file_name in ("train.jsonl", "val.jsonl"):
+        for row in iter_jsonl(REPO_DIR / "data" / file_name):
+            texts.append(row["SubjectEntity"])
+            texts.extend(row["ObjectEntities"])
+    for file_path in (REPO_DIR / "prompt_templates").glob("*.csv"):
+        texts.extend(file_path.read_text().splitlines())
+
+    torch.manual_seed(seed)
+
+    # BERT with a WordPiece tokenizer
+    tokenizer = Tokenizer(models.WordPiece(unk_token="[UNK]"))
+    tokenizer.normalizer = normalizers.BertNormalizer(lowercase=False)
+    tokenizer.pre_tokenizer = pre_tokenizers.BertPreTokenizer()
+    tokenizer.decoder = decoders.WordPiece()
+    special_tokens = ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]"]
+    tokenizer.train_from_iterator(texts, trainers.WordPieceTrainer(
+        vocab_size=2000, special_tokens=special_tokens))
+    tokenizer.post_processor = processors.TemplateProcessing(
+        single="[CLS] $A [SEP]",
+        pair="[CLS] $A [SEP] $B [SEP]",
+        special_tokens=[("[CLS]", 2), ("[SEP]", 3)],
+    )
+    bert_tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer, unk_token="[UNK]", pad_token="[PAD]",
+        cls_token="[CLS]", sep_token="[SEP]", mask_token="[MASK]")
+    bert_tokenizer.save_pretrained(bert_dir)
+    BertForMaskedLM(BertConfig(
+        vocab_size=len(bert_tokenizer), hidden_size=64, intermediate_size=128,
+        num_hidden_layers=2, num_attention_heads=4,
+    )).save_pretrained(bert_dir)
+
+    # GPT-2 with a byte-level BPE tokenizer
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    tokenizer.train_from_iterator(texts, trainers.BpeTrainer(
+        vocab_size=2000, special_tokens=["<|endoftext|>"],
+        initial_alphabet=pre_tokenizers.ByteLevel.alphabet()))
+    gpt2_tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer, bos_token="<|endoftext|>",
+        eos_token="<|endoftext|>")
+    gpt2_tokenizer.save_pretrained(gpt2_dir)
+    GPT2LMHeadModel(GPT2Config(
+        vocab_size=len(gpt2_tokenizer), n_embd=64, n_layer=2, n_head=4,
+        n_positions=1024, bos_token_id=0, eos_token_id=0,
+    )).save_pretrained(gpt2_dir)
+
+    return {"bert": bert_dir, "gpt2": gpt2_dir}
+
+
+def benchmark_prediction(config: dict, num_rows: int,
+                         disambiguation_latency: float,
+                         seed: int) -> Dict:
+    """Run a model over the validation rows, batch by batch."""
+    import torch
+    from models.user_config import Models
+
+    random.seed(seed)
+    torch.manual_seed(seed)
+
+    start_time = time.perf_counter()
+    model = Models.get_model(config["model"])(config)
+    load_seconds = time.perf_counter() - start_time
+    model.disambiguator.close()
+    model.disambiguator = StubDisambiguator(disambiguation_latency)
+
+    rows = list(iter_jsonl(REPO_DIR / "data" / "val.jsonl"))
+    rows = (rows * (num_rows // len(rows) + 1))[:num_rows]
+
+    prompt_tokens = sum(
+        len(model.tokenizer(model.create_prompt(
+            subject_entity=row["SubjectEntity"],
+            relation=row["Relation"]))["input_ids"])
+        for row in rows
+    )
+
+    # Count the generated tokens of the custom decode loop
+    generated_tokens = 0
+    if hasattr(model, "decode"):
+        decode = model.decode
+
+        def counting_decode(*args, **kwargs):
+            nonlocal generated_tokens
+            texts = decode(*args, **kwargs)
+            generated_tokens += sum(
+                len(ids) for ids in model.tokenizer(
+                    texts, add_special_tokens=False)["input_ids"])
+            return texts
+
+        model.decode = counting_decode
+
+    batch_latencies = []
+    start_time = time.perf_counter()
+    batch_start_time = start_time
+    for i, _ in enumerate(stream_predictions(model, rows, model.batch_size)):
+        if (i + 1) % model.batch_size == 0 or i + 1 == len(rows):
+            now = time.perf_counter()
+            batch_latencies.append(now - batch_start_time)
+            batch_start_time = now
+    seconds = time.perf_counter() - start_time
+    model.close()
+
+    results = {
+        "rows": len(rows),
+        "load_seconds": round(load_seconds, 3),
+        "seconds": round(seconds, 3),
+        "rows_per_sec": round(len(rows) / seconds, 2),
+        "prompt_tokens_per_sec": round(prompt_tokens / seconds, 1),
+        "batch_latency_ms": percentiles(batch_latencies, 1000),
+        "disambiguation_latency_ms": percentiles(
+            model.disambiguator.call_latencies, 1000),
+    }
+    if generated_tokens:
+        results["generated_tokens_per_sec"] = round(
+            generated_tokens / seconds, 1)
+    results["peak_rss_mb"] = peak_rss_mb()
+    return results
+
+
+def write_synthetic_predictions(work_dir: Path, scale: int,
+                                seed: int) -> Dict[str, Path]:
+    """
+    Scale the validation data up `scale` times, with perturbed predictions
+    (dropped, duplicated and wrong objects), as JSONL and Arrow files.
+    """
+    from models.columnar import ColumnarWriter
+
+    files = {}
+    for kind in ("gt", "pred"):
+        files[kind] = work_dir / f"eval-{kind}-x{scale}.jsonl"
+        files[f"{kind}_arrow"] = files[kind].with_suffix(".arrow")
+    if all(file.exists() for file in files.values()):
+        return files
+    gt_file = files["gt"]
+    pred_file = files["pred"]
+
+    rng = random.Random(seed)
+    rows = list(iter_jsonl(REPO_DIR / "data" / "val.jsonl"))
+    with open(gt_file, "w") as gt_f, open(pred_file, "w") as pred_f:
+        for copy in range(scale):
+            for row in rows:
+                gt_row = {**row, "SubjectEntity": f"{row['SubjectEntity']} #{copy}"}
+                objects = [qid for qid in row["ObjectEntitiesID"]
+                           if rng.random() > 0.3]
+                objects += [f"Q{rng.randint(1, 10_000)}"
+                            for _ in range(rng.randint(0, 2))]
+                if objects and rng.random() < 0.1:
+                    objects.append(objects[0])
+                pred_row = {
+                    "SubjectEntityID": row["SubjectEntityID"],
+                    "SubjectEntity": gt_row["SubjectEntity"],
+                    "Relation": row["Relation"],
+                    "ObjectEntitiesID": objects,
+                }
+                gt_f.write(json.dumps(gt_row) + "\n")
+                pred_f.write(json.dumps(pred_row) + "\n")
+
+    for kind in ("gt", "pred"):
+        writer = ColumnarWriter(files[f"{kind}_arrow"])
+        for row in iter_jsonl(files[kind]):
+            writer.write(row)
+        writer.close()
+    return files
+
+
+def benchmark_evaluation(gt_file: Path, pred_file: Path, mode: str,
+                         repeats: int = 5) -> Dict:
+    """
+    Evaluate a synthetic prediction file in memory, streaming or columnar
+    (from memory-mapped Arrow files), keeping the fastest of a few repeats of
+    every stage.
+    """
+    from evaluate import GroundTruthIndex, columnar_scores, read_jsonl_file, \
+        read_table, results_table, scores_per_sr_pair, streaming_scores
+
+    stage_seconds = {}
+
+    def timed(stage, function, *args):
+        start_time = time.perf_counter()
+        result = function(*args)
+        seconds = time.perf_counter() - start_time
+        stage_seconds[stage] = min(stage_seconds.get(stage, seconds), seconds)
+        return result
+
+    for _ in range(repeats):
+        if mode == "streaming":
+            index = timed("read", GroundTruthIndex.from_file, gt_file)
+            scores = timed("score", streaming_scores, pred_file, index)
+        elif mode == "columnar":
+            pred_table = timed("read", read_table, pred_file)
+            gt_table = read_table(gt_file)
+            scores = timed("score", columnar_scores, pred_table, gt_table)
+        else:
+            pred_rows = timed("read", read_jsonl_file, pred_file)
+            gt_rows = read_jsonl_file(gt_file)
+            scores = timed("score", scores_per_sr_pair, pred_rows, gt_rows)
+        timed("results_table", results_table, scores)
+
+    seconds = sum(stage_seconds.values())
+    return {
+        "rows": len(scores),
+        "seconds": round(seconds, 3),
+        "rows_per_sec": round(len(scores) / seconds, 1),
+        "stage_latency_ms": {stage: round(value * 1000, 3)
+                             for stage, value in stage_seconds.items()},
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def run_isolated(function, *args):
+    """Run a function in a fresh process, so that its peak RSS is its own."""
+    with ProcessPoolExecutor(max_workers=1,
+                             mp_context=get_context("spawn")) as executor:
+        return executor.submit(function, *args).result()
+
+
+def get_metric(results: Dict, name: str):
+    for key in name.split("."):
+        if not isinstance(results, dict) or key not in results:
+            return None
+        results = results[key]
+    return results
+
+
+def compare(results: Dict, baseline: Dict, tolerance: float) -> List[str]:
+    """Print every metric next to its baseline value; return the regressions."""
+    regressions = []
+    print(f"{'benchmark':24s} {'metric':32s} {'value':>12s} "
+          f"{'baseline':>12s} {'change':>8s}")
+    for name, benchmark in results["benchmarks"].items():
+        for metric, higher_is_better in COMPARED_METRICS.items():
+            value = get_metric(benchmark, metric)
+            if value is None:
+                continue
+            reference = get_metric(baseline.get("benchmarks", {}).get(name, {}),
+                                   metric)
+            if not reference:
+                print(f"{name:24s} {metric:32s} {value:12,.2f} "
+                      f"{'-':>12s} {'-':>8s}")
+                continue
+
+            change = value / reference - 1
+            worse = -change if higher_is_better else change
+            flag = ""
+            if metric in GATED_METRICS and worse > tolerance:
+                flag = " REGRESSION"
+                regressions.append(f"{name} {metric}")
+            print(f"{name:24s} {metric:32s} {value:12,.2f} "
+                  f"{reference:12,.2f} {change:+8.1%}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the prediction and evaluation pipeline")
+
+    parser.add_argument(
+        "-o", "--output_file",
+        type=str,
+        default="benchmarks/results.json",
+        help="Path to the JSON results"
+    )
+    parser.add_argument(
+        "-b", "--baseline_file",
+        type=str,
+        default="benchmarks/baseline.json",
+        help="Path to the stored baseline results to compare against"
+    )
+    parser.add_argument(
+        "--update_baseline",
+        action="store_true",
+        help="Store the results as the new baseline"
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.3,
+        help="Relative change beyond which a throughput or memory metric "
+             "counts as a regression"
+    )
+    parser.add_argument(
+        "--work_dir",
+        type=str,
+        default="cache/benchmarks",
+        help="Directory of the tiny models and synthetic data"
+    )
+    parser.add_argument(
+        "--rows",
+        type=int,
+        default=256,
+        help="Number of rows to predict per model"
+    )
+    parser.add_argument(
+        "--eval_scale",
+        type=int,
+        default=100,
+        help="How many times the validation data is scaled up for evaluation"
+    )
+    parser.add_argument(
+        "--disambiguation_latency",
+        type=float,
+        default=0.001,
+        help="Simulated latency of the stub disambiguator per new label, in "
+             "seconds"
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="Random seed of the models and data"
+    )
+
+    args = parser.parse_args()
+
+    os.chdir(REPO_DIR)
+    work_dir = Path(args.work_dir)
+    work_dir.mkdir(parents=True, exist_ok=True)
+
+    # Build the models in a child process, so that this one stays small
+    model_dirs = run_isolated(build_tiny_models, work_dir, args.seed)
+    eval_files = write_synthetic_predictions(work_dir, args.eval_scale,
+                                             args.seed)
+
+    common_config = {
+        "batch_size": 16,
+        "disambiguation_backend": "wikidata",
+        "train_data_file": "data/train.jsonl",
+    }
+    benchmarks = {
+        "predict_fill_mask": (benchmark_prediction, {
+            **common_config,
+            "model": "baseline_fill_mask",
+            "llm_path": str(model_dirs["bert"]),
+            "prompt_templates_file": "prompt_templates/masked_prompts.csv",
+            "top_k": 10,
+            "threshold": 0.001,
+        }, args.rows, args.disambiguation_latency, args.seed),
+        "predict_generation": (benchmark_prediction, {
+            **common_config,
+            "model": "baseline_generation",
+            "llm_path": str(model_dirs["gpt2"]),
+            "prompt_templates_file": "prompt_templates/question_prompts.csv",
+            "use_quantization": False,
+            "few_shot": 3,
+            "max_new_tokens": 16,
+            "prefix_caching": True,
+        }, args.rows, args.disambiguation_latency, args.seed),
+        "evaluate_in_memory": (benchmark_evaluation, eval_files["gt"],
+                               eval_files["pred"], "in_memory"),
+        "evaluate_streaming": (benchmark_evaluation, eval_files["gt"],
+                               eval_files["pred"], "streaming"),
+        "evaluate_columnar": (benchmark_evaluation, eval_files["gt_arrow"],
+                              eval_files["pred_arrow"], "columnar"),
+    }
+
+    results = {
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+        },
+        "benchmarks": {},
+    }
+    for name, (function, *function_args) in benchmarks.items():
+        logger.info(f"Running `{name}`...")
+        results["benchmarks"][name] = run_isolated(function, *function_args)
+
+    with open(args.output_file, "w") as f:
+        json.dump(results, f, indent=2)
+    logger.info(f"Saved the results to `{args.output_file}`.")
+
+    baseline = {}
+    if Path(args.baseline_file).exists():
+        with open(args.baseline_file) as f:
+            baseline = json.load(f)
+    regressions = compare(results, baseline, args.tolerance)
+
+    if args.update_baseline:
+        with open(args.baseline_file, "w") as f:
+            json.dump(results, f, indent=2)
+        logger.info(f"Saved the results as the baseline "
+                    f"`{args.baseline_file}`.")
+    elif regressions:
+        logger.error(f"{len(regressions)} metrics regressed by more than "
+                     f"{args.tolerance:.0%}: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+import argparse
+import json
+
+from loguru import logger
+
+from models.columnar import ColumnarWriter, is_columnar_file, \
+    iter_columnar_rows
+
+
+def iter_rows(file_path):
+    if is_columnar_file(file_path):
+        yield from iter_columnar_rows(file_path)
+        return
+    with open(file_path) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Convert prediction and ground truth files between JSONL "
+                    "and columnar (Arrow/Parquet) formats")
+
+    parser.add_argument(
+        "-i", "--input_file",
+        type=str,
+        required=True,
+        help="Path to the input file (.jsonl, .arrow, .feather or .parquet)"
+    )
+    parser.add_argument(
+        "-o", "--output_file",
+        type=str,
+        required=True,
+        help="Path to the output file; its extension selects the format"
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=65536,
+        help="Number of rows per record batch of a columnar output file"
+    )
+
+    args = parser.parse_args()
+
+    logger.info(f"Converting `{args.input_file}` to `{args.output_file}`...")
+    num_rows = 0
+    if is_columnar_file(args.output_file):
+        writer = ColumnarWriter(args.output_file, batch_size=args.batch_size)
+        for row in iter_rows(args.input_file):
+            writer.write(row)
+        writer.close()
+        num_rows = writer.num_rows
+    else:
+        with open(args.output_file, "w") as f:
+            for row in iter_rows(args.input_file):
+                f.write(json.dumps(row) + "\n")
+                num_rows += 1
+    logger.info(f"Converted {num_rows:,} rows.")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,24 @@
+from __future__ import annotations
+
 import argparse
+import glob
+import hashlib
 import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain
 from pathlib import Path
-from typing import List, Dict, Union
+from typing import TYPE_CHECKING, List, Dict, Union
+
+from models.columnar import is_columnar_file, iter_columnar_rows, \
+    read_columnar_file
 
-import pandas as pd
+# NumPy and pandas are imported where they are needed, which keeps the start
+# of the script fast
+if TYPE_CHECKING:
+    import numpy as np
+    import pandas as pd
+    import pyarrow as pa
 
 
 def read_jsonl_file(file_path: Union[str, Path]) -> List[Dict]:
@@ -12,7 +27,36 @@ def read_jsonl_file(file_path: Union[str, Path]) -> List[Dict]:
     return rows
 
 
+def read_rows(file_path: Union[str, Path]) -> List[Dict]:
+    """Read the rows of a JSONL or columnar (Arrow/Parquet) file."""
+    if is_columnar_file(file_path):
+        return list(iter_columnar_rows(file_path))
+    return read_jsonl_file(file_path)
+
+
+def read_table(file_path: Union[str, Path]) -> pa.Table:
+    """
+    Read the subject, relation and object columns of a JSONL or columnar file
+    as an Arrow table, without creating a Python object per row.
+    """
+    import pyarrow as pa
+    import pyarrow.json
+
+    if is_columnar_file(file_path):
+        return read_columnar_file(file_path)
+    schema = pa.schema([
+        ("SubjectEntity", pa.string()),
+        ("Relation", pa.string()),
+        ("ObjectEntitiesID", pa.list_(pa.string())),
+    ])
+    return pyarrow.json.read_json(
+        file_path,
+        parse_options=pyarrow.json.ParseOptions(
+            explicit_schema=schema, unexpected_field_behavior="ignore"))
+
+
 def true_positives(preds: List, gts: List) -> int:
+    gts = set(gts)
     tp = 0
     for pred in preds:
         if pred in gts:
@@ -208,47 +252,602 @@ def prediction_statistics(scores_per_sr: List[Dict[str, float]]) -> dict:
     return final_stats
 
 
-def main():
-    parser = argparse.ArgumentParser(
-        description="Evaluate Precision, Recall and F1-score of predictions")
-
-    parser.add_argument(
-        "-p", "--predictions",
-        type=str,
-        required=True,
-        help="Path to the predictions file (required)"
+def sorted_unique(values: np.ndarray) -> np.ndarray:
+    """Sorted unique values of an integer array."""
+    import numpy as np
+
+    values = np.sort(values)
+    if len(values) == 0:
+        return values
+    return values[np.concatenate(([True], values[1:] != values[:-1]))]
+
+
+def scores_per_sr_pair(pred_rows, gt_rows) -> pd.DataFrame:
+    """
+    Vectorized equivalent of `evaluate_per_sr_pair`, returned as a DataFrame.
+
+    Object IDs are encoded as integers, and the true positives, precision,
+    recall and F1-score of all Subject-Relation pairs are computed at once
+    with NumPy set operations.
+    """
+    import numpy as np
+    import pandas as pd
+
+    # Like `rows_to_dict`, the last row of a duplicated pair wins
+    gt_dict = {(r["SubjectEntity"], r["Relation"]): r["ObjectEntitiesID"]
+               for r in gt_rows}
+    pred_dict = {(r["SubjectEntity"], r["Relation"]): r["ObjectEntitiesID"]
+                 for r in pred_rows}
+
+    pairs = list(gt_dict)
+    gt_objects = [gt_dict[pair] for pair in pairs]
+    pred_objects = [pred_dict[pair] for pair in pairs]
+
+    # Encode the object IDs as integers
+    num_pairs = len(pairs)
+    gt_lengths = [len(x) for x in gt_objects]
+    pred_lengths = [len(x) for x in pred_objects]
+    codes, uniques = pd.factorize(
+        np.array(list(chain(chain.from_iterable(gt_objects),
+                            chain.from_iterable(pred_objects))), dtype=object),
+        use_na_sentinel=False,
     )
-    parser.add_argument(
-        "-g", "--ground_truth",
-        type=str,
-        required=True,
-        help="Path to the ground truth file (required)"
+    num_gt_objects = sum(gt_lengths)
+    return scores_from_object_codes(
+        pairs,
+        np.repeat(np.arange(num_pairs, dtype=np.int64), gt_lengths),
+        codes[:num_gt_objects],
+        np.repeat(np.arange(num_pairs, dtype=np.int64), pred_lengths),
+        codes[num_gt_objects:],
+        len(uniques),
     )
 
-    args = parser.parse_args()
 
-    # Read the predictions and ground truth
-    pred_rows = read_jsonl_file(args.predictions)
-    gt_rows = read_jsonl_file(args.ground_truth)
+def scores_from_object_codes(pairs, gt_pair_ids: np.ndarray,
+                             gt_codes: np.ndarray, pred_pair_ids: np.ndarray,
+                             pred_codes: np.ndarray,
+                             num_codes: int) -> pd.DataFrame:
+    """
+    Per-pair scores from the integer-encoded ground truth and predicted
+    objects, each given with the index of its pair in `pairs`.
+    """
+    import numpy as np
+
+    # Encode every (pair, object) as one integer key, so that de-duplication
+    # and matching are NumPy set operations
+    num_pairs = len(pairs)
+    num_codes = max(num_codes, 1)
+    gt_keys = sorted_unique(
+        np.asarray(gt_pair_ids, dtype=np.int64) * num_codes + gt_codes)
+    pred_keys = sorted_unique(
+        np.asarray(pred_pair_ids, dtype=np.int64) * num_codes + pred_codes)
+
+    # A ground truth key is a true positive if it is also a predicted key
+    positions = np.searchsorted(pred_keys, gt_keys)
+    matched = pred_keys[np.minimum(positions, len(pred_keys) - 1)] == gt_keys \
+        if len(pred_keys) > 0 else np.zeros(len(gt_keys), dtype=bool)
+
+    total_gt = np.bincount(gt_keys // num_codes, minlength=num_pairs)
+    total_pred = np.bincount(pred_keys // num_codes, minlength=num_pairs)
+    tp = np.bincount(gt_keys[matched] // num_codes, minlength=num_pairs)
+
+    return scores_from_counts(pairs, tp, total_pred, total_gt)
+
+
+def string_codes(*arrays) -> tuple:
+    """
+    Integer codes of the strings of several Arrow arrays, shared between the
+    arrays: equal strings get equal codes. Returns the codes of every array
+    and the number of distinct strings.
+    """
+    import numpy as np
+    import pyarrow as pa
+
+    chunks = []
+    for array in arrays:
+        for chunk in getattr(array, "chunks", [array]):
+            if pa.types.is_dictionary(chunk.type):
+                chunk = chunk.dictionary_decode()
+            chunks.append(chunk.cast(pa.large_string()))
+    encoded = pa.chunked_array(
+        chunks, type=pa.large_string()).combine_chunks().dictionary_encode()
+    codes = encoded.indices.to_numpy(zero_copy_only=False).astype(np.int64)
+    bounds = np.cumsum([0] + [len(array) for array in arrays])
+    return (*(codes[start:end] for start, end in zip(bounds[:-1], bounds[1:])),
+            len(encoded.dictionary))
+
+
+def last_rows(keys: np.ndarray):
+    """The unique keys, sorted, and the index of the last row of each."""
+    import numpy as np
+
+    unique_keys, first = np.unique(keys[::-1], return_index=True)
+    return unique_keys, len(keys) - 1 - first
+
+
+def columnar_scores(pred_table: pa.Table, gt_table: pa.Table) -> pd.DataFrame:
+    """
+    Vectorized equivalent of `evaluate_per_sr_pair` on Arrow tables, e.g. of
+    memory-mapped columnar files. Subjects, relations and objects are
+    encoded as integers by Arrow, so no Python object is created per row
+    except for the pairs of the result.
+    """
+    import numpy as np
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    # Encode every Subject-Relation pair as one integer key
+    gt_subjects, pred_subjects, _ = string_codes(
+        gt_table["SubjectEntity"], pred_table["SubjectEntity"])
+    gt_relations, pred_relations, num_relations = string_codes(
+        gt_table["Relation"], pred_table["Relation"])
+    gt_keys, gt_rows = last_rows(gt_subjects * num_relations + gt_relations)
+    pred_keys, pred_rows = last_rows(
+        pred_subjects * num_relations + pred_relations)
+
+    pairs = list(zip(
+        gt_table["SubjectEntity"].take(gt_rows).cast(pa.string()).to_pylist(),
+        gt_table["Relation"].take(gt_rows).cast(pa.string()).to_pylist()))
+
+    # Like `rows_to_dict`, the last row of a duplicated pair wins, and every
+    # ground truth pair must be predicted
+    positions = np.minimum(np.searchsorted(pred_keys, gt_keys),
+                           max(len(pred_keys) - 1, 0))
+    found = (pred_keys[positions] == gt_keys if len(pred_keys) > 0
+             else np.zeros(len(gt_keys), dtype=bool))
+    if not found.all():
+        raise KeyError(pairs[int(np.argmin(found))])
+    pred_rows = pred_rows[positions]
+
+    gt_objects = gt_table["ObjectEntitiesID"].take(gt_rows)
+    pred_objects = pred_table["ObjectEntitiesID"].take(pred_rows)
+    gt_codes, pred_codes, num_codes = string_codes(
+        pc.list_flatten(gt_objects), pc.list_flatten(pred_objects))
+    return scores_from_object_codes(
+        pairs,
+        pc.list_parent_indices(gt_objects).to_numpy(),
+        gt_codes,
+        pc.list_parent_indices(pred_objects).to_numpy(),
+        pred_codes,
+        num_codes,
+    )
+
+
+def prf_from_counts(tp, total_pred, total_gt):
+    """
+    Precision, recall and F1-score arrays from count arrays of any (matching)
+    shape, with the same edge cases as `precision`, `recall` and `f1_score`.
+    """
+    import numpy as np
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        p = np.where(total_pred == 0, 1.0,
+                     np.minimum(tp / total_pred, 1.0))
+        r = np.where(total_gt == 0, 1.0, np.minimum(tp / total_gt, 1.0))
+        f1 = np.where(p + r == 0, 0.0, 2 * p * r / (p + r))
+    return p, r, f1
+
+
+def scores_from_counts(pairs, tp, total_pred, total_gt) -> pd.DataFrame:
+    """Per-pair scores from the true positive, prediction and ground truth counts."""
+    import numpy as np
+    import pandas as pd
+
+    tp = np.asarray(tp, dtype=np.int64)
+    total_pred = np.asarray(total_pred, dtype=np.int64)
+    total_gt = np.asarray(total_gt, dtype=np.int64)
+    p, r, f1 = prf_from_counts(tp, total_pred, total_gt)
+
+    scores = pd.DataFrame({
+        "SubjectEntity": [pair[0] for pair in pairs],
+        "Relation": [pair[1] for pair in pairs],
+        "p": p,
+        "r": r,
+        "f1": f1,
+        "tp": tp,
+        "total_pred": total_pred,
+        "total_gt": total_gt,
+    })
+
+    # Sort the pairs by relation and subject entity
+    return scores.sort_values(["Relation", "SubjectEntity"],
+                              kind="stable").reset_index(drop=True)
+
+
+def relation_digests(pred_rows, gt_rows) -> Dict[str, str]:
+    """A digest of the ground truth and prediction rows of every relation."""
+    digests = {}
+    for kind, rows in (("gt", gt_rows), ("pred", pred_rows)):
+        for row in rows:
+            digest = digests.setdefault(row["Relation"], hashlib.sha256())
+            digest.update(kind.encode())
+            digest.update(json.dumps(row, sort_keys=True).encode())
+    return {rel: digest.hexdigest() for rel, digest in digests.items()}
+
+
+def incremental_scores(pred_rows, gt_rows,
+                       cache_file: Union[str, Path]) -> pd.DataFrame:
+    """
+    Like `scores_per_sr_pair`, but only re-evaluates the relations whose
+    ground truth or predictions changed since the last evaluation. The per-pair
+    scores of every relation are kept in `cache_file` with the digest of its
+    rows.
+    """
+    import pandas as pd
+
+    cache = {}
+    if Path(cache_file).exists():
+        with open(cache_file) as f:
+            cache = json.load(f)
+
+    gt_relations = {row["Relation"] for row in gt_rows}
+    digests = relation_digests(pred_rows, gt_rows)
+    changed = {rel for rel in gt_relations
+               if cache.get(rel, {}).get("digest") != digests[rel]}
+
+    frames = [pd.DataFrame(cache[rel]["scores"])
+              for rel in sorted(gt_relations - changed)]
+    if changed:
+        scores = scores_per_sr_pair(
+            [row for row in pred_rows if row["Relation"] in changed],
+            [row for row in gt_rows if row["Relation"] in changed])
+        frames.append(scores)
+        for rel, group in scores.groupby("Relation", sort=False):
+            cache[rel] = {
+                "digest": digests[rel],
+                "scores": group.to_dict(orient="list"),
+            }
+
+    # Forget the relations that are no longer evaluated
+    cache = {rel: cache[rel] for rel in gt_relations}
+    tmp_file = Path(str(cache_file) + ".tmp")
+    with open(tmp_file, "w") as f:
+        json.dump(cache, f)
+    os.replace(tmp_file, cache_file)
+
+    scores = pd.concat(frames, ignore_index=True)
+    return scores.sort_values(["Relation", "SubjectEntity"],
+                              kind="stable").reset_index(drop=True)
+
+
+class GroundTruthIndex:
+    """
+    Compact index of a ground truth file: object IDs are encoded as integers
+    and stored per Subject-Relation pair.
+    """
+
+    def __init__(self):
+        self.pair_ids = {}
+        self.objects = []
+        self.object_codes = {}
+
+    @classmethod
+    def from_file(cls, file_path: Union[str, Path]) -> "GroundTruthIndex":
+        """Stream a ground truth JSONL or columnar file into an index."""
+        index = cls()
+        if is_columnar_file(file_path):
+            for row in iter_columnar_rows(file_path):
+                index.add(row)
+            return index
+        with open(file_path, "rb") as f:
+            for line in f:
+                if line.strip():
+                    index.add(json.loads(line))
+        return index
+
+    def add(self, row: Dict):
+        key = (row["SubjectEntity"], row["Relation"])
+        codes = frozenset(
+            self.object_codes.setdefault(qid, len(self.object_codes))
+            for qid in row["ObjectEntitiesID"]
+        )
+        if key in self.pair_ids:
+            # Like `rows_to_dict`, the last row of a duplicated pair wins
+            self.objects[self.pair_ids[key]] = codes
+        else:
+            self.pair_ids[key] = len(self.objects)
+            self.objects.append(codes)
+
+    @property
+    def pairs(self) -> List:
+        return list(self.pair_ids)
+
+    def count(self, row: Dict):
+        """Return the pair ID, true positives and number of predictions of a row."""
+        pair_id = self.pair_ids.get((row["SubjectEntity"], row["Relation"]))
+        if pair_id is None:
+            return None, 0, 0
+        preds = set(row["ObjectEntitiesID"])
+        codes = {self.object_codes[qid] for qid in preds
+                 if qid in self.object_codes}
+        return pair_id, len(codes & self.objects[pair_id]), len(preds)
+
+
+def shard_offsets(file_path: Union[str, Path], num_shards: int) -> List[
+    tuple]:
+    """Split a file into `num_shards` byte ranges of similar sizes."""
+    size = Path(file_path).stat().st_size
+    bounds = [size * i // num_shards for i in range(num_shards + 1)]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def evaluate_shard(file_path: Union[str, Path], start: int, end: int,
+                   index: GroundTruthIndex) -> Dict[int, tuple]:
+    """
+    Stream the prediction lines that start within [start, end) through the
+    ground truth index, and return (true positives, #predictions) per pair.
+    """
+    counts = {}
+    with open(file_path, "rb") as f:
+        if start > 0:
+            # Skip the line that started in the previous shard
+            f.seek(start - 1)
+            f.readline()
+        while f.tell() < end:
+            line = f.readline()
+            if not line:
+                break
+            if not line.strip():
+                continue
+            pair_id, tp, total_pred = index.count(json.loads(line))
+            if pair_id is not None:
+                # Later predictions of the same pair win
+                counts[pair_id] = (tp, total_pred)
+    return counts
+
+
+def evaluate_columnar_file(file_path: Union[str, Path],
+                           index: GroundTruthIndex) -> Dict[int, tuple]:
+    """Like `evaluate_shard`, for a whole columnar prediction file."""
+    counts = {}
+    for row in iter_columnar_rows(file_path):
+        pair_id, tp, total_pred = index.count(row)
+        if pair_id is not None:
+            counts[pair_id] = (tp, total_pred)
+    return counts
+
+
+_shard_index = None
+
+
+def _init_shard_worker(index: GroundTruthIndex):
+    global _shard_index
+    _shard_index = index
+
+
+def _evaluate_shard_worker(args) -> Dict[int, tuple]:
+    return evaluate_shard(*args, index=_shard_index)
+
+
+def merge_shard_results(shard_results: List[Dict[int, tuple]]) -> Dict[
+    int, tuple]:
+    """Merge per-shard counts, in file order."""
+    counts = {}
+    for result in shard_results:
+        counts.update(result)
+    return counts
+
+
+def streaming_scores(pred_file: Union[str, Path], index: GroundTruthIndex,
+                     num_shards: int = 1) -> pd.DataFrame:
+    """
+    Evaluate a prediction file without loading it, optionally split into
+    shards that are evaluated in parallel processes.
+    """
+    shards = shard_offsets(pred_file, max(num_shards, 1))
+    if is_columnar_file(pred_file):
+        shard_results = [evaluate_columnar_file(pred_file, index)]
+    elif len(shards) == 1:
+        shard_results = [evaluate_shard(pred_file, *shards[0], index=index)]
+    else:
+        with ProcessPoolExecutor(max_workers=len(shards),
+                                 initializer=_init_shard_worker,
+                                 initargs=(index,)) as executor:
+            shard_results = list(executor.map(
+                _evaluate_shard_worker,
+                [(pred_file, start, end) for start, end in shards]))
+    counts = merge_shard_results(shard_results)
+
+    pairs = index.pairs
+    tp = []
+    total_pred = []
+    for pair_id, pair in enumerate(pairs):
+        if pair_id not in counts:
+            raise KeyError(pair)
+        tp.append(counts[pair_id][0])
+        total_pred.append(counts[pair_id][1])
+    total_gt = [len(objects) for objects in index.objects]
+
+    return scores_from_counts(pairs, tp, total_pred, total_gt)
+
+
+def _evaluate_run_worker(pred_file) -> pd.DataFrame:
+    return results_table(streaming_scores(pred_file, _shard_index))
+
+
+def compare_runs(pred_files: List[Union[str, Path]], index: GroundTruthIndex,
+                 num_jobs: int = 1) -> pd.DataFrame:
+    """
+    Evaluate many prediction files against one ground truth index, in
+    parallel processes, and combine their tables into one comparison table
+    with one row per run and relation.
+    """
+    import pandas as pd
+
+    if num_jobs > 1 and len(pred_files) > 1:
+        with ProcessPoolExecutor(max_workers=min(num_jobs, len(pred_files)),
+                                 initializer=_init_shard_worker,
+                                 initargs=(index,)) as executor:
+            tables = list(executor.map(_evaluate_run_worker, pred_files))
+    else:
+        tables = [results_table(streaming_scores(pred_file, index))
+                  for pred_file in pred_files]
+
+    # Name the runs after their files, or their paths if the names collide
+    names = [Path(pred_file).stem for pred_file in pred_files]
+    if len(set(names)) < len(names):
+        names = [str(pred_file) for pred_file in pred_files]
+
+    comparison = pd.concat(tables, keys=names, names=["Run", "Relation"])
+    return comparison.reset_index()
+
+
+def results_table(scores: pd.DataFrame) -> pd.DataFrame:
+    """
+    Compute the macro averages, micro averages and prediction statistics per
+    relation from per-pair scores, as printed by `main`.
+    """
+
+    # Sum like the built-in `sum`, so that the results match exactly
+    def total(values) -> float:
+        return sum(values.tolist())
+
+    all_relations = "*** All Relations ***"
+    groups = list(scores.groupby("Relation", sort=True)) + [
+        (all_relations, scores)]
+
+    macro_averages = {}
+    micro_averages = {}
+    stats = {}
+    for rel, group in groups:
+        n = len(group)
+        macro_averages[rel] = {
+            "macro-p": total(group["p"]) / n,
+            "macro-r": total(group["r"]) / n,
+            "macro-f1": total(group["f1"]) / n,
+        }
+
+        tp = int(group["tp"].sum())
+        total_pred = int(group["total_pred"].sum())
+        total_gt = int(group["total_gt"].sum())
+        micro_p = tp / total_pred if total_pred > 0 else 1.0
+        micro_r = tp / total_gt if total_gt > 0 else 1.0
+        micro_averages[rel] = {
+            "micro-p": micro_p,
+            "micro-r": micro_r,
+            "micro-f1": f1_score(micro_p, micro_r),
+        }
+
+        stats[rel] = {
+            "avg. #preds": total_pred / n,
+            "#empty preds": int((group["total_pred"] == 0).sum()),
+        }
+
+    return format_results(macro_averages, micro_averages, stats)
+
 
-    # Evaluate the predictions
-    scores_per_sr_pair = evaluate_per_sr_pair(pred_rows, gt_rows)
+def format_results(macro_per_relation: dict, micro_per_relation: dict,
+                   stats: dict) -> pd.DataFrame:
+    """Combine the averages and statistics into one table."""
+    import pandas as pd
 
     # Macro average
-    macro_per_relation = macro_average_per_relation(scores_per_sr_pair)
     macro_df = pd.DataFrame(macro_per_relation).transpose().round(3)
 
     # Micro average
-    micro_per_relation = micro_average_per_relation(scores_per_sr_pair)
     micro_df = pd.DataFrame(micro_per_relation).transpose().round(3)
 
     # Statistics
-    stats = prediction_statistics(scores_per_sr_pair)
     stats_df = pd.DataFrame(stats).transpose().round(3)
     stats_df["#empty preds"] = stats_df["#empty preds"].astype(int)
 
     # Combine the results
-    results = pd.concat([macro_df, micro_df, stats_df], axis=1)
+    return pd.concat([macro_df, micro_df, stats_df], axis=1)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Evaluate Precision, Recall and F1-score of predictions")
+
+    parser.add_argument(
+        "-p", "--predictions",
+        type=str,
+        nargs="+",
+        required=True,
+        help="Path to the predictions file (required), in JSONL or columnar "
+             "(.arrow, .feather or .parquet) format. Several files or glob "
+             "patterns evaluate many runs into one comparison table"
+    )
+    parser.add_argument(
+        "-g", "--ground_truth",
+        type=str,
+        required=True,
+        help="Path to the ground truth file (required), in JSONL or columnar "
+             "format"
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Stream the predictions through a ground truth index instead of "
+             "loading them"
+    )
+    parser.add_argument(
+        "--shards",
+        type=int,
+        default=1,
+        help="Number of shards of the predictions file evaluated in parallel "
+             "processes (implies --stream)"
+    )
+    parser.add_argument(
+        "--cache_file",
+        type=str,
+        help="Keep the per-pair scores in this file and only re-evaluate the "
+             "relations whose predictions or ground truth changed"
+    )
+    parser.add_argument(
+        "-j", "--jobs",
+        type=int,
+        default=os.cpu_count(),
+        help="Number of parallel processes when comparing several runs"
+    )
+    parser.add_argument(
+        "-o", "--output",
+        type=str,
+        help="Save the comparison table of several runs to a .csv or "
+             ".parquet file"
+    )
+
+    args = parser.parse_args()
+
+    pred_files = []
+    for pattern in args.predictions:
+        pred_files.extend(sorted(glob.glob(pattern)) or [pattern])
+
+    if len(pred_files) > 1 or args.output:
+        # Index the ground truth once and evaluate all runs against it
+        gt_index = GroundTruthIndex.from_file(args.ground_truth)
+        comparison = compare_runs(pred_files, gt_index, args.jobs)
+        print(comparison.set_index(["Run", "Relation"]).to_string())
+
+        if args.output:
+            if Path(args.output).suffix == ".parquet":
+                comparison.to_parquet(args.output, index=False)
+            else:
+                comparison.to_csv(args.output, index=False)
+        return
+
+    if ((is_columnar_file(pred_files[0])
+         or is_columnar_file(args.ground_truth)) and not args.cache_file):
+        # Evaluate the columns of the (memory-mapped) files at once
+        scores = columnar_scores(read_table(pred_files[0]),
+                                 read_table(args.ground_truth))
+    elif args.stream or args.shards > 1:
+        # Index the ground truth, then stream the predictions through it
+        gt_index = GroundTruthIndex.from_file(args.ground_truth)
+        scores = streaming_scores(pred_files[0], gt_index, args.shards)
+    else:
+        # Read the predictions and ground truth
+        pred_rows = read_rows(pred_files[0])
+        gt_rows = read_rows(args.ground_truth)
+
+        # Evaluate the predictions, incrementally when caching
+        if args.cache_file:
+            scores = incremental_scores(pred_rows, gt_rows, args.cache_file)
+        else:
+            scores = scores_per_sr_pair(pred_rows, gt_rows)
+
+    # Macro and micro averages, statistics
+    results = results_table(scores)
     print(results)
 
 
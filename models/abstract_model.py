@@ -13,6 +13,12 @@ class AbstractModel:
             inputs: A list of dictionaries containing the subject entity ("SubjectEntity"), its Wikidata ID ("SubjectEntityID") and relation ("Relation")
 
         Returns:
-            A list of predictions (Wikidata IDs) along with their inputs (subject entity and relation)
+            A list of predictions (Wikidata IDs) along with their inputs (subject entity and relation).
+            Implementations may also yield the predictions one by one, which lets `baseline.py --stream`
+            write each of them as soon as it is ready.
         """
         raise NotImplementedError
+
+    def close(self):
+        """Release the resources held by the model, e.g. open files."""
+        pass
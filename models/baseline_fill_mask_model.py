@@ -1,14 +1,19 @@
+import math
+from itertools import islice
+from pathlib import Path
+from typing import Dict, Iterator, List
+
 import torch
 from loguru import logger
-from tqdm import tqdm
 from transformers import AutoModelForMaskedLM, pipeline, AutoTokenizer
 
 from models.baseline_model import BaselineModel
+from models.profiling import profiler
 
 
 class FillMaskModel(BaselineModel):
     def __init__(self, config):
-        super().__init__()
+        super().__init__(config)
 
         # Getting model parameters from the configuration file
         llm_path = config["llm_path"]
@@ -18,19 +23,64 @@ class FillMaskModel(BaselineModel):
         # Generation parameters
         self.threshold = config["threshold"]
         self.batch_size = config["batch_size"]
+        self.top_k = top_k
+        # Multi-token objects: 1..max_mask_tokens masks, filled by beam search
+        self.max_mask_tokens = config.get("max_mask_tokens", 1)
+        self.beam_size = config.get("beam_size", top_k)
+
+        # Raw top-k outputs, saved for threshold sweeps
+        self.raw_outputs_file = config.get("raw_outputs_file")
+        self._raw_writer = None
+
+        # CPU fast path: thread counts, bf16 weights, dynamic int8
+        # quantization of the linear layers and compilation
+        num_threads = config.get("num_threads")
+        num_interop_threads = config.get("num_interop_threads")
+        torch_dtype = config.get("torch_dtype", "float32")
+        dynamic_quantization = config.get("dynamic_quantization", False)
+        device = config.get(
+            "device", "cuda" if torch.cuda.is_available() else "cpu")
+        if dynamic_quantization:
+            if torch_dtype != "float32":
+                raise ValueError(
+                    "Dynamic quantization requires `torch_dtype: float32`.")
+            # Quantized linear layers only run on CPU
+            device = "cpu"
+
+        if num_threads:
+            torch.set_num_threads(num_threads)
+        if num_interop_threads:
+            try:
+                torch.set_num_interop_threads(num_interop_threads)
+            except RuntimeError:
+                logger.warning("The number of inter-op threads can only be "
+                               "set before any parallel work has started.")
 
         # Initialize the model and tokenizer
         logger.info(f"Loading the tokenizer `{llm_path}`...")
         self.tokenizer = AutoTokenizer.from_pretrained(llm_path)
 
         logger.info(f"Loading the model `{llm_path}`...")
-        self.llm = AutoModelForMaskedLM.from_pretrained(llm_path)
+        self.llm = AutoModelForMaskedLM.from_pretrained(
+            llm_path,
+            torch_dtype=getattr(torch, torch_dtype),
+        )
+        self.llm.eval()
+        if dynamic_quantization:
+            logger.info("Quantizing the linear layers to int8...")
+            self.llm = torch.ao.quantization.quantize_dynamic(
+                self.llm, {torch.nn.Linear}, dtype=torch.qint8)
+        if config.get("compile", False):
+            # Compile the forward pass only, so that the pipeline still sees
+            # a regular model; padded lengths vary, hence dynamic shapes
+            self.llm.forward = torch.compile(self.llm.forward, dynamic=True)
+
         self.pipe = pipeline(
             task="fill-mask",
             model=self.llm,
             tokenizer=self.tokenizer,
             top_k=top_k,
-            device="cuda" if torch.cuda.is_available() else "cpu",
+            device=device,
         )
 
         # Prompt templates
@@ -46,28 +96,69 @@ class FillMaskModel(BaselineModel):
         return prompt
 
     def generate_predictions(self, inputs):
-        logger.info("Generating predictions...")
-        prompts = [
-            self.create_prompt(
-                subject_entity=inp["SubjectEntity"],
-                relation=inp["Relation"]
-            ) for inp in inputs
-        ]
-        outputs = self.pipe(prompts, batch_size=self.batch_size)
+        logger.info("Generating and disambiguating predictions...")
+        with profiler.span("generate_predictions", rows=len(inputs)):
+            with profiler.span("build_prompts", prompts=len(inputs)):
+                prompts = [
+                    self.create_prompt(
+                        subject_entity=inp["SubjectEntity"],
+                        relation=inp["Relation"]
+                    ) for inp in inputs
+                ]
+            if self.max_mask_tokens > 1:
+                outputs = self.iter_fill_multi_token(prompts)
+            else:
+                # Given an iterator, the pipeline yields the outputs as they
+                # complete
+                outputs = iter(self.pipe((prompt for prompt in prompts),
+                                         batch_size=self.batch_size))
 
-        logger.info("Disambiguating entities...")
-        results = []
-        for inp, output, prompt in tqdm(
-                zip(inputs, outputs, prompts),
-                total=len(inputs),
-                desc="Disambiguating entities"):
-            wikidata_ids = []
-            for seq in output:
-                if seq["score"] > self.threshold:
-                    wikidata_id = self.disambiguation_baseline(seq["token_str"])
-                    if wikidata_id:
-                        wikidata_ids.append(wikidata_id)
+            def iter_batches():
+                for start in range(0, len(prompts), self.batch_size):
+                    indices = list(range(
+                        start, min(start + self.batch_size, len(prompts))))
+                    if profiler.enabled:
+                        # Tokenized again for the count only, outside the span
+                        profiler.count("prompt_tokens", sum(
+                            len(ids) for ids in self.tokenizer(
+                                [prompts[i] for i in indices])["input_ids"]))
+                    with profiler.span("fill_mask_batch",
+                                       prompts=len(indices)):
+                        batch_outputs = list(
+                            islice(outputs, self.batch_size))
+                    yield indices, batch_outputs
 
+            def disambiguate(indices, batch_outputs):
+                batch_inputs = [inputs[i] for i in indices]
+                if self.raw_outputs_file:
+                    # Disambiguate every top-k token, not only those above the
+                    # threshold, so that the raw outputs can be swept offline
+                    token_ids = self.disambiguate_top_k(batch_inputs,
+                                                        batch_outputs)
+                    with profiler.span("write_raw_outputs",
+                                       rows=len(batch_inputs)):
+                        self.write_raw_outputs(batch_inputs, batch_outputs,
+                                               token_ids)
+                    return [
+                        [wikidata_id for seq, wikidata_id in zip(output, ids)
+                         if seq["score"] > self.threshold and wikidata_id]
+                        for output, ids in zip(batch_outputs, token_ids)
+                    ]
+                entity_lists = [
+                    [seq["token_str"] for seq in output
+                     if seq["score"] > self.threshold]
+                    for output in batch_outputs
+                ]
+                return self.disambiguate_all(
+                    entity_lists,
+                    relations=[inp["Relation"] for inp in batch_inputs])
+
+            with torch.inference_mode():
+                wikidata_id_lists = self.disambiguate_pipelined(
+                    inputs, iter_batches(), disambiguate)
+
+        results = []
+        for inp, wikidata_ids in zip(inputs, wikidata_id_lists):
             result_row = {
                 "SubjectEntityID": inp["SubjectEntityID"],
                 "SubjectEntity": inp["SubjectEntity"],
@@ -77,3 +168,174 @@ class FillMaskModel(BaselineModel):
             results.append(result_row)
 
         return results
+
+    def iter_fill_multi_token(self, prompts: List[str]) -> Iterator[
+        List[Dict]]:
+        """Yield the multi-token outputs of the prompts, batch by batch."""
+        for start in range(0, len(prompts), self.batch_size):
+            yield from self.fill_multi_token(
+                prompts[start:start + self.batch_size])
+
+    def fill_multi_token(self, prompts: List[str]) -> List[List[Dict]]:
+        """
+        Predict objects of 1 to `max_mask_tokens` tokens for a batch of
+        prompts, in the output format of the fill-mask pipeline.
+
+        The mask of every prompt is expanded into 1..K mask tokens, and the
+        masks are filled from left to right with a beam search: in round s,
+        all unfinished candidates of all prompts and lengths go through the
+        model together, every candidate is extended with its `beam_size` most
+        likely tokens at its s-th mask, and only the `beam_size` best
+        candidates per prompt and length are kept. A batch thus takes K
+        rounds of forward passes.
+
+        The score of a candidate is the geometric mean of its token
+        probabilities, i.e. its length-normalized likelihood. It equals the
+        pipeline's score for one token, but it is not a calibrated
+        probability, and its scale differs between lengths, so `threshold`
+        should be tuned again (e.g. with `threshold_sweep.py`) for K > 1.
+        """
+        mask_token_id = self.tokenizer.mask_token_id
+        special_ids = torch.tensor(self.tokenizer.all_special_ids)
+        device = self.llm.device
+
+        # Candidates: (prompt, length, token IDs, mask position, log-prob)
+        candidates = []
+        for i, ids in enumerate(self.tokenizer(prompts)["input_ids"]):
+            position = ids.index(mask_token_id)
+            for length in range(1, self.max_mask_tokens + 1):
+                candidates.append((
+                    i, length,
+                    ids[:position] + [mask_token_id] * length
+                    + ids[position + 1:],
+                    position, 0.0,
+                ))
+
+        finished = []
+        chunk_size = self.batch_size * self.beam_size
+        for step in range(self.max_mask_tokens):
+            expanded = {}
+            for start in range(0, len(candidates), chunk_size):
+                chunk = candidates[start:start + chunk_size]
+                max_length = max(len(c[2]) for c in chunk)
+                input_ids = torch.tensor(
+                    [c[2] + [self.tokenizer.pad_token_id]
+                     * (max_length - len(c[2])) for c in chunk],
+                    device=device)
+                attention_mask = torch.tensor(
+                    [[1] * len(c[2]) + [0] * (max_length - len(c[2]))
+                     for c in chunk],
+                    device=device)
+                positions = torch.tensor([c[3] + step for c in chunk],
+                                         device=device)
+
+                logits = self.llm(input_ids=input_ids,
+                                  attention_mask=attention_mask).logits
+                log_probs = logits[torch.arange(len(chunk), device=device),
+                                   positions].float().log_softmax(dim=-1)
+                log_probs[:, special_ids] = float("-inf")
+                top_log_probs, top_ids = log_probs.topk(self.beam_size,
+                                                        dim=-1)
+
+                for c, token_log_probs, token_ids in zip(
+                        chunk, top_log_probs.tolist(), top_ids.tolist()):
+                    i, length, ids, position, log_prob = c
+                    for token_log_prob, token_id in zip(token_log_probs,
+                                                        token_ids):
+                        new_ids = list(ids)
+                        new_ids[position + step] = token_id
+                        expanded.setdefault((i, length), []).append((
+                            i, length, new_ids, position,
+                            log_prob + token_log_prob))
+
+            # Keep the best candidates per prompt and length
+            candidates = []
+            for beams in expanded.values():
+                beams.sort(key=lambda c: -c[4])
+                for c in beams[:self.beam_size]:
+                    if c[1] == step + 1:
+                        finished.append(c)
+                    else:
+                        candidates.append(c)
+
+        outputs = [{} for _ in prompts]
+        for i, length, ids, position, log_prob in finished:
+            token_str = self.tokenizer.decode(
+                ids[position:position + length]).strip()
+            # Length-normalized likelihood
+            score = math.exp(log_prob / length)
+            if token_str and score > outputs[i].get(token_str, -1.0):
+                outputs[i][token_str] = score
+
+        return [
+            [{"token_str": token_str, "score": score}
+             for token_str, score in sorted(
+                 output.items(), key=lambda x: -x[1])[:self.top_k]]
+            for output in outputs
+        ]
+
+    def disambiguate_top_k(self, inputs, outputs) -> List[List[str]]:
+        """The Wikidata ID of every top-k token ("" if it does not resolve)."""
+        tokens = [seq["token_str"] for output in outputs for seq in output]
+        relations = [inp["Relation"] for inp, output in zip(inputs, outputs)
+                     for _ in output]
+        resolved = self.disambiguate_all([[token] for token in tokens],
+                                         relations=relations)
+
+        token_ids = []
+        position = 0
+        for output in outputs:
+            token_ids.append([
+                ids[0] if ids else ""
+                for ids in resolved[position:position + len(output)]
+            ])
+            position += len(output)
+        return token_ids
+
+    def write_raw_outputs(self, inputs, outputs, token_ids):
+        """Append the raw top-k outputs to a Parquet file, one row per token."""
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        columns = {
+            "SubjectEntityID": [],
+            "SubjectEntity": [],
+            "Relation": [],
+            "Rank": [],
+            "Token": [],
+            "Score": [],
+            "ObjectEntityID": [],
+        }
+        for inp, output, ids in zip(inputs, outputs, token_ids):
+            for rank, (seq, wikidata_id) in enumerate(zip(output, ids)):
+                columns["SubjectEntityID"].append(inp["SubjectEntityID"])
+                columns["SubjectEntity"].append(inp["SubjectEntity"])
+                columns["Relation"].append(inp["Relation"])
+                columns["Rank"].append(rank)
+                columns["Token"].append(seq["token_str"])
+                columns["Score"].append(float(seq["score"]))
+                columns["ObjectEntityID"].append(wikidata_id)
+
+        table = pa.Table.from_pydict(columns, schema=pa.schema([
+            ("SubjectEntityID", pa.string()),
+            ("SubjectEntity", pa.string()),
+            ("Relation", pa.string()),
+            ("Rank", pa.int16()),
+            ("Token", pa.string()),
+            ("Score", pa.float32()),
+            ("ObjectEntityID", pa.string()),
+        ]))
+        if self._raw_writer is None:
+            Path(self.raw_outputs_file).parent.mkdir(parents=True,
+                                                     exist_ok=True)
+            logger.info(f"Saving the raw top-k outputs to "
+                        f"`{self.raw_outputs_file}`...")
+            self._raw_writer = pq.ParquetWriter(self.raw_outputs_file,
+                                                table.schema)
+        self._raw_writer.write_table(table)
+
+    def close(self):
+        if self._raw_writer is not None:
+            self._raw_writer.close()
+            self._raw_writer = None
+        super().close()
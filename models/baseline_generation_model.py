@@ -1,29 +1,64 @@
+import copy
 import json
 import random
+import time
+from typing import Iterator, List, Optional, Tuple
 
 import torch
 from loguru import logger
 from tqdm import tqdm
 from transformers import pipeline, AutoModelForCausalLM, AutoTokenizer, \
-    BitsAndBytesConfig
+    BitsAndBytesConfig, DynamicCache, GenerationConfig, LogitsProcessorList, \
+    NoRepeatNGramLogitsProcessor, RepetitionPenaltyLogitsProcessor, \
+    StopStringCriteria, TemperatureLogitsWarper, TopKLogitsWarper, \
+    TopPLogitsWarper
 
 from models.baseline_model import BaselineModel
+from models.constrained_decoding import AnswerTries, ConstrainedAnswer, \
+    read_relation_labels
+from models.profiling import profiler
+
+# Generation config settings that `GenerationModel.decode` does not apply
+UNSUPPORTED_GENERATION_SETTINGS = (
+    "num_beams", "min_length", "min_new_tokens", "bad_words_ids",
+    "sequence_bias", "typical_p", "min_p", "epsilon_cutoff", "eta_cutoff",
+    "suppress_tokens", "begin_suppress_tokens", "forced_bos_token_id",
+    "forced_eos_token_id", "exponential_decay_length_penalty",
+    "guidance_scale",
+)
 
 
 class GenerationModel(BaselineModel):
+    # Text between the prompt and the first object of an answer
+    answer_prefix = " "
+
     def __init__(self, config):
-        super().__init__()
+        super().__init__(config)
 
         # Getting parameters from the configuration file
         llm_path = config["llm_path"]
         prompt_templates_file = config["prompt_templates_file"]
         train_data_file = config["train_data_file"]
         use_quantization = config.get("use_quantization", True)
+        # Device (map) of the model, e.g. "cuda:1" for one worker per GPU
+        device_map = config.get("device", "auto")
 
         # Generation parameters
         self.few_shot = config.get("few_shot", 5)
         self.batch_size = config.get("batch_size", 4)
         self.max_new_tokens = config.get("max_new_tokens", 64)
+        # Token budget per batch; batches are built by prompt length if set
+        self.max_batch_tokens = config.get("max_batch_tokens")
+        # Fixed few-shot prefix per relation whose key/values are reused
+        self.prefix_caching = config.get("prefix_caching", False)
+        self.few_shot_seed = config.get("few_shot_seed", 0)
+        self.fixed_examples = {}
+        # Each sequence stops as soon as it emits one of these strings
+        self.stop_strings = config.get("stop_strings", ["\n"])
+        self._stop_criteria = None
+        self._logits_processors = None
+        # End-of-sequence token IDs (default: the model's generation config)
+        self.eos_token_id = None
 
         # Initialize the model and tokenizer
         logger.info(f"Loading the tokenizer `{llm_path}`...")
@@ -44,14 +79,14 @@ class GenerationModel(BaselineModel):
             )
             self.llm = AutoModelForCausalLM.from_pretrained(
                 llm_path,
-                device_map="auto",
+                device_map=device_map,
                 quantization_config=bnb_config,
                 torch_dtype=torch.float16,
             )
         else:
             self.llm = AutoModelForCausalLM.from_pretrained(
                 llm_path,
-                device_map="auto"
+                device_map=device_map
             )
         self.pipe = pipeline(
             task="text-generation",
@@ -67,6 +102,14 @@ class GenerationModel(BaselineModel):
         self.in_context_examples = self.instantiate_in_context_examples(
             train_data_file)
 
+        # Constrained decoding: the answers of these relations are restricted
+        # to known object labels, which map to their IDs directly
+        self.answer_tries = {}
+        constrained_relations = config.get("constrained_relations", [])
+        if constrained_relations:
+            self.answer_tries = self.build_answer_tries(
+                config["constrained_label_sources"], constrained_relations)
+
     def instantiate_in_context_examples(self, train_data_file):
         logger.info(f"Reading train data from `{train_data_file}`...")
         with open(train_data_file) as f:
@@ -86,50 +129,574 @@ class GenerationModel(BaselineModel):
 
         return in_context_examples
 
-    def create_prompt(self, subject_entity: str, relation: str) -> str:
+    def sample_in_context_examples(self, pool: list, relation: str) -> list:
+        """
+        Sample `few_shot` in-context examples from the pool.
+
+        With prefix caching, the examples are drawn once per relation with a
+        seeded RNG and reused, so all prompts of a relation share a prefix.
+        """
+        if self.few_shot <= 0:
+            return []
+        k = min(self.few_shot, len(pool))
+        if not self.prefix_caching:
+            return random.sample(pool, k)
+        if relation not in self.fixed_examples:
+            rng = random.Random(f"{self.few_shot_seed}-{relation}")
+            self.fixed_examples[relation] = rng.sample(pool, k)
+        return self.fixed_examples[relation]
+
+    def create_prompt_parts(self, subject_entity: str, relation: str) -> Tuple[
+        str, str]:
+        """Create a prompt as (few-shot prefix, subject-specific suffix)."""
         template = self.prompt_templates[relation]
-        if self.few_shot > 0:
-            random_examples = random.sample(
-                self.in_context_examples,
-                min(self.few_shot, len(self.in_context_examples))
-            )
-        else:
-            random_examples = []
+        random_examples = self.sample_in_context_examples(
+            self.in_context_examples, relation)
         few_shot_examples = "\n".join(random_examples)
-        prompt = (f"{few_shot_examples}"
-                  f"\n{template.format(subject_entity=subject_entity)}")
-        return prompt
+        return (f"{few_shot_examples}\n",
+                template.format(subject_entity=subject_entity))
 
-    def generate_predictions(self, inputs):
-        logger.info("Generating predictions...")
-        prompts = [
-            self.create_prompt(
-                subject_entity=inp["SubjectEntity"],
-                relation=inp["Relation"]
-            ) for inp in inputs
+    def create_prompt(self, subject_entity: str, relation: str) -> str:
+        return "".join(self.create_prompt_parts(subject_entity, relation))
+
+    def tokenize_continuations(self, texts: List[str]) -> List[List[int]]:
+        """
+        Tokenize texts in the context of a preceding line, so that their
+        first token is the one generated after other text.
+        """
+        anchor_ids = self.tokenizer("\n", add_special_tokens=False)[
+            "input_ids"]
+        token_ids = []
+        for ids, text in zip(self.tokenizer(
+                ["\n" + text for text in texts],
+                add_special_tokens=False)["input_ids"], texts):
+            if ids[:len(anchor_ids)] == anchor_ids:
+                token_ids.append(ids[len(anchor_ids):])
+            else:
+                token_ids.append(self.tokenizer(
+                    text, add_special_tokens=False)["input_ids"])
+        return token_ids
+
+    def build_answer_tries(self, sources, relations) -> dict:
+        """Build the answer tries of the constrained relations."""
+        logger.info(f"Building the answer tries of {len(relations):,} "
+                    f"relations from {', '.join(map(str, sources))}...")
+        answer_tries = {}
+        for relation, labels in read_relation_labels(sources,
+                                                     relations).items():
+            if not labels:
+                logger.warning(f"No labels found for the constrained "
+                               f"relation `{relation}`.")
+                continue
+            answer_tries[relation] = AnswerTries(
+                labels, self.tokenize_continuations,
+                answer_prefix=self.answer_prefix)
+            logger.info(f"Constrained `{relation}` to "
+                        f"{answer_tries[relation].first.num_labels - 1:,} "
+                        f"labels.")
+        return answer_tries
+
+    def create_constraints(self, inputs) -> Optional[
+        List[Optional[ConstrainedAnswer]]]:
+        """The answer state of every input of a constrained relation."""
+        if not self.answer_tries:
+            return None
+        return [
+            ConstrainedAnswer(self.answer_tries[inp["Relation"]])
+            if inp["Relation"] in self.answer_tries else None
+            for inp in inputs
         ]
 
-        outputs = []
-        for i in tqdm(range(0, len(prompts), self.batch_size),
-                      total=(len(prompts) // self.batch_size + 1),
-                      desc="Generating predictions"):
-            prompt_batch = prompts[i:i + self.batch_size]
-            output = self.pipe(
-                prompt_batch,
-                batch_size=self.batch_size,
-                max_new_tokens=self.max_new_tokens,
+    def schedule_batches(self, prompt_ids) -> List[List[int]]:
+        """
+        Group the indices of tokenized prompts into batches.
+
+        Without a token budget, prompts are sliced into batches of
+        `batch_size` in input order. With `max_batch_tokens`, prompts are
+        sorted by token length and packed so that each batch's padded size,
+        (longest prompt + `max_new_tokens`) * number of prompts, stays within
+        the budget. Similar lengths end up together, which minimizes padding.
+        """
+        if not self.max_batch_tokens:
+            return [list(range(i, min(i + self.batch_size, len(prompt_ids))))
+                    for i in range(0, len(prompt_ids), self.batch_size)]
+
+        lengths = [len(ids) for ids in prompt_ids]
+        # Longest prompts first, so that memory problems surface early
+        order = sorted(range(len(prompt_ids)), key=lambda i: -lengths[i])
+
+        batches = []
+        batch = []
+        batch_length = 0
+        for i in order:
+            length = max(batch_length, lengths[i] + self.max_new_tokens)
+            if batch and length * (len(batch) + 1) > self.max_batch_tokens:
+                batches.append(batch)
+                batch = []
+                length = lengths[i] + self.max_new_tokens
+            batch.append(i)
+            batch_length = length
+        if batch:
+            batches.append(batch)
+
+        return batches
+
+    def generate_batched(self, prompts, eos_token_id=None) -> List[str]:
+        """Generate over left-padded batches and keep the input order."""
+        outputs = [None] * len(prompts)
+        for batch, texts in self.iter_generate_batched(
+                prompts, eos_token_id=eos_token_id):
+            for i, text in zip(batch, texts):
+                outputs[i] = text
+        return outputs
+
+    def iter_generate_batched(self, prompts, eos_token_id=None,
+                              constraints=None) -> Iterator[
+        Tuple[List[int], List[str]]]:
+        """
+        Yield (prompt indices, new texts) of every batch as it completes.
+
+        `constraints` may hold a ConstrainedAnswer (or None) per prompt.
+        """
+        with profiler.span("tokenize", prompts=len(prompts)):
+            prompt_ids = self.tokenizer(prompts)["input_ids"]
+        return self.iter_generate_ids_batched(prompt_ids,
+                                              eos_token_id=eos_token_id,
+                                              constraints=constraints)
+
+    def iter_generate_ids_batched(self, prompt_ids, eos_token_id=None,
+                                  constraints=None) -> Iterator[
+        Tuple[List[int], List[str]]]:
+        """Like `iter_generate_batched`, for prompts given as token IDs."""
+        batches = self.schedule_batches(prompt_ids)
+
+        start_time = time.perf_counter()
+        for batch in tqdm(batches, desc="Generating predictions"):
+            input_ids, attention_mask = self.left_pad(
+                [prompt_ids[i] for i in batch])
+            texts = self.decode(
+                input_ids,
+                attention_mask,
+                eos_token_id=eos_token_id,
+                constraints=([constraints[i] for i in batch]
+                             if constraints is not None else None),
             )
-            outputs.extend(output)
+            yield batch, texts
+
+        elapsed = time.perf_counter() - start_time
+        logger.info(
+            f"Generated {len(prompt_ids):,} prompts in {len(batches):,} "
+            f"batches in {elapsed:.1f}s "
+            f"({len(prompt_ids) / elapsed if elapsed > 0 else 0:.2f} "
+            f"prompts/sec)."
+        )
+
+    def left_pad(self, sequences) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Left-pad token ID lists into a batch and its attention mask."""
+        pad_token_id = self.tokenizer.pad_token_id
+        max_length = max(len(ids) for ids in sequences)
+        input_ids = torch.tensor([
+            [pad_token_id] * (max_length - len(ids)) + ids
+            for ids in sequences
+        ], device=self.llm.device)
+        attention_mask = torch.tensor([
+            [0] * (max_length - len(ids)) + [1] * len(ids)
+            for ids in sequences
+        ], device=self.llm.device)
+        return input_ids, attention_mask
+
+    def stop_criteria(self) -> Optional[StopStringCriteria]:
+        """Whether each sequence ends with one of the stop strings."""
+        if self._stop_criteria is None and self.stop_strings:
+            self._stop_criteria = StopStringCriteria(self.tokenizer,
+                                                     self.stop_strings)
+        return self._stop_criteria
+
+    def stop_start_token_ids(self) -> set:
+        """The first tokens of the stop strings, generated after other text."""
+        return {ids[0] for ids in self.tokenize_continuations(
+            [stop for stop in self.stop_strings if stop]) if ids}
+
+    def logits_processors(self) -> Tuple[LogitsProcessorList,
+                                         LogitsProcessorList]:
+        """
+        The logits processors and sampling warpers of the model's generation
+        config, in the order in which `generate()` applies them.
+        """
+        if self._logits_processors is None:
+            generation_config = self.llm.generation_config
+            defaults = GenerationConfig()
+            unsupported = [
+                name for name in UNSUPPORTED_GENERATION_SETTINGS
+                if getattr(generation_config, name, None)
+                not in (None, getattr(defaults, name, None))
+            ]
+            if unsupported:
+                logger.warning(f"The generation config settings "
+                               f"{unsupported} are not applied.")
+
+            processors = LogitsProcessorList()
+            repetition_penalty = generation_config.repetition_penalty
+            if repetition_penalty is not None and repetition_penalty != 1.0:
+                processors.append(
+                    RepetitionPenaltyLogitsProcessor(repetition_penalty))
+            if generation_config.no_repeat_ngram_size:
+                processors.append(NoRepeatNGramLogitsProcessor(
+                    generation_config.no_repeat_ngram_size))
+
+            warpers = LogitsProcessorList()
+            temperature = generation_config.temperature
+            if temperature is not None and temperature != 1.0:
+                warpers.append(TemperatureLogitsWarper(temperature))
+            if generation_config.top_k:
+                warpers.append(TopKLogitsWarper(generation_config.top_k))
+            top_p = generation_config.top_p
+            if top_p is not None and top_p < 1.0:
+                warpers.append(TopPLogitsWarper(top_p))
+            self._logits_processors = processors, warpers
+        return self._logits_processors
+
+    def select_next_tokens(self, sequence_ids: torch.Tensor,
+                           logits: torch.Tensor) -> torch.Tensor:
+        """Pick the next tokens following the model's generation config."""
+        if not self.llm.generation_config.do_sample:
+            return logits.argmax(dim=-1)
+        _, warpers = self.logits_processors()
+        logits = warpers(sequence_ids, logits.float())
+        return torch.multinomial(logits.softmax(dim=-1), num_samples=1)[:, 0]
+
+    def constrain_logits(self, logits: torch.Tensor, constraints,
+                         end_token_ids: torch.Tensor) -> torch.Tensor:
+        """Mask the logits of constrained sequences to their allowed tokens."""
+        mask = torch.zeros_like(logits)
+        for row, constraint in enumerate(constraints):
+            if constraint is None:
+                continue
+            allowed = constraint.allowed_token_ids(logits.device)
+            if allowed is None:
+                continue
+            mask[row] = float("-inf")
+            mask[row, allowed] = 0
+            if constraint.can_end():
+                mask[row, end_token_ids] = 0
+        return logits + mask
+
+    def decode(self, input_ids, attention_mask, past_key_values=None,
+               eos_token_id=None, constraints=None) -> List[str]:
+        """
+        Generate the new text of a batch, token by token.
+
+        A sequence finishes as soon as it emits an end-of-sequence token or
+        ends with one of the stop strings, and is then dropped from the active
+        batch, so the remaining steps only run the unfinished sequences. The
+        logits processors of the model's generation config are applied as by
+        `generate()`. Only the newly generated text is returned, which may
+        go on after a stop string inside a token (see `truncate_at_stop`).
+
+        `past_key_values` may hold the key/values of the first tokens of
+        `input_ids`, in which case only the remaining tokens are encoded.
+
+        `constraints` may hold a ConstrainedAnswer (or None) per sequence, in
+        which case only the tokens its trie allows are generated, and it
+        tracks the labels that were generated.
+        """
+        if eos_token_id is None:
+            eos_token_id = self.llm.generation_config.eos_token_id
+        if isinstance(eos_token_id, int):
+            eos_token_id = [eos_token_id]
+        eos_token_ids = set(eos_token_id or [])
+        stop_criteria = self.stop_criteria()
+        processors, _ = self.logits_processors()
+        if constraints is not None:
+            end_token_ids = torch.tensor(
+                sorted(eos_token_ids | self.stop_start_token_ids()),
+                dtype=torch.long, device=input_ids.device)
+
+        if past_key_values is None:
+            past_key_values = DynamicCache()
+        past_length = past_key_values.get_seq_length()
+
+        new_token_ids = [[] for _ in range(input_ids.shape[0])]
+        active = list(range(input_ids.shape[0]))
+        sequence_ids = input_ids
+        position_ids = (attention_mask.cumsum(dim=-1) - 1).clamp(min=0)
+        position_ids = position_ids[:, past_length:]
+        next_input_ids = input_ids[:, past_length:]
+
+        with profiler.span("generate_batch",
+                           prompts=input_ids.shape[0]) as span:
+            if profiler.enabled:
+                prompt_tokens = int(attention_mask[:, past_length:].sum())
+                profiler.count("prompt_tokens", prompt_tokens)
+                span.set(prompt_tokens=prompt_tokens)
+
+            for _ in range(self.max_new_tokens):
+                with torch.inference_mode():
+                    logits = self.llm(
+                        input_ids=next_input_ids,
+                        attention_mask=attention_mask,
+                        position_ids=position_ids,
+                        past_key_values=past_key_values,
+                        use_cache=True,
+                    ).logits[:, -1, :].float()
+                logits = processors(sequence_ids, logits)
+                if constraints is not None:
+                    logits = self.constrain_logits(
+                        logits, [constraints[i] for i in active],
+                        end_token_ids)
+                next_tokens = self.select_next_tokens(sequence_ids, logits)
+                sequence_ids = torch.cat([sequence_ids, next_tokens[:, None]],
+                                         dim=-1)
+                stopped = (stop_criteria(sequence_ids, logits).tolist()
+                           if stop_criteria is not None
+                           else [False] * len(active))
+
+                keep = []
+                for row, token_id in enumerate(next_tokens.tolist()):
+                    if (constraints is not None
+                            and constraints[active[row]] is not None):
+                        constraints[active[row]].advance(token_id)
+                    if token_id in eos_token_ids:
+                        continue
+                    new_token_ids[active[row]].append(token_id)
+                    if not stopped[row]:
+                        keep.append(row)
+
+                if not keep:
+                    break
+                if len(keep) < len(active):
+                    # Drop the finished sequences from the batch
+                    rows = torch.tensor(keep, device=input_ids.device)
+                    past_key_values.batch_select_indices(rows)
+                    attention_mask = attention_mask[rows]
+                    position_ids = position_ids[rows]
+                    sequence_ids = sequence_ids[rows]
+                    next_tokens = next_tokens[rows]
+                    active = [active[row] for row in keep]
+
+                attention_mask = torch.cat(
+                    [attention_mask,
+                     attention_mask.new_ones((len(active), 1))],
+                    dim=-1)
+                position_ids = position_ids[:, -1:] + 1
+                next_input_ids = next_tokens[:, None]
+
+            if profiler.enabled:
+                new_tokens = sum(len(ids) for ids in new_token_ids)
+                profiler.count("generated_tokens", new_tokens)
+                span.set(new_tokens=new_tokens)
+
+        return self.tokenizer.batch_decode(new_token_ids,
+                                           skip_special_tokens=True)
+
+    def generate_with_prefix_cache(self, prompt_parts,
+                                   eos_token_id=None) -> List[str]:
+        """
+        Generate outputs for (prefix, suffix) prompts, encoding every distinct
+        prefix only once.
+
+        The past key/values of each prefix are computed once and copied into
+        every batch of prompts that share it, so only the suffixes are
+        prefilled. Prompts whose tokenization does not start with the
+        tokenized prefix are generated without the cache.
+        """
+        outputs = [None] * len(prompt_parts)
+        for batch, texts in self.iter_generate_with_prefix_cache(
+                prompt_parts, eos_token_id=eos_token_id):
+            for i, text in zip(batch, texts):
+                outputs[i] = text
+        return outputs
+
+    def iter_generate_with_prefix_cache(self, prompt_parts, eos_token_id=None,
+                                        constraints=None) -> Iterator[
+        Tuple[List[int], List[str]]]:
+        """Like `generate_with_prefix_cache`, yielding every batch as it completes."""
+        prompts = [prefix + suffix for prefix, suffix in prompt_parts]
+        with profiler.span("tokenize", prompts=len(prompts)):
+            prompt_ids = self.tokenizer(prompts)["input_ids"]
+
+            # Split off the suffix tokens after the tokenized prefix
+            prefix_ids = {}
+            prompt_parts_ids = []
+            for i, (prefix, _) in enumerate(prompt_parts):
+                if prefix not in prefix_ids:
+                    prefix_ids[prefix] = self.tokenizer(prefix)["input_ids"]
+                ids = prefix_ids[prefix]
+                if (len(prompt_ids[i]) > len(ids)
+                        and prompt_ids[i][:len(ids)] == ids):
+                    prompt_parts_ids.append((ids, prompt_ids[i][len(ids):]))
+                else:
+                    prompt_parts_ids.append(([], prompt_ids[i]))
+
+        return self.iter_generate_ids_with_prefix_cache(
+            prompt_parts_ids, eos_token_id=eos_token_id,
+            constraints=constraints)
+
+    def iter_generate_ids_with_prefix_cache(self, prompt_parts_ids,
+                                            eos_token_id=None,
+                                            constraints=None) -> Iterator[
+        Tuple[List[int], List[str]]]:
+        """
+        Like `iter_generate_with_prefix_cache`, for prompts given as (prefix
+        token IDs, suffix token IDs). Prompts with an empty prefix or suffix
+        are generated without the cache.
+        """
+        # Group the prompts by prefix
+        groups = {}
+        uncached = []
+        for i, (prefix_ids, suffix_ids) in enumerate(prompt_parts_ids):
+            if prefix_ids and suffix_ids:
+                groups.setdefault(tuple(prefix_ids), []).append(i)
+            else:
+                uncached.append(i)
+
+        jobs = [
+            (prefix, indices[j:j + self.batch_size])
+            for prefix, indices in groups.items()
+            for j in range(0, len(indices), self.batch_size)
+        ]
+
+        start_time = time.perf_counter()
+        prefix_cache = None
+        cached_prefix = None
+        for prefix, batch in tqdm(jobs, desc="Generating predictions"):
+            ids = list(prefix)
+            if prefix != cached_prefix:
+                with profiler.span("prefill_prefix", prefix_tokens=len(ids)), \
+                        torch.inference_mode():
+                    prefix_cache = self.llm(
+                        torch.tensor([ids], device=self.llm.device),
+                        use_cache=True,
+                    ).past_key_values
+                cached_prefix = prefix
+
+            texts = self.generate_from_prefix(
+                ids, prefix_cache,
+                [prompt_parts_ids[i][1] for i in batch],
+                eos_token_id=eos_token_id,
+                constraints=([constraints[i] for i in batch]
+                             if constraints is not None else None),
+            )
+            yield batch, texts
+
+        num_cached = len(prompt_parts_ids) - len(uncached)
+        elapsed = time.perf_counter() - start_time
+        logger.info(
+            f"Generated {num_cached:,} prompts with "
+            f"{len(groups):,} cached prefixes in {elapsed:.1f}s "
+            f"({num_cached / elapsed if elapsed > 0 else 0:.2f} prompts/sec)."
+        )
+
+        if uncached:
+            for batch, texts in self.iter_generate_ids_batched(
+                    [prompt_parts_ids[i][0] + prompt_parts_ids[i][1]
+                     for i in uncached],
+                    eos_token_id=eos_token_id,
+                    constraints=([constraints[i] for i in uncached]
+                                 if constraints is not None else None)):
+                yield [uncached[i] for i in batch], texts
+
+    def generate_from_prefix(self, prefix_ids, prefix_cache, suffix_ids,
+                             eos_token_id=None, constraints=None) -> List[
+        str]:
+        """Generate continuations of a batch of suffixes after a cached prefix."""
+        pad_token_id = self.tokenizer.pad_token_id
+        max_length = max(len(ids) for ids in suffix_ids)
+
+        # The suffixes are left-padded between the prefix and their tokens
+        input_ids = torch.tensor([
+            prefix_ids + [pad_token_id] * (max_length - len(ids)) + ids
+            for ids in suffix_ids
+        ], device=self.llm.device)
+        attention_mask = torch.tensor([
+            [1] * len(prefix_ids) + [0] * (max_length - len(ids))
+            + [1] * len(ids)
+            for ids in suffix_ids
+        ], device=self.llm.device)
+
+        cache = copy.deepcopy(prefix_cache)
+        cache.batch_repeat_interleave(len(suffix_ids))
+
+        return self.decode(input_ids, attention_mask,
+                           past_key_values=cache,
+                           eos_token_id=eos_token_id,
+                           constraints=constraints)
+
+    def generate_outputs(self, inputs, eos_token_id=None) -> List[str]:
+        """Create the prompts of the inputs and generate their new text."""
+        outputs = [None] * len(inputs)
+        for batch, texts in self.iter_generate_outputs(
+                inputs, eos_token_id=eos_token_id):
+            for i, text in zip(batch, texts):
+                outputs[i] = text
+        return outputs
+
+    def iter_generate_outputs(self, inputs, eos_token_id=None,
+                              constraints=None) -> Iterator[
+        Tuple[List[int], List[str]]]:
+        """Like `generate_outputs`, yielding (input indices, new texts) per batch."""
+        if self.prefix_caching:
+            with profiler.span("build_prompts", prompts=len(inputs)):
+                prompt_parts = [
+                    self.create_prompt_parts(
+                        subject_entity=inp["SubjectEntity"],
+                        relation=inp["Relation"]
+                    ) for inp in inputs
+                ]
+            return self.iter_generate_with_prefix_cache(
+                prompt_parts, eos_token_id=eos_token_id,
+                constraints=constraints)
+
+        with profiler.span("build_prompts", prompts=len(inputs)):
+            prompts = [
+                self.create_prompt(
+                    subject_entity=inp["SubjectEntity"],
+                    relation=inp["Relation"]
+                ) for inp in inputs
+            ]
+        return self.iter_generate_batched(prompts, eos_token_id=eos_token_id,
+                                          constraints=constraints)
+
+    def generate_predictions(self, inputs):
+        logger.info("Generating and disambiguating predictions...")
+        with profiler.span("generate_predictions", rows=len(inputs)):
+            # Constrained answers carry their IDs; the others are parsed
+            constraints = self.create_constraints(inputs)
+            batches = (
+                (batch, [
+                    constraints[i]
+                    if constraints is not None and constraints[i] is not None
+                    else self.parse_output(text)
+                    for i, text in zip(batch, texts)
+                ])
+                for batch, texts in self.iter_generate_outputs(
+                    inputs,
+                    eos_token_id=self.eos_token_id,
+                    constraints=constraints,
+                )
+            )
+
+            def disambiguate(indices, answers):
+                free = [k for k, answer in enumerate(answers)
+                        if not isinstance(answer, ConstrainedAnswer)]
+                resolved = self.disambiguate_all(
+                    [answers[k] for k in free],
+                    relations=[inputs[indices[k]]["Relation"] for k in free])
+                wikidata_id_lists = [
+                    answer.wikidata_ids()
+                    if isinstance(answer, ConstrainedAnswer) else None
+                    for answer in answers
+                ]
+                for k, wikidata_ids in zip(free, resolved):
+                    wikidata_id_lists[k] = wikidata_ids
+                profiler.count("constrained_answers", len(answers) - len(free))
+                return wikidata_id_lists
+
+            wikidata_id_lists = self.disambiguate_pipelined(inputs, batches,
+                                                            disambiguate)
 
-        logger.info("Disambiguating entities...")
         results = []
-        for inp, output, prompt in tqdm(zip(inputs, outputs, prompts),
-                                        total=len(inputs),
-                                        desc="Disambiguating entities"):
-            # Remove the original prompt from the generated text
-            qa_answer = output[0]["generated_text"].split(prompt)[
-                -1].split("\n")[0].strip()
-            wikidata_ids = self.disambiguate_entities(qa_answer)
+        for inp, wikidata_ids in zip(inputs, wikidata_id_lists):
             results.append({
                 "SubjectEntityID": inp["SubjectEntityID"],
                 "SubjectEntity": inp["SubjectEntity"],
@@ -139,13 +706,34 @@ class GenerationModel(BaselineModel):
 
         return results
 
-    def disambiguate_entities(self, qa_answer: str):
-        wikidata_ids = []
-        qa_entities = qa_answer.split(", ")
-        for entity in qa_entities:
+    def truncate_at_stop(self, text: str) -> str:
+        """Cut a generated text at the first of the configured stop strings."""
+        end = min((index for index in (text.find(stop)
+                                       for stop in self.stop_strings if stop)
+                   if index >= 0), default=len(text))
+        return text[:end]
+
+    def parse_output(self, text: str) -> List[str]:
+        """The candidate entities of a generated text."""
+        # Keep the first line of the generated text, up to any stop string
+        text = self.truncate_at_stop(text)
+        return self.parse_entities(text.split("\n")[0].strip())
+
+    @staticmethod
+    def parse_entities(qa_answer: str):
+        """Split a generated answer into candidate entity strings."""
+        entities = []
+        for entity in qa_answer.split(", "):
             entity = entity.strip()
             if entity.startswith("and "):
                 entity = entity[4:].strip()
+            entities.append(entity)
+
+        return entities
+
+    def disambiguate_entities(self, qa_answer: str):
+        wikidata_ids = []
+        for entity in self.parse_entities(qa_answer):
             wikidata_id = self.disambiguation_baseline(entity)
             if wikidata_id:
                 wikidata_ids.append(wikidata_id)
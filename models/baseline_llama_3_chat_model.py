@@ -1,13 +1,16 @@
 import json
-import random
+from typing import Dict, Iterator, List, Tuple
 
 from loguru import logger
-from tqdm import tqdm
 
 from models.baseline_generation_model import GenerationModel
+from models.profiling import profiler
 
 
 class Llama3ChatModel(GenerationModel):
+    # The answer starts right after the assistant header
+    answer_prefix = ""
+
     def __init__(self, config):
         assert config["llm_path"] in [
             "meta-llama/Meta-Llama-3-8B-Instruct",
@@ -25,10 +28,20 @@ class Llama3ChatModel(GenerationModel):
             "If there are multiple answers, separate them with a comma. "
             "If there are no answers, type \"None\".")
 
+        # Chat answers end with a terminator rather than a newline
+        self.stop_strings = config.get("stop_strings", [])
+
         self.terminators = [
             self.pipe.tokenizer.eos_token_id,
             self.pipe.tokenizer.convert_tokens_to_ids("<|eot_id|>")
         ]
+        # Each sequence of a batch stops at its first terminator
+        self.eos_token_id = self.terminators
+
+        # In-context examples per relation, with the token IDs of their turns
+        self.question_turns = {}
+        self.example_pools = self.index_in_context_examples()
+        self.use_prompt_ids = self.check_prompt_ids()
 
     def instantiate_in_context_examples(self, train_data_file):
         logger.info(f"Reading train data from `{train_data_file}`...")
@@ -62,18 +75,66 @@ class Llama3ChatModel(GenerationModel):
 
         return in_context_examples
 
-    def create_prompt(self, subject_entity: str, relation: str) -> str:
-        template = self.prompt_templates[relation]
-        random_examples = []
-        if self.few_shot > 0:
-            pool = [example["messages"] for example in self.in_context_examples
-                    if example["relation"] == relation]
-            # pool = [example["messages"] for example in self.in_context_examples]
-            random_examples = random.sample(
-                pool,
-                min(self.few_shot, len(pool))
-            )
-
+    def index_in_context_examples(self) -> Dict[str, List[dict]]:
+        """
+        Bucket the in-context examples by relation, and tokenize the chat
+        turns of every example once.
+
+        Every turn of the chat template starts and ends with a special token,
+        so a prompt tokenizes to the concatenation of its system turn (with
+        the tokenizer's special tokens), example turns and question turn,
+        each tokenized on its own.
+        """
+        tokenizer = self.pipe.tokenizer
+        system_messages = [{"role": "system", "content": self.system_message}]
+        self.system_text = tokenizer.apply_chat_template(system_messages,
+                                                         tokenize=False)
+        self.system_ids = tokenizer(self.system_text)["input_ids"]
+
+        pools = {}
+        turns = []
+        for example in self.in_context_examples:
+            pools.setdefault(example["relation"], []).append(example)
+            turns.append(self.strip_system_turn(tokenizer.apply_chat_template(
+                system_messages + example["messages"], tokenize=False)))
+
+        logger.info("Tokenizing in-context examples...")
+        turn_ids = tokenizer([turn or "" for turn in turns],
+                             add_special_tokens=False)["input_ids"]
+        for example, turn, ids in zip(self.in_context_examples, turns,
+                                      turn_ids):
+            example["token_ids"] = ids if turn is not None else None
+
+        return pools
+
+    def strip_system_turn(self, prompt: str):
+        """The turns of a chat prompt after the system turn, if it has one."""
+        if not prompt.startswith(self.system_text):
+            return None
+        return prompt[len(self.system_text):]
+
+    def question_turn(self, subject_entity: str, relation: str) -> str:
+        """The chat turn that asks for the objects of a subject."""
+        if relation not in self.question_turns:
+            # Render the turn once per relation around a placeholder subject
+            placeholder = "\x00"
+            turn = self.strip_system_turn(self.render_prompt(
+                [], self.prompt_templates[relation].format(
+                    subject_entity=placeholder)))
+            self.question_turns[relation] = (
+                turn.split(placeholder)
+                if turn is not None and turn.count(placeholder) == 1
+                else None)
+
+        parts = self.question_turns[relation]
+        if parts is None or subject_entity != subject_entity.strip():
+            # The template may trim the subject at the edges of the turn
+            return self.strip_system_turn(self.render_prompt(
+                [], self.prompt_templates[relation].format(
+                    subject_entity=subject_entity)))
+        return parts[0] + subject_entity + parts[1]
+
+    def render_prompt(self, examples: List[dict], question: str) -> str:
         messages = [
             {
                 "role": "system",
@@ -81,53 +142,109 @@ class Llama3ChatModel(GenerationModel):
             }
         ]
 
-        for example in random_examples:
-            messages.extend(example)
+        for example in examples:
+            messages.extend(example["messages"])
 
         messages.append({
             "role": "user",
-            "content": template.format(subject_entity=subject_entity)
+            "content": question
         })
 
-        prompt = self.pipe.tokenizer.apply_chat_template(
+        return self.pipe.tokenizer.apply_chat_template(
             messages,
             tokenize=False,
             add_generation_prompt=True
         )
 
-        return prompt
-
-    def generate_predictions(self, inputs):
-        logger.info("Generating predictions...")
-        prompts = [
-            self.create_prompt(
-                subject_entity=inp["SubjectEntity"],
-                relation=inp["Relation"]
-            ) for inp in inputs
-        ]
-
-        outputs = []
-        for prompt in tqdm(prompts, desc="Generating predictions"):
-            output = self.pipe(
-                prompt,
-                max_new_tokens=self.max_new_tokens,
-                eos_token_id=self.terminators,
+    def check_prompt_ids(self) -> bool:
+        """
+        Check that prompts assembled from token IDs match the tokenized
+        prompt strings, for a prompt of every relation.
+        """
+        tokenizer = self.pipe.tokenizer
+        for relation, template in self.prompt_templates.items():
+            examples = self.example_pools.get(relation, [])[:self.few_shot]
+            if any(example["token_ids"] is None for example in examples):
+                break
+            question = self.question_turn("Example Subject", relation)
+            if question is None:
+                break
+            prompt_ids = (
+                self.system_ids
+                + [i for example in examples for i in example["token_ids"]]
+                + tokenizer(question, add_special_tokens=False)["input_ids"]
             )
-            outputs.append(output)
-
-        logger.info("Disambiguating entities...")
-        results = []
-        for inp, output, prompt in tqdm(zip(inputs, outputs, prompts),
-                                        total=len(inputs),
-                                        desc="Disambiguating entities"):
-            # Remove the original prompt from the generated text
-            qa_answer = output[0]["generated_text"][len(prompt):].strip()
-            wikidata_ids = self.disambiguate_entities(qa_answer)
-            results.append({
-                "SubjectEntityID": inp["SubjectEntityID"],
-                "SubjectEntity": inp["SubjectEntity"],
-                "Relation": inp["Relation"],
-                "ObjectEntitiesID": wikidata_ids,
-            })
-
-        return results
+            expected_ids = tokenizer(self.render_prompt(
+                examples, template.format(subject_entity="Example Subject")
+            ))["input_ids"]
+            if prompt_ids != expected_ids:
+                break
+        else:
+            return True
+
+        logger.warning("The chat template does not split into separately "
+                       "tokenized turns; prompts are tokenized as strings.")
+        return False
+
+    def create_prompt_parts(self, subject_entity: str, relation: str) -> Tuple[
+        str, str]:
+        template = self.prompt_templates[relation]
+        examples = self.sample_in_context_examples(
+            self.example_pools.get(relation, []), relation)
+
+        # The system message and the examples form the shared prefix
+        prefix = self.pipe.tokenizer.apply_chat_template(
+            [{"role": "system", "content": self.system_message}]
+            + [message for example in examples
+               for message in example["messages"]],
+            tokenize=False,
+        )
+        prompt = self.render_prompt(
+            examples, template.format(subject_entity=subject_entity))
+
+        if not prompt.startswith(prefix):
+            return "", prompt
+        return prefix, prompt[len(prefix):]
+
+    def create_prefix_ids(self, relation: str) -> List[int]:
+        """The token IDs of the system turn and the examples of a prompt."""
+        examples = self.sample_in_context_examples(
+            self.example_pools.get(relation, []), relation)
+        prefix_ids = list(self.system_ids)
+        for example in examples:
+            prefix_ids.extend(example["token_ids"])
+        return prefix_ids
+
+    def iter_generate_outputs(self, inputs, eos_token_id=None,
+                              constraints=None) -> Iterator[
+        Tuple[List[int], List[str]]]:
+        """
+        Like `GenerationModel.iter_generate_outputs`, with the prompts
+        assembled from cached token IDs: only the question turns are
+        tokenized.
+        """
+        if not self.use_prompt_ids:
+            return super().iter_generate_outputs(inputs,
+                                                 eos_token_id=eos_token_id,
+                                                 constraints=constraints)
+
+        with profiler.span("build_prompts", prompts=len(inputs)):
+            prefix_ids = [self.create_prefix_ids(inp["Relation"])
+                          for inp in inputs]
+            suffix_ids = self.pipe.tokenizer(
+                [self.question_turn(inp["SubjectEntity"], inp["Relation"])
+                 for inp in inputs],
+                add_special_tokens=False,
+            )["input_ids"]
+
+        if self.prefix_caching:
+            return self.iter_generate_ids_with_prefix_cache(
+                list(zip(prefix_ids, suffix_ids)), eos_token_id=eos_token_id,
+                constraints=constraints)
+        return self.iter_generate_ids_batched(
+            [prefix + suffix
+             for prefix, suffix in zip(prefix_ids, suffix_ids)],
+            eos_token_id=eos_token_id, constraints=constraints)
+
+    def parse_output(self, text: str) -> List[str]:
+        return self.parse_entities(self.truncate_at_stop(text).strip())
@@ -1,18 +1,54 @@
 import csv
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
 
-import requests
 from loguru import logger
 
 from models.abstract_model import AbstractModel
+from models.disambiguation import WikidataDisambiguator
+from models.disambiguation_cache import DisambiguationCache
+from models.label_index import OfflineDisambiguator
+from models.profiling import profiler
 
 
 class BaselineModel(AbstractModel):
-    def __init__(self):
+    def __init__(self, config=None):
         super().__init__()
 
+        config = config or {}
+
+        # Cache for Wikidata lookups, shared across relations and runs
+        self.disambiguation_cache = DisambiguationCache(
+            file_path=config.get("disambiguation_cache_file"),
+            ttl=config.get("disambiguation_cache_ttl", 30 * 24 * 3600),
+            max_entries=config.get("disambiguation_cache_max_entries",
+                                   1_000_000),
+            lru_size=config.get("disambiguation_cache_lru_size", 65536),
+        )
+        self.disambiguator = WikidataDisambiguator.from_config(
+            config, cache=self.disambiguation_cache)
+
+        # Offline label index, with the Wikidata API as fallback
+        backend = config.get("disambiguation_backend", "wikidata")
+        if backend == "offline":
+            self.disambiguator = OfflineDisambiguator.from_config(
+                config, fallback=self.disambiguator)
+        elif backend != "wikidata":
+            raise ValueError(
+                f"Disambiguation backend `{backend}` not found.")
+
+        # Number of generated batches that may wait for disambiguation while
+        # the next batch is generated (0 disambiguates each batch in turn)
+        self.disambiguation_pipeline_depth = config.get(
+            "disambiguation_pipeline_depth", 2)
+
     def generate_predictions(self, inputs):
         raise NotImplementedError
 
+    def close(self):
+        self.disambiguator.close()
+
     @staticmethod
     def read_prompt_templates_from_csv(file_path) -> dict:
         """Read prompt templates from a CSV file."""
@@ -27,28 +63,85 @@ class BaselineModel(AbstractModel):
             }
         return prompt_templates
 
-    @staticmethod
-    def disambiguation_baseline(item) -> str:
+    def disambiguation_baseline(self, item, relation: Optional[str] = None) -> str:
         """A simple disambiguation function that returns the Wikidata ID of an item."""
-        item = str(item).strip()
-
-        if not item or item == "None":
-            return ""
-
-        try:
-            # If item can be converted to an integer, return it directly
-            return str(int(item))
-        except ValueError:
-            # If not, proceed with the Wikidata search
-            try:
-                url = (f"https://www.wikidata.org/w/api.php"
-                       f"?action=wbsearchentities"
-                       f"&search={item}"
-                       f"&language=en"
-                       f"&format=json")
-                data = requests.get(url).json()
-                # Return the first id (Could upgrade this in the future)
-                return str(data["search"][0]["id"])
-            except Exception as e:
-                logger.error(f"Error getting Wikidata ID for `{item}`: {e}")
-                return item
+        return self.disambiguator.lookup(item, relation=relation)
+
+    def disambiguate_all(self, entity_lists: List[List[str]],
+                         relations: Optional[List[str]] = None) -> List[
+        List[str]]:
+        """
+        Disambiguate the candidate entities of many rows in one go.
+
+        All candidates are collected and de-duplicated first, then resolved
+        concurrently. If the relation of every row is given, candidates are
+        resolved per relation so that relation-aware backends can filter by it.
+        Entities that do not resolve to an ID are dropped.
+        """
+        if relations is None:
+            relations = [None] * len(entity_lists)
+
+        entities_per_relation = {}
+        for entities, relation in zip(entity_lists, relations):
+            entities_per_relation.setdefault(relation, set()).update(entities)
+
+        wikidata_ids = {}
+        for relation, entities in entities_per_relation.items():
+            resolved = self.disambiguator.lookup_many(entities,
+                                                      relation=relation)
+            for entity, wikidata_id in resolved.items():
+                wikidata_ids[(entity, relation)] = wikidata_id
+
+        return [
+            [wikidata_ids[(entity, relation)] for entity in entities
+             if wikidata_ids[(entity, relation)]]
+            for entities, relation in zip(entity_lists, relations)
+        ]
+
+    def disambiguate_pipelined(self, inputs: List[Dict],
+                               batches: Iterable[Tuple[List[int], Any]],
+                               disambiguate: Optional[Callable] = None) -> \
+            List[List[str]]:
+        """
+        Disambiguate generated batches while the next ones are generated.
+
+        `batches` yields (input indices, entity lists) as inference completes
+        them, in any order. Each batch is handed to a background thread, so
+        that inference and disambiguation overlap. At most
+        `disambiguation_pipeline_depth` batches wait for disambiguation;
+        beyond that, generation waits for the oldest one (backpressure).
+
+        `disambiguate(indices, payload)` may replace the default
+        `disambiguate_all` of the entity lists. Returns the Wikidata ID lists
+        of all inputs, in input order.
+        """
+        if disambiguate is None:
+            def disambiguate(indices, entity_lists):
+                return self.disambiguate_all(
+                    entity_lists,
+                    relations=[inputs[i]["Relation"] for i in indices])
+
+        wikidata_id_lists = [None] * len(inputs)
+        pending = deque()
+
+        def timed_disambiguate(indices, payload):
+            with profiler.span("disambiguate", rows=len(indices)):
+                return disambiguate(indices, payload)
+
+        def collect():
+            indices, future = pending.popleft()
+            with profiler.span("wait_for_disambiguation"):
+                wikidata_ids_of_batch = future.result()
+            for i, wikidata_ids in zip(indices, wikidata_ids_of_batch):
+                wikidata_id_lists[i] = wikidata_ids
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            for indices, payload in batches:
+                pending.append((indices, executor.submit(
+                    timed_disambiguate, indices, payload)))
+                while len(pending) > self.disambiguation_pipeline_depth:
+                    collect()
+            while pending:
+                collect()
+
+        return wikidata_id_lists
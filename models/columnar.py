@@ -0,0 +1,139 @@
+from pathlib import Path
+from typing import Dict, Iterator, List, Union
+
+from loguru import logger
+
+# Arrow IPC files are memory-mapped when read; Parquet files are smaller
+COLUMNAR_SUFFIXES = (".arrow", ".feather", ".parquet")
+
+# The columns of a prediction or ground truth file. The dictionary-encoded
+# columns store every distinct string once, and the rows refer to it by index.
+DICTIONARY_COLUMNS = ("SubjectEntity", "Relation")
+LIST_COLUMNS = ("ObjectEntities", "ObjectEntitiesID")
+COLUMNS = ("SubjectEntityID", "SubjectEntity", "Relation", "ObjectEntities",
+           "ObjectEntitiesID")
+
+
+def is_columnar_file(file_path: Union[str, Path]) -> bool:
+    return Path(file_path).suffix in COLUMNAR_SUFFIXES
+
+
+def read_columnar_file(file_path: Union[str, Path]):
+    """
+    Read a columnar file as an Arrow table. Arrow IPC files are memory-mapped,
+    so the columns are not copied into memory until they are used.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    if Path(file_path).suffix == ".parquet":
+        return pq.read_table(file_path, memory_map=True)
+    return pa.ipc.open_file(pa.memory_map(str(file_path))).read_all()
+
+
+def iter_columnar_rows(file_path: Union[str, Path]) -> Iterator[Dict]:
+    """Read the rows of a columnar file as dicts, batch by batch."""
+    for batch in read_columnar_file(file_path).to_batches():
+        yield from batch.to_pylist()
+
+
+class ColumnarWriter:
+    """
+    Writes prediction or ground truth rows to an Arrow IPC or Parquet file.
+
+    Rows are buffered and written in record batches of `batch_size` rows. The
+    subject, relation and object columns are dictionary-encoded with one
+    dictionary per column that grows from batch to batch, so that an IPC
+    file only stores the new strings of each batch (as dictionary deltas).
+    The columns are those of `COLUMNS` present in the first row; other
+    fields are not stored.
+    """
+
+    def __init__(self, output_file: Union[str, Path],
+                 batch_size: int = 65536):
+        self.output_file = Path(output_file)
+        self.batch_size = batch_size
+        self.num_rows = 0
+
+        self._rows = []
+        self._columns = None
+        self._dictionaries = {}
+        self._writer = None
+        self._sink = None
+
+    def write(self, row: Dict):
+        if self._columns is None:
+            self._columns = [column for column in COLUMNS if column in row]
+            dropped = sorted(set(row) - set(COLUMNS))
+            if dropped:
+                logger.warning(f"Not storing the fields {dropped} in "
+                               f"`{self.output_file}`.")
+        self._rows.append(row)
+        self.num_rows += 1
+        if len(self._rows) >= self.batch_size:
+            self.flush()
+
+    def _encode(self, column: str, values: List[str]):
+        import pyarrow as pa
+
+        codes = self._dictionaries.setdefault(column, {})
+        indices = [None if value is None
+                   else codes.setdefault(value, len(codes))
+                   for value in values]
+        return pa.DictionaryArray.from_arrays(
+            pa.array(indices, type=pa.int32()),
+            pa.array(list(codes), type=pa.string()))
+
+    def _batch(self):
+        import pyarrow as pa
+
+        arrays = []
+        for column in self._columns:
+            values = [row.get(column) for row in self._rows]
+            if column in DICTIONARY_COLUMNS:
+                arrays.append(self._encode(column, values))
+            elif column in LIST_COLUMNS:
+                offsets = [0]
+                for objects in values:
+                    offsets.append(offsets[-1] + len(objects or ()))
+                items = self._encode(column, [
+                    item for objects in values for item in objects or ()])
+                arrays.append(pa.ListArray.from_arrays(
+                    pa.array(offsets, type=pa.int32()), items,
+                    mask=pa.array([objects is None for objects in values],
+                                  type=pa.bool_())))
+            else:
+                arrays.append(pa.array(values, type=pa.string()))
+        return pa.RecordBatch.from_arrays(arrays, names=self._columns)
+
+    def flush(self):
+        if self._rows:
+            self._write_batch()
+
+    def _write_batch(self):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        batch = self._batch()
+        self._rows = []
+        if self._writer is None:
+            if self.output_file.suffix == ".parquet":
+                self._writer = pq.ParquetWriter(self.output_file,
+                                                batch.schema)
+            else:
+                self._sink = pa.OSFile(str(self.output_file), "wb")
+                self._writer = pa.ipc.new_file(
+                    self._sink, batch.schema,
+                    options=pa.ipc.IpcWriteOptions(
+                        emit_dictionary_deltas=True))
+        self._writer.write_batch(batch)
+
+    def close(self):
+        if self._columns is None:
+            # Nothing was written: store an empty table of all columns
+            self._columns = list(COLUMNS)
+        if self._rows or self._writer is None:
+            self._write_batch()
+        self._writer.close()
+        if self._sink is not None:
+            self._sink.close()
@@ -0,0 +1,184 @@
+from collections import Counter, defaultdict
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional, Union
+
+import torch
+
+from models.label_index import read_label_pairs
+
+
+class TrieNode:
+    __slots__ = ("children", "wikidata_id", "allowed")
+
+    def __init__(self):
+        self.children = {}
+        # Wikidata ID of the label that ends here ("" for no object)
+        self.wikidata_id = None
+        # Allowed next token IDs, computed on first use
+        self.allowed = None
+
+
+class LabelTrie:
+    """A prefix trie over the token IDs of labels, mapping each to its ID."""
+
+    def __init__(self):
+        self.root = TrieNode()
+        self.num_labels = 0
+
+    def add(self, token_ids: List[int], wikidata_id: str):
+        if not token_ids:
+            return
+        node = self.root
+        for token_id in token_ids:
+            node = node.children.setdefault(token_id, TrieNode())
+        if node.wikidata_id is None:
+            self.num_labels += 1
+            node.wikidata_id = wikidata_id
+
+
+def read_relation_labels(sources: Iterable[Union[str, Path]],
+                         relations: Iterable[str]) -> Dict[
+    str, Dict[str, str]]:
+    """
+    Read the candidate object labels of every relation, with their most
+    frequent Wikidata ID. Labels of a source without relations are
+    candidates of every relation.
+    """
+    relations = set(relations)
+    counts = defaultdict(lambda: defaultdict(Counter))
+    for source in sources:
+        for label, wikidata_id, relation in read_label_pairs(source):
+            label = label.strip()
+            if not label or not wikidata_id:
+                continue
+            for r in ([relation] if relation else relations):
+                if r in relations:
+                    counts[r][label][wikidata_id] += 1
+
+    return {
+        relation: {label: ids.most_common(1)[0][0]
+                   for label, ids in counts[relation].items()}
+        for relation in relations
+    }
+
+
+class AnswerTries:
+    """
+    The tries of the answers of a relation: a list of labels separated by
+    ", ", or "None".
+
+    The first label is tokenized after the answer prefix (e.g. the space
+    after the question), every further label together with its separator.
+    """
+
+    def __init__(self, labels: Dict[str, str],
+                 tokenize: Callable[[List[str]], List[List[int]]],
+                 answer_prefix: str = " ", separator: str = ", ",
+                 no_answer: str = "None"):
+        self.first = LabelTrie()
+        self.next = LabelTrie()
+
+        labels = list(labels.items())
+        first_ids = tokenize([answer_prefix + label for label, _ in labels]
+                             + [answer_prefix + no_answer])
+        next_ids = tokenize([separator + label for label, _ in labels])
+        for (_, wikidata_id), token_ids in zip(labels, first_ids):
+            self.first.add(token_ids, wikidata_id)
+        self.first.add(first_ids[-1], "")
+        for (_, wikidata_id), token_ids in zip(labels, next_ids):
+            self.next.add(token_ids, wikidata_id)
+
+
+class ConstrainedAnswer:
+    """
+    The decoding state of one answer restricted to an AnswerTries.
+
+    The state walks the tries token by token. Once a label is complete, the
+    answer may go on with a longer label, a further label after the
+    separator, or end, so the state follows every trie position that the
+    tokens so far can lead to (e.g. "Paris" and "Paris, Texas"). The Wikidata
+    IDs of the labels are recorded, so the answer never needs to be
+    disambiguated. The no-answer "None" may only be followed by an end token.
+
+    When the tokens read as different lists of labels (e.g. "Paris, Texas"
+    and "Paris" + "Texas"), the longest label wins: the branches that go on
+    with a label are kept before those that start a new one, and the first
+    branch that ends on a complete label gives the IDs.
+    """
+
+    def __init__(self, tries: AnswerTries):
+        self.tries = tries
+        # (trie node, IDs of the labels completed before it) per branch
+        self.branches = [(tries.first.root, ())]
+        self.ids = None
+
+    @staticmethod
+    def is_no_answer(node: TrieNode) -> bool:
+        return node.wikidata_id == ""
+
+    def node_allowed(self, node: TrieNode, device) -> torch.Tensor:
+        if node.allowed is None or node.allowed.device != device:
+            token_ids = []
+            if not self.is_no_answer(node):
+                token_ids.extend(node.children)
+                if node.wikidata_id is not None:
+                    token_ids.extend(self.tries.next.root.children)
+            node.allowed = torch.tensor(sorted(set(token_ids)),
+                                        dtype=torch.long, device=device)
+        return node.allowed
+
+    def allowed_token_ids(self, device) -> Optional[torch.Tensor]:
+        """The tokens that may follow, or None once the answer has ended."""
+        if not self.branches:
+            return None
+        if len(self.branches) == 1:
+            return self.node_allowed(self.branches[0][0], device)
+        return torch.unique(torch.cat([self.node_allowed(node, device)
+                                       for node, _ in self.branches]))
+
+    def can_end(self) -> bool:
+        return any(node.wikidata_id is not None for node, _ in self.branches)
+
+    def advance(self, token_id: int):
+        if not self.branches:
+            # Ended; the rest of the sequence is not part of the answer
+            return
+        branches = []
+        ended_ids = None
+        for node, ids in self.branches:
+            if self.is_no_answer(node):
+                # "None" only ends
+                if ended_ids is None:
+                    ended_ids = ids
+                continue
+            child = node.children.get(token_id)
+            if child is not None:
+                branches.append((child, ids))
+            if node.wikidata_id is None:
+                continue
+            # The separator of a further label, or the end of the answer
+            following = self.tries.next.root.children.get(token_id)
+            if following is not None:
+                branches.append((following, ids + (node.wikidata_id,)))
+            elif child is None and ended_ids is None:
+                ended_ids = ids + (node.wikidata_id,)
+        self.branches = branches
+        if not branches:
+            self.ids = ended_ids if ended_ids is not None else ()
+
+    def wikidata_ids(self) -> List[str]:
+        """
+        The IDs of the complete labels, also when cut off by the length, with
+        the longest labels of an ambiguous answer.
+        """
+        ids = self.ids
+        if ids is None:
+            # Cut off: prefer a branch that ends on a complete label
+            node, ids = next(
+                ((node, ids) for node, ids in self.branches
+                 if node.wikidata_id is not None),
+                self.branches[0])
+            if node.wikidata_id is not None:
+                ids = ids + (node.wikidata_id,)
+        return [wikidata_id for wikidata_id in dict.fromkeys(ids)
+                if wikidata_id]
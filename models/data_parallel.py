@@ -0,0 +1,177 @@
+import multiprocessing
+import os
+import queue
+import traceback
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Union
+
+from loguru import logger
+
+
+def split_cores(num_workers: int) -> List[Optional[List[int]]]:
+    """Split the CPU cores available to this process into contiguous sets."""
+    if not hasattr(os, "sched_getaffinity"):
+        return [None] * num_workers
+    cores = sorted(os.sched_getaffinity(0))
+    if len(cores) < num_workers:
+        return [None] * num_workers
+    return [cores[len(cores) * i // num_workers:
+                  len(cores) * (i + 1) // num_workers]
+            for i in range(num_workers)]
+
+
+def _disambiguation_stats(model) -> dict:
+    disambiguator = getattr(model, "disambiguator", None)
+    return disambiguator.stats() if disambiguator is not None else {}
+
+
+def worker_raw_outputs_file(raw_outputs_file: str,
+                            worker_id: Union[int, str]) -> str:
+    """The file of a worker's part of the raw outputs."""
+    path = Path(raw_outputs_file)
+    return str(path.with_name(f"{path.stem}.worker{worker_id}{path.suffix}"))
+
+
+def _worker(worker_id: int, config: dict, device: Optional[str],
+            cores: Optional[List[int]], tasks, results):
+    """
+    Load a model, then generate predictions for shards until told to stop.
+    Every result carries the worker's disambiguation statistics so far.
+    """
+    try:
+        if cores:
+            os.sched_setaffinity(0, cores)
+            import torch
+            torch.set_num_threads(len(cores))
+        if device:
+            config = {**config, "device": device}
+        if config.get("raw_outputs_file"):
+            # Every worker saves its own part of the raw outputs
+            config = {**config, "raw_outputs_file": worker_raw_outputs_file(
+                config["raw_outputs_file"], worker_id)}
+
+        from models.user_config import Models
+        model = Models.get_model(config["model"])(config)
+    except Exception:
+        results.put((None, None, traceback.format_exc(), worker_id, {}))
+        return
+
+    try:
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            shard_id, rows = task
+            try:
+                predictions = list(model.generate_predictions(rows))
+                results.put((shard_id, predictions, None, worker_id,
+                             _disambiguation_stats(model)))
+            except Exception:
+                results.put((shard_id, None, traceback.format_exc(),
+                             worker_id, _disambiguation_stats(model)))
+    finally:
+        model.close()
+
+
+class WorkerStats:
+    """The disambiguation statistics of the workers, summed up."""
+
+    def __init__(self):
+        self.per_worker = {}
+
+    def stats(self) -> dict:
+        totals = {}
+        for stats in self.per_worker.values():
+            for key, value in stats.items():
+                if key != "hit_rate":
+                    totals[key] = totals.get(key, 0) + value
+        if "hits" in totals and "misses" in totals:
+            lookups = totals["hits"] + totals["misses"]
+            totals["hit_rate"] = (totals["hits"] / lookups if lookups > 0
+                                  else 0.0)
+        return totals
+
+
+class DataParallelModel:
+    """
+    Runs one model instance per worker process and spreads the input over
+    them.
+
+    Every worker is pinned to a device (e.g. one GPU each) and/or a disjoint
+    set of CPU cores, with as many PyTorch threads as cores. Inputs are split
+    into shards that the workers pull from a shared queue, and the results are
+    yielded back in input order. `disambiguator.stats()` sums up the
+    disambiguation statistics that the workers reported with their results.
+    """
+
+    def __init__(self, config: dict, num_workers: int,
+                 devices: Optional[List[str]] = None,
+                 shard_size: int = 64, pin_cores: bool = True):
+        self.num_workers = num_workers
+        self.shard_size = shard_size
+        self.disambiguator = WorkerStats()
+
+        context = multiprocessing.get_context("spawn")
+        self._tasks = context.Queue()
+        self._results = context.Queue()
+        # Do not block on exit for shards that no worker will pick up
+        self._tasks.cancel_join_thread()
+
+        if config.get("raw_outputs_file"):
+            parts = worker_raw_outputs_file(config["raw_outputs_file"], "*")
+            logger.info(f"The workers save their raw outputs to `{parts}`.")
+        cores = split_cores(num_workers) if pin_cores else [None] * num_workers
+        self._workers = []
+        for i in range(num_workers):
+            device = devices[i % len(devices)] if devices else None
+            logger.info(f"Starting worker {i} (device: {device or 'default'}, "
+                        f"cores: {cores[i] or 'all'})...")
+            worker = context.Process(
+                target=_worker,
+                args=(i, config, device, cores[i], self._tasks,
+                      self._results),
+                daemon=True,
+            )
+            worker.start()
+            self._workers.append(worker)
+
+    def generate_predictions(self, inputs: List[Dict]) -> Iterator[Dict]:
+        shards = [inputs[start:start + self.shard_size]
+                  for start in range(0, len(inputs), self.shard_size)]
+        for shard_id, shard in enumerate(shards):
+            self._tasks.put((shard_id, shard))
+
+        # Yield the shards in order, holding back those that finish early
+        done = {}
+        for shard_id in range(len(shards)):
+            while shard_id not in done:
+                finished_id, results, error = self._get_result()
+                if error is not None:
+                    self.terminate()
+                    raise RuntimeError(f"A worker failed:\n{error}")
+                done[finished_id] = results
+            yield from done.pop(shard_id)
+
+    def _get_result(self):
+        while True:
+            try:
+                shard_id, results, error, worker_id, stats = \
+                    self._results.get(timeout=1.0)
+                self.disambiguator.per_worker[worker_id] = stats
+                return shard_id, results, error
+            except queue.Empty:
+                if not all(worker.is_alive() for worker in self._workers):
+                    self.terminate()
+                    raise RuntimeError("A worker exited unexpectedly.")
+
+    def close(self):
+        for _ in self._workers:
+            self._tasks.put(None)
+        for worker in self._workers:
+            worker.join()
+
+    def terminate(self):
+        for worker in self._workers:
+            worker.terminate()
+        for worker in self._workers:
+            worker.join()
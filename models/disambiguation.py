@@ -0,0 +1,245 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Optional
+
+import requests
+from loguru import logger
+from requests.adapters import HTTPAdapter
+from tqdm import tqdm
+
+from models.disambiguation_cache import DisambiguationCache
+from models.profiling import profiler
+
+WIKIDATA_API_URL = "https://www.wikidata.org/w/api.php"
+
+
+class RateLimiter:
+    """Spaces out requests shared by several threads and honors server back-off."""
+
+    def __init__(self, max_requests_per_second: Optional[float] = None):
+        self.interval = (1.0 / max_requests_per_second
+                         if max_requests_per_second else 0.0)
+        self._next_time = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next_time)
+            self._next_time = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+    def pause(self, seconds: float):
+        """Hold back every thread for `seconds`, e.g. after a 429 response."""
+        with self._lock:
+            self._next_time = max(self._next_time,
+                                  time.monotonic() + seconds)
+
+
+class WikidataDisambiguator:
+    """
+    Resolves surface strings to Wikidata IDs with the `wbsearchentities` API.
+
+    Lookups go through a DisambiguationCache first. Remaining strings are
+    de-duplicated and resolved concurrently over a pooled keep-alive session,
+    with retries, exponential backoff and rate-limit handling.
+    """
+
+    def __init__(self,
+                 cache: Optional[DisambiguationCache] = None,
+                 api_url: str = WIKIDATA_API_URL,
+                 language: str = "en",
+                 max_workers: int = 8,
+                 max_retries: int = 3,
+                 backoff_factor: float = 0.5,
+                 timeout: float = 10.0,
+                 max_requests_per_second: Optional[float] = None):
+        self.cache = cache if cache is not None else DisambiguationCache()
+        self.api_url = api_url
+        self.language = language
+        self.max_workers = max(1, max_workers)
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.timeout = timeout
+        self.rate_limiter = RateLimiter(max_requests_per_second)
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1,
+                              pool_maxsize=self.max_workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self.http_calls = 0
+        self.http_errors = 0
+        self._counter_lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config: dict,
+                    cache: Optional[DisambiguationCache] = None):
+        return cls(
+            cache=cache,
+            api_url=config.get("wikidata_api_url", WIKIDATA_API_URL),
+            language=config.get("wikidata_language", "en"),
+            max_workers=config.get("disambiguation_max_workers", 8),
+            max_retries=config.get("disambiguation_max_retries", 3),
+            backoff_factor=config.get("disambiguation_backoff_factor", 0.5),
+            timeout=config.get("disambiguation_timeout", 10.0),
+            max_requests_per_second=config.get(
+                "disambiguation_max_requests_per_second"),
+        )
+
+    @staticmethod
+    def resolve_locally(item: str) -> Optional[str]:
+        """Resolve empty, "None" and numeric items without a lookup."""
+        if not item or item == "None":
+            return ""
+        try:
+            # If item can be converted to an integer, return it directly
+            return str(int(item))
+        except ValueError:
+            return None
+
+    def lookup(self, item, relation: Optional[str] = None) -> str:
+        """Return the Wikidata ID of a single item (the relation is unused)."""
+        item = str(item).strip()
+
+        wikidata_id = self.resolve_locally(item)
+        if wikidata_id is not None:
+            return wikidata_id
+
+        wikidata_id = self.cache.get(item, self.language)
+        if wikidata_id is not None:
+            return wikidata_id or item
+
+        return self._lookup_remote(item)
+
+    def lookup_many(self, items: Iterable[str],
+                    relation: Optional[str] = None,
+                    desc: str = "Disambiguating entities") -> Dict[str, str]:
+        """
+        Resolve many items at once.
+
+        Returns a dictionary mapping every given item to its Wikidata ID, with
+        the same semantics as `lookup`. Each distinct label is resolved once;
+        uncached labels are queried concurrently.
+        """
+        results = {}
+        pending = {}
+        num_cached = 0
+        for item in items:
+            if item in results:
+                continue
+            stripped = str(item).strip()
+            wikidata_id = self.resolve_locally(stripped)
+            if wikidata_id is None:
+                wikidata_id = self.cache.get(stripped, self.language)
+                if wikidata_id is None:
+                    pending.setdefault(stripped, []).append(item)
+                    results[item] = None
+                    continue
+                wikidata_id = wikidata_id or stripped
+                num_cached += 1
+            results[item] = wikidata_id
+
+        profiler.count("disambiguation_cache_hits", num_cached)
+        if pending:
+            profiler.count("disambiguation_remote_lookups", len(pending))
+            queries = list(pending)
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                resolved = list(tqdm(
+                    executor.map(self._lookup_remote, queries),
+                    total=len(queries),
+                    desc=desc,
+                ))
+            for query, wikidata_id in zip(queries, resolved):
+                # Failed searches fall back to the surface string, the query
+                for item in pending[query]:
+                    results[item] = wikidata_id
+
+        return results
+
+    def stats(self) -> dict:
+        return {
+            **self.cache.stats(),
+            "http_calls": self.http_calls,
+            "http_errors": self.http_errors,
+        }
+
+    def close(self):
+        self.session.close()
+        self.cache.close()
+
+    def _lookup_remote(self, item: str) -> str:
+        try:
+            search_results = self._search(item)
+        except Exception as e:
+            with self._counter_lock:
+                self.http_errors += 1
+            logger.error(f"Error getting Wikidata ID for `{item}`: {e}")
+            return item
+
+        if not search_results:
+            logger.error(f"Error getting Wikidata ID for `{item}`: "
+                         f"no search results")
+            # Remember that the search came back empty
+            self.cache.put(item, "", self.language)
+            return item
+
+        # Return the first id (Could upgrade this in the future)
+        wikidata_id = str(search_results[0]["id"])
+        self.cache.put(item, wikidata_id, self.language)
+        return wikidata_id
+
+    def _search(self, item: str) -> list:
+        params = {
+            "action": "wbsearchentities",
+            "search": item,
+            "language": self.language,
+            "format": "json",
+        }
+
+        for attempt in range(self.max_retries + 1):
+            self.rate_limiter.wait()
+            with self._counter_lock:
+                self.http_calls += 1
+            profiler.count("http_calls")
+
+            last_attempt = attempt == self.max_retries
+            try:
+                with profiler.span("wikidata_request",
+                                   attempt=attempt) as span:
+                    response = self.session.get(self.api_url, params=params,
+                                                timeout=self.timeout)
+                    span.set(status=response.status_code)
+            except requests.RequestException:
+                profiler.count("http_failed_requests")
+                if last_attempt:
+                    raise
+                time.sleep(self.backoff_factor * 2 ** attempt)
+                continue
+
+            if response.status_code == 429 or response.status_code >= 500:
+                profiler.count("http_failed_requests")
+                if last_attempt:
+                    response.raise_for_status()
+                delay = self._retry_after(response)
+                if delay is None:
+                    delay = self.backoff_factor * 2 ** attempt
+                if response.status_code == 429:
+                    # Hold back all workers, not only this one
+                    self.rate_limiter.pause(delay)
+                else:
+                    time.sleep(delay)
+                continue
+
+            response.raise_for_status()
+            return response.json()["search"]
+
+    @staticmethod
+    def _retry_after(response) -> Optional[float]:
+        try:
+            return max(float(response.headers["Retry-After"]), 0.0)
+        except (KeyError, ValueError):
+            return None
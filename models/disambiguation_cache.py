@@ -0,0 +1,197 @@
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional, Tuple, Union
+
+from loguru import logger
+
+# Seconds to wait for a lock on the SQLite file, which the worker processes
+# of a data-parallel run share
+BUSY_TIMEOUT = 60.0
+
+# Version 1 keys the entries by the searched label instead of its normalized
+# form; the entries of older files are dropped
+SCHEMA_VERSION = 1
+
+
+def normalize_label(label: str) -> str:
+    """Normalize a surface string so that trivial variants share one key."""
+    label = unicodedata.normalize("NFKC", str(label))
+    return " ".join(label.split()).casefold()
+
+
+class DisambiguationCache:
+    """
+    Two-level cache for Wikidata lookups: an in-process LRU in front of a
+    persistent SQLite file. Entries are keyed by (language, label), with the
+    label exactly as it was searched, and store the resolved Wikidata ID (""
+    when the search returned nothing).
+    """
+
+    def __init__(self,
+                 file_path: Union[str, Path, None] = None,
+                 ttl: Optional[float] = 30 * 24 * 3600,
+                 max_entries: Optional[int] = 1_000_000,
+                 lru_size: int = 65536):
+        self.file_path = file_path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lru_size = lru_size
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evicted = 0
+
+        self._lru = OrderedDict()
+        self._lock = threading.Lock()
+        self._puts_since_eviction = 0
+
+        self._db = None
+        if file_path:
+            Path(file_path).parent.mkdir(parents=True, exist_ok=True)
+            logger.info(f"Opening the disambiguation cache `{file_path}`...")
+            self._db = sqlite3.connect(
+                str(file_path),
+                check_same_thread=False,
+                isolation_level=None,
+                timeout=BUSY_TIMEOUT,
+            )
+            # Readers do not block the writer of another process
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute("BEGIN IMMEDIATE")
+            version = self._db.execute("PRAGMA user_version").fetchone()[0]
+            if version < SCHEMA_VERSION:
+                self._db.execute("DROP TABLE IF EXISTS lookups")
+                self._db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS lookups ("
+                "language TEXT NOT NULL, "
+                "label TEXT NOT NULL, "
+                "qid TEXT NOT NULL, "
+                "created REAL NOT NULL, "
+                "accessed REAL NOT NULL, "
+                "PRIMARY KEY (language, label))"
+            )
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS lookups_accessed "
+                "ON lookups (accessed)"
+            )
+            self._db.execute("COMMIT")
+
+    @staticmethod
+    def make_key(label: str, language: str = "en") -> Tuple[str, str]:
+        # Not normalized: the search results of variants of a label may differ
+        return language, str(label)
+
+    def get(self, label: str, language: str = "en") -> Optional[str]:
+        """Return the cached Wikidata ID, or None on a cache miss."""
+        key = self.make_key(label, language)
+        now = time.time()
+
+        with self._lock:
+            entry = self._lru.get(key)
+            if entry is not None:
+                qid, created = entry
+                if not self._is_expired(created, now):
+                    self._lru.move_to_end(key)
+                    self.hits += 1
+                    return qid
+                del self._lru[key]
+
+            if self._db is not None:
+                row = self._db.execute(
+                    "SELECT qid, created FROM lookups "
+                    "WHERE language = ? AND label = ?",
+                    key
+                ).fetchone()
+                if row is not None:
+                    qid, created = row
+                    if not self._is_expired(created, now):
+                        self._db.execute(
+                            "UPDATE lookups SET accessed = ? "
+                            "WHERE language = ? AND label = ?",
+                            (now, *key)
+                        )
+                        self._remember(key, qid, created)
+                        self.hits += 1
+                        self.disk_hits += 1
+                        return qid
+                    self._db.execute(
+                        "DELETE FROM lookups WHERE language = ? AND label = ?",
+                        key
+                    )
+                    self.expired += 1
+
+            self.misses += 1
+            return None
+
+    def put(self, label: str, qid: str, language: str = "en"):
+        key = self.make_key(label, language)
+        now = time.time()
+
+        with self._lock:
+            self._remember(key, qid, now)
+            if self._db is None:
+                return
+            self._db.execute(
+                "INSERT OR REPLACE INTO lookups "
+                "(language, label, qid, created, accessed) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (*key, qid, now, now)
+            )
+            self._puts_since_eviction += 1
+            if self._puts_since_eviction >= 1024:
+                self._evict()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "expired": self.expired,
+            "evicted": self.evicted,
+            "hit_rate": self.hits / lookups if lookups > 0 else 0.0,
+        }
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._evict()
+                self._db.close()
+                self._db = None
+
+    def _is_expired(self, created: float, now: float) -> bool:
+        return self.ttl is not None and now - created > self.ttl
+
+    def _remember(self, key, qid, created):
+        self._lru[key] = (qid, created)
+        self._lru.move_to_end(key)
+        while len(self._lru) > self.lru_size:
+            self._lru.popitem(last=False)
+
+    def _evict(self):
+        """Drop expired entries, then the least recently used ones above the size bound."""
+        self._puts_since_eviction = 0
+        if self.ttl is not None:
+            cursor = self._db.execute(
+                "DELETE FROM lookups WHERE created < ?",
+                (time.time() - self.ttl,)
+            )
+            self.expired += max(cursor.rowcount, 0)
+        if self.max_entries is not None:
+            count = self._db.execute(
+                "SELECT COUNT(*) FROM lookups").fetchone()[0]
+            if count > self.max_entries:
+                cursor = self._db.execute(
+                    "DELETE FROM lookups WHERE rowid IN ("
+                    "SELECT rowid FROM lookups ORDER BY accessed LIMIT ?)",
+                    (count - self.max_entries,)
+                )
+                self.evicted += max(cursor.rowcount, 0)
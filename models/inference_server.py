@@ -0,0 +1,312 @@
+import http.client
+import ipaddress
+import json
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterable, Iterator, List, Optional
+from urllib.parse import urlsplit
+
+from loguru import logger
+
+from models.profiling import profiler
+
+# The fields of an input row that the models use
+ROW_KEYS = ("SubjectEntityID", "SubjectEntity", "Relation")
+
+
+class MicroBatcher:
+    """
+    Coalesces the rows of concurrent requests into batches for one model.
+
+    A single thread owns the model. It takes the first waiting row, then
+    keeps collecting rows until the batch holds `max_batch_size` rows or
+    `max_wait` seconds have passed since the first one, and predicts the
+    whole batch at once. Each row gets its own future, so a request may be
+    split over several batches and a batch may serve several requests.
+    """
+
+    def __init__(self, predict: Callable[[List[Dict]], Iterable[Dict]],
+                 max_batch_size: int = 64, max_wait: float = 0.01):
+        self.predict = predict
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait
+
+        self.num_requests = 0
+        self.num_rows = 0
+        self.num_batches = 0
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run,
+                                        name="micro-batcher", daemon=True)
+        self._thread.start()
+
+    def submit(self, rows: List[Dict]) -> List[Future]:
+        futures = []
+        for row in rows:
+            future = Future()
+            self._queue.put((row, future))
+            futures.append(future)
+        with self._lock:
+            self.num_requests += 1
+        return futures
+
+    def generate_predictions(self, rows: List[Dict]) -> List[Dict]:
+        """Predict the rows along with those of any concurrent request."""
+        return [future.result() for future in self.submit(rows)]
+
+    def _next_batch(self) -> Optional[List]:
+        item = self._queue.get()
+        if item is None:
+            return None
+        batch = [item]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            try:
+                item = self._queue.get(
+                    timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+            if item is None:
+                # Finish this batch, then stop
+                self._queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _predict_batch(self, batch: List):
+        rows = [row for row, _ in batch]
+        try:
+            with profiler.span("micro_batch", rows=len(rows)):
+                results = list(self.predict(rows))
+            if len(results) != len(rows):
+                raise RuntimeError(f"Expected {len(rows)} results, got "
+                                   f"{len(results)}.")
+        except Exception as e:
+            if len(batch) == 1:
+                batch[0][1].set_exception(e)
+                return
+            # Predict the rows one by one, so that only the failing rows
+            # fail their requests
+            for item in batch:
+                self._predict_batch([item])
+            return
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)
+        with self._lock:
+            self.num_rows += len(rows)
+            self.num_batches += 1
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                break
+            self._predict_batch(batch)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "requests": self.num_requests,
+                "rows": self.num_rows,
+                "batches": self.num_batches,
+            }
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        if self.path != "/health":
+            self._send_json(404, {"error": f"Unknown path `{self.path}`."})
+            return
+        self._send_json(200, {
+            "model": self.server.model_name,
+            "stats": self.server.batcher.stats(),
+        })
+
+    def do_POST(self):
+        if self.path != "/predict":
+            self._send_json(404, {"error": f"Unknown path `{self.path}`."})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            rows = json.loads(self.rfile.read(length))["rows"]
+            # Reject bad rows here, as they would fail a whole shared batch
+            rows = [{key: row[key] for key in ROW_KEYS} for row in rows]
+        except (ValueError, KeyError, TypeError) as e:
+            self._send_json(400, {"error": f"Invalid request: {e!r}"})
+            return
+        try:
+            results = self.server.batcher.generate_predictions(rows)
+        except Exception as e:
+            logger.exception("Prediction failed.")
+            self._send_json(500, {"error": f"{type(e).__name__}: {e}"})
+            return
+        self._send_json(200, {"results": results})
+
+    def _send_json(self, status: int, body: dict):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if self.client_address else "local"
+
+    def log_message(self, format, *args):
+        logger.debug(f"{self.address_string()} {format % args}")
+
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn,
+                      socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class InferenceServer:
+    """
+    Serves the predictions of a loaded model over local HTTP.
+
+    The server listens on a loopback address or a Unix socket, so that only
+    local jobs can reach it. `POST /predict` takes `{"rows": [...]}` with the
+    SubjectEntityID, SubjectEntity and Relation of each row and returns
+    `{"results": [...]}` in the same order. `GET /health` returns the model
+    name and the micro-batching statistics.
+    """
+
+    def __init__(self, model, model_name: str = "",
+                 host: str = "127.0.0.1", port: int = 8765,
+                 unix_socket: Optional[str] = None,
+                 max_batch_size: int = 64, max_wait: float = 0.01):
+        self.model = model
+        self.batcher = MicroBatcher(model.generate_predictions,
+                                    max_batch_size=max_batch_size,
+                                    max_wait=max_wait)
+
+        if unix_socket:
+            if os.path.exists(unix_socket):
+                os.unlink(unix_socket)
+            self.httpd = _UnixHTTPServer(unix_socket, _RequestHandler)
+            os.chmod(unix_socket, 0o600)
+            self.address = f"unix:{unix_socket}"
+        else:
+            if not ipaddress.ip_address(
+                    socket.gethostbyname(host)).is_loopback:
+                raise ValueError(f"Host `{host}` is not a loopback address; "
+                                 f"the server has no authentication.")
+            self.httpd = ThreadingHTTPServer((host, port), _RequestHandler)
+            self.httpd.daemon_threads = True
+            host, port = self.httpd.server_address[:2]
+            self.address = f"http://{host}:{port}"
+        self.unix_socket = unix_socket
+        self.httpd.batcher = self.batcher
+        self.httpd.model_name = model_name
+
+    def serve_forever(self):
+        logger.info(f"Serving predictions at `{self.address}`...")
+        self.httpd.serve_forever()
+
+    def shutdown(self):
+        """Stop serving; call from another thread than `serve_forever`."""
+        self.httpd.shutdown()
+
+    def close(self):
+        self.httpd.server_close()
+        self.batcher.close()
+        if self.unix_socket and os.path.exists(self.unix_socket):
+            os.unlink(self.unix_socket)
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path: str, timeout: Optional[float] = None):
+        super().__init__("localhost", timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+class InferenceClient:
+    """
+    Stands in for a model by sending the rows to an InferenceServer.
+
+    `address` is `http://127.0.0.1:<port>` or `unix:<path>`. The rows are
+    sent in requests of `request_size` rows over one keep-alive connection.
+    """
+
+    def __init__(self, address: str, request_size: int = 256,
+                 timeout: Optional[float] = None):
+        self.address = address
+        self.request_size = max(1, request_size)
+        self.timeout = timeout
+        self._connection = None
+
+        self.model_name = self._request("GET", "/health")["model"]
+        logger.info(f"Connected to the inference server at `{address}` "
+                    f"(model: `{self.model_name}`).")
+
+    def _connect(self) -> http.client.HTTPConnection:
+        if self.address.startswith("unix:"):
+            return _UnixHTTPConnection(
+                urlsplit(self.address).path, timeout=self.timeout)
+        url = urlsplit(self.address)
+        if url.scheme != "http":
+            raise ValueError(f"Unsupported server address `{self.address}`.")
+        return http.client.HTTPConnection(url.hostname, url.port,
+                                          timeout=self.timeout)
+
+    def _request(self, method: str, path: str,
+                 body: Optional[dict] = None) -> dict:
+        data = json.dumps(body).encode() if body is not None else None
+        headers = {"Content-Type": "application/json"} if data else {}
+        # Retry once on a fresh connection if the kept-alive one was closed
+        for attempt in range(2):
+            if self._connection is None:
+                self._connection = self._connect()
+            try:
+                self._connection.request(method, path, body=data,
+                                         headers=headers)
+                response = self._connection.getresponse()
+                data = response.read()
+                break
+            except (ConnectionError, http.client.HTTPException):
+                self._connection.close()
+                self._connection = None
+                if attempt == 1:
+                    raise
+        if response.status != 200:
+            # Errors of the HTTP server itself are HTML pages
+            error = response.reason
+            if response.getheader("Content-Type") == "application/json":
+                error = json.loads(data).get("error", error)
+            raise RuntimeError(f"The inference server returned "
+                               f"{response.status}: {error}")
+        return json.loads(data)
+
+    def generate_predictions(self, inputs: List[Dict]) -> Iterator[Dict]:
+        for start in range(0, len(inputs), self.request_size):
+            rows = [{key: row[key] for key in ROW_KEYS}
+                    for row in inputs[start:start + self.request_size]]
+            with profiler.span("server_request", rows=len(rows)):
+                yield from self._request("POST", "/predict",
+                                         {"rows": rows})["results"]
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
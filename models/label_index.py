@@ -0,0 +1,381 @@
+import argparse
+import bisect
+import json
+import mmap
+import struct
+import tempfile
+import unicodedata
+from collections import Counter, defaultdict
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+import numpy as np
+from loguru import logger
+
+from models.disambiguation import WikidataDisambiguator
+from models.disambiguation_cache import normalize_label
+from models.profiling import profiler
+
+MAGIC = b"LKBCIDX1"
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+
+
+def index_key(label: str) -> str:
+    """Case- and diacritic-insensitive key of a label."""
+    label = unicodedata.normalize("NFKD", normalize_label(label))
+    return "".join(c for c in label if not unicodedata.combining(c))
+
+
+def read_label_pairs(file_path: Union[str, Path]) -> Iterable[
+    Tuple[str, str, Optional[str]]]:
+    """
+    Read (label, Wikidata ID, relation) triples from a label source.
+
+    Supported sources are the challenge JSONL files, whose `ObjectEntities`
+    and `ObjectEntitiesID` lists are paired up, and tab-separated label dumps
+    with one `<ID>\\t<label or alias>[\\t<relation>]` line per label.
+    """
+    file_path = Path(file_path)
+    with open(file_path) as f:
+        if file_path.suffix == ".jsonl":
+            for line in f:
+                row = json.loads(line)
+                labels = row.get("ObjectEntities") or []
+                wikidata_ids = row.get("ObjectEntitiesID") or []
+                if len(labels) != len(wikidata_ids):
+                    # The labels cannot be paired with their IDs reliably
+                    continue
+                for label, wikidata_id in zip(labels, wikidata_ids):
+                    yield label, wikidata_id, row.get("Relation")
+        else:
+            for line in f:
+                fields = line.rstrip("\n").split("\t")
+                if len(fields) < 2:
+                    continue
+                relation = fields[2] if len(fields) > 2 else None
+                yield fields[1], fields[0], relation
+
+
+def source_stamps(sources: Iterable[Union[str, Path]]) -> List[Dict]:
+    """The path, size and modification time of every label source."""
+    stamps = []
+    for source in sources:
+        stat = Path(source).stat()
+        stamps.append({
+            "path": str(Path(source).resolve()),
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+        })
+    return stamps
+
+
+class LabelIndex:
+    """
+    A memory-mapped, read-only index from normalized labels to Wikidata IDs.
+
+    Entries are sorted by key, so a lookup is a binary search over the mapped
+    file. Every (key, ID) entry carries how often it was seen and a bitmask of
+    the relations it was seen with, which allows filtering by relation.
+    """
+
+    def __init__(self, file_path: Union[str, Path]):
+        self.file_path = file_path
+        self._file = open(file_path, "rb")
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self._mmap[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"`{file_path}` is not a label index file.")
+        offset = len(MAGIC)
+        header_size, = struct.unpack_from("<I", self._mmap, offset)
+        offset += 4
+        header = json.loads(self._mmap[offset:offset + header_size])
+        offset += header_size
+
+        self.relations = header["relations"]
+        # The sources the index was built from (missing in older indexes)
+        self.sources = header.get("sources")
+        self.num_entries = n = header["num_entries"]
+
+        def array(dtype, count):
+            nonlocal offset
+            values = np.frombuffer(self._mmap, dtype=dtype, count=count,
+                                   offset=offset)
+            offset += values.nbytes
+            return values
+
+        self._key_offsets = array("<u8", n + 1)
+        self._id_offsets = array("<u8", n + 1)
+        self._counts = array("<u4", n)
+        self._relation_masks = array("<u8", n)
+        self._keys_start = offset
+        self._ids_start = offset + int(self._key_offsets[-1])
+
+        self._keys = _KeyView(self)
+
+    @staticmethod
+    def build(sources: Iterable[Union[str, Path]],
+              file_path: Union[str, Path]) -> Path:
+        """Build an index file from JSONL files and/or tab-separated label dumps."""
+        sources = list(sources)
+        counts = Counter()
+        relation_sets = defaultdict(set)
+        for source in sources:
+            logger.info(f"Reading labels from `{source}`...")
+            for label, wikidata_id, relation in read_label_pairs(source):
+                key = index_key(label)
+                wikidata_id = str(wikidata_id).strip()
+                if not key or not wikidata_id or key == wikidata_id.casefold():
+                    continue
+                counts[(key, wikidata_id)] += 1
+                if relation:
+                    relation_sets[(key, wikidata_id)].add(relation)
+
+        relations = sorted({r for rs in relation_sets.values() for r in rs})
+        if len(relations) > 64:
+            raise ValueError("A label index supports at most 64 relations.")
+        relation_bits = {r: 1 << i for i, r in enumerate(relations)}
+
+        # Sort by key bytes, then the most frequent ID first
+        entries = sorted(
+            counts.items(),
+            key=lambda x: (x[0][0].encode(), -x[1], x[0][1])
+        )
+        keys = [key.encode() for (key, _), _ in entries]
+        wikidata_ids = [wikidata_id.encode() for (_, wikidata_id), _ in entries]
+        masks = [
+            sum(relation_bits[r] for r in relation_sets[entry])
+            for entry, _ in entries
+        ]
+
+        header = json.dumps({
+            "relations": relations,
+            "num_entries": len(entries),
+            "sources": source_stamps(sources),
+        }).encode()
+
+        file_path = Path(file_path)
+        file_path.parent.mkdir(parents=True, exist_ok=True)
+        # A temporary file of its own, as several processes may build the
+        # same index at once
+        f = tempfile.NamedTemporaryFile(dir=file_path.parent,
+                                        prefix=file_path.name + ".",
+                                        suffix=".tmp", delete=False)
+        tmp_path = Path(f.name)
+        try:
+            with f:
+                f.write(MAGIC)
+                f.write(struct.pack("<I", len(header)))
+                f.write(header)
+                f.write(np.cumsum([0] + [len(k) for k in keys],
+                                  dtype="<u8").tobytes())
+                f.write(np.cumsum([0] + [len(i) for i in wikidata_ids],
+                                  dtype="<u8").tobytes())
+                f.write(np.array([c for _, c in entries],
+                                 dtype="<u4").tobytes())
+                f.write(np.array(masks, dtype="<u8").tobytes())
+                f.write(b"".join(keys))
+                f.write(b"".join(wikidata_ids))
+            tmp_path.replace(file_path)
+        except BaseException:
+            tmp_path.unlink(missing_ok=True)
+            raise
+
+        logger.info(f"Wrote {len(entries):,} labels to `{file_path}`.")
+        return file_path
+
+    def candidates(self, label: str) -> List[Tuple[str, int, int]]:
+        """All (Wikidata ID, count, relation mask) entries of a label."""
+        key = index_key(label).encode()
+        start = bisect.bisect_left(self._keys, key)
+        entries = []
+        for i in range(start, self.num_entries):
+            if self._keys[i] != key:
+                break
+            start_id = self._ids_start + int(self._id_offsets[i])
+            end_id = self._ids_start + int(self._id_offsets[i + 1])
+            entries.append((
+                self._mmap[start_id:end_id].decode(),
+                int(self._counts[i]),
+                int(self._relation_masks[i]),
+            ))
+        return entries
+
+    def lookup(self, label: str, relation: Optional[str] = None) -> Optional[
+        str]:
+        """
+        Return the most frequent Wikidata ID of a label, or None if unknown.
+
+        If `relation` is given and known to the index, only IDs that were seen
+        as objects of that relation are considered.
+        """
+        bit = None
+        if relation is not None and relation in self.relations:
+            bit = 1 << self.relations.index(relation)
+        for wikidata_id, _, mask in self.candidates(label):
+            if bit is None or mask & bit:
+                return wikidata_id
+        return None
+
+    def close(self):
+        self._keys = None
+        self._key_offsets = self._id_offsets = None
+        self._counts = self._relation_masks = None
+        self._mmap.close()
+        self._file.close()
+
+
+class _KeyView:
+    """Sequence view over the keys of a LabelIndex, for bisect."""
+
+    def __init__(self, index: LabelIndex):
+        self.index = index
+
+    def __len__(self):
+        return self.index.num_entries
+
+    def __getitem__(self, i: int) -> bytes:
+        index = self.index
+        start = index._keys_start + int(index._key_offsets[i])
+        end = index._keys_start + int(index._key_offsets[i + 1])
+        return index._mmap[start:end]
+
+
+class OfflineDisambiguator:
+    """
+    Resolves surface strings with a LabelIndex, optionally falling back to
+    another disambiguator (typically the Wikidata API) for unknown labels.
+    """
+
+    def __init__(self,
+                 index: LabelIndex,
+                 fallback=None,
+                 filter_by_relation: bool = True):
+        self.index = index
+        self.fallback = fallback
+        self.filter_by_relation = filter_by_relation
+
+        self.index_hits = 0
+        self.index_misses = 0
+
+    @classmethod
+    def from_config(cls, config: dict, fallback=None):
+        index_file = Path(config.get("label_index_file",
+                                     REPO_DIR / "cache" / "label_index.bin"))
+        sources = config.get("label_index_sources",
+                             [config.get("train_data_file",
+                                         "data/train.jsonl")])
+
+        index = None
+        if index_file.exists():
+            logger.info(f"Loading the label index `{index_file}`...")
+            index = LabelIndex(index_file)
+            try:
+                stamps = source_stamps(sources)
+            except FileNotFoundError as e:
+                logger.warning(f"Cannot check whether the label index is up "
+                               f"to date: {e}")
+                stamps = index.sources
+            if index.sources != stamps:
+                logger.warning(f"The label sources changed since the label "
+                               f"index `{index_file}` was built; "
+                               f"rebuilding it.")
+                index.close()
+                index = None
+        if index is None:
+            logger.info(f"Building the label index `{index_file}`...")
+            LabelIndex.build(sources, index_file)
+            index = LabelIndex(index_file)
+
+        return cls(
+            index=index,
+            fallback=(fallback if config.get("label_index_fallback", True)
+                      else None),
+            filter_by_relation=config.get("label_index_filter_by_relation",
+                                          True),
+        )
+
+    def _lookup_index(self, item: str, relation: Optional[str]) -> Optional[
+        str]:
+        wikidata_id = WikidataDisambiguator.resolve_locally(item)
+        if wikidata_id is not None:
+            return wikidata_id
+
+        wikidata_id = self.index.lookup(
+            item, relation if self.filter_by_relation else None)
+        if wikidata_id is None:
+            self.index_misses += 1
+        else:
+            self.index_hits += 1
+        return wikidata_id
+
+    def lookup(self, item, relation: Optional[str] = None) -> str:
+        """Return the Wikidata ID of a single item."""
+        item = str(item).strip()
+        wikidata_id = self._lookup_index(item, relation)
+        if wikidata_id is not None:
+            return wikidata_id
+        if self.fallback is not None:
+            return self.fallback.lookup(item)
+        return ""
+
+    def lookup_many(self, items: Iterable[str],
+                    relation: Optional[str] = None,
+                    desc: str = "Disambiguating entities") -> Dict[str, str]:
+        """Resolve many items, sending only the unknown ones to the fallback."""
+        results = {}
+        unknown = []
+        for item in items:
+            if item in results:
+                continue
+            wikidata_id = self._lookup_index(str(item).strip(), relation)
+            if wikidata_id is None:
+                unknown.append(item)
+                wikidata_id = ""
+            results[item] = wikidata_id
+
+        profiler.count("index_hits", len(results) - len(unknown))
+        if unknown and self.fallback is not None:
+            results.update(self.fallback.lookup_many(unknown, desc=desc))
+
+        return results
+
+    def stats(self) -> dict:
+        stats = self.fallback.stats() if self.fallback is not None else {}
+        return {
+            **stats,
+            "index_hits": self.index_hits,
+            "index_misses": self.index_misses,
+        }
+
+    def close(self):
+        self.index.close()
+        if self.fallback is not None:
+            self.fallback.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Build an offline label index for disambiguation")
+
+    parser.add_argument(
+        "-s", "--sources",
+        type=str,
+        nargs="+",
+        required=True,
+        help="JSONL data files and/or tab-separated label dumps"
+    )
+    parser.add_argument(
+        "-o", "--output_file",
+        type=str,
+        required=True,
+        help="Path to the index file"
+    )
+
+    args = parser.parse_args()
+
+    LabelIndex.build(args.sources, args.output_file)
+
+
+if __name__ == "__main__":
+    main()
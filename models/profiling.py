@@ -0,0 +1,157 @@
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Union
+
+
+class _NullSpan:
+    """Stands in for a span while profiling is disabled."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def set(self, **args):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    def __init__(self, profiler: "Profiler", name: str, args: dict):
+        self.profiler = profiler
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profiler.add_span(self.name, self.start, time.perf_counter(),
+                               self.args)
+        return False
+
+    def set(self, **args):
+        """Attach values that are only known inside the span, e.g. counts."""
+        self.args.update(args)
+
+
+class Profiler:
+    """
+    Collects timed spans and counters of a run.
+
+    Spans are nested per thread, so the disambiguation of one batch shows up
+    next to the generation of the next. The profiler is disabled by default,
+    in which case `span` returns a shared no-op and `count` returns at once.
+    The events can be written as a Chrome trace, which Perfetto
+    (https://ui.perfetto.dev) and `chrome://tracing` open.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.spans = []
+        self.counters = {}
+        self.counter_events = []
+        self._thread_names = {}
+        self._lock = threading.Lock()
+        self._start = time.perf_counter()
+
+    def enable(self):
+        self.enabled = True
+        self.spans = []
+        self.counters = {}
+        self.counter_events = []
+        self._thread_names = {}
+        self._start = time.perf_counter()
+
+    def span(self, name: str, **args):
+        """Time a block: `with profiler.span("tokenize", prompts=8): ...`."""
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name, args)
+
+    def add_span(self, name: str, start: float, end: float, args: dict):
+        thread = threading.current_thread()
+        with self._lock:
+            self._thread_names.setdefault(thread.ident, thread.name)
+            self.spans.append((name, start, end, thread.ident, args))
+
+    def count(self, name: str, value: int = 1):
+        """Add to a counter, e.g. the tokens or cache hits of a batch."""
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+            self.counter_events.append(
+                (name, time.perf_counter(), self.counters[name]))
+
+    def trace_events(self) -> List[Dict]:
+        """The spans and counters in the Chrome trace event format."""
+        pid = os.getpid()
+
+        def timestamp(t):
+            return round((t - self._start) * 1e6, 3)
+
+        events = [
+            {"name": "thread_name", "ph": "M", "pid": pid, "tid": tid,
+             "args": {"name": name}}
+            for tid, name in self._thread_names.items()
+        ]
+        for name, start, end, tid, args in self.spans:
+            events.append({
+                "name": name, "cat": "baseline", "ph": "X",
+                "ts": timestamp(start),
+                "dur": round((end - start) * 1e6, 3),
+                "pid": pid, "tid": tid, "args": args,
+            })
+        for name, t, value in self.counter_events:
+            events.append({
+                "name": name, "ph": "C", "ts": timestamp(t), "pid": pid,
+                "args": {name: value},
+            })
+        return events
+
+    def write_trace(self, file_path: Union[str, Path]):
+        Path(file_path).parent.mkdir(parents=True, exist_ok=True)
+        with open(file_path, "w") as f:
+            json.dump({"traceEvents": self.trace_events(),
+                       "displayTimeUnit": "ms"}, f)
+
+    def summary(self) -> str:
+        """A table of the time per span name, followed by the counters."""
+        durations = {}
+        for name, start, end, _, _ in self.spans:
+            durations.setdefault(name, []).append(end - start)
+
+        lines = [f"{'stage':28s} {'calls':>8s} {'total s':>10s} "
+                 f"{'mean ms':>10s} {'p50 ms':>10s} {'p95 ms':>10s} "
+                 f"{'max ms':>10s}"]
+        for name, values in sorted(durations.items(),
+                                   key=lambda x: -sum(x[1])):
+            values.sort()
+
+            def percentile(q):
+                return values[min(len(values) - 1, int(q * len(values)))]
+
+            lines.append(
+                f"{name:28s} {len(values):8,} {sum(values):10.3f} "
+                f"{sum(values) / len(values) * 1000:10.2f} "
+                f"{percentile(0.5) * 1000:10.2f} "
+                f"{percentile(0.95) * 1000:10.2f} "
+                f"{values[-1] * 1000:10.2f}")
+        if self.counters:
+            lines.append("")
+            lines.append(f"{'counter':28s} {'value':>8s}")
+            for name, value in sorted(self.counters.items()):
+                lines.append(f"{name:28s} {value:8,}")
+        return "\n".join(lines)
+
+
+# Shared by all modules of a process; `baseline.py --profile` enables it
+profiler = Profiler()
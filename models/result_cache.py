@@ -0,0 +1,160 @@
+import hashlib
+import json
+import sqlite3
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Union
+
+from loguru import logger
+
+from models.profiling import profiler
+
+# Configuration keys that only affect speed or bookkeeping, not the results
+IGNORED_CONFIG_KEYS = {
+    "batch_size",
+    "device",
+    "num_threads",
+    "num_interop_threads",
+    "compile",
+    "max_batch_tokens",
+    "prompt_templates_file",
+    "raw_outputs_file",
+    "result_cache_file",
+    "label_index_file",
+    "disambiguation_cache_file",
+    "disambiguation_cache_ttl",
+    "disambiguation_cache_max_entries",
+    "disambiguation_cache_lru_size",
+    "disambiguation_max_workers",
+    "disambiguation_max_retries",
+    "disambiguation_backoff_factor",
+    "disambiguation_timeout",
+    "disambiguation_max_requests_per_second",
+    "disambiguation_pipeline_depth",
+}
+
+# Configuration keys of files (or lists of files) whose content, not only
+# their path, determines the results
+DIGESTED_CONFIG_KEYS = ("train_data_file", "label_index_sources",
+                        "constrained_label_sources")
+
+
+def file_digest(file_path: Union[str, Path]) -> str:
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """
+    Content-addressed cache of result rows, stored in a SQLite file.
+
+    A row is keyed by a hash of the settings that determine its result: the
+    configuration (model, LLM, few-shot settings, ...), the prompt template
+    text of its relation, the content of the few-shot example pool and label
+    sources, and the subject and relation themselves. Editing the template of
+    one relation therefore only invalidates the rows of that relation, unless
+    the prompts draw few-shot examples from `train_data_file`: its examples
+    are formatted with the templates of all relations, so all templates are
+    part of every key. Changes to the model code are not part of the key.
+    """
+
+    def __init__(self, file_path: Union[str, Path], config: dict):
+        self.file_path = file_path
+
+        self.hits = 0
+        self.misses = 0
+
+        self.prompt_templates = {}
+        if config.get("prompt_templates_file"):
+            from models.baseline_model import BaselineModel
+            self.prompt_templates = BaselineModel.read_prompt_templates_from_csv(
+                config["prompt_templates_file"])
+
+        # Settings shared by all rows
+        settings = {key: value for key, value in config.items()
+                    if key not in IGNORED_CONFIG_KEYS}
+        for key in DIGESTED_CONFIG_KEYS:
+            file_paths = config.get(key) or []
+            if isinstance(file_paths, (str, Path)):
+                file_paths = [file_paths]
+            digests = [file_digest(file_path) for file_path in file_paths
+                       if Path(file_path).exists()]
+            if digests:
+                settings[f"{key}_digest"] = digests
+        if config.get("train_data_file"):
+            # The few-shot examples are formatted with every template
+            settings["prompt_templates"] = self.prompt_templates
+        self._settings = json.dumps(settings, sort_keys=True, default=str)
+
+        Path(file_path).parent.mkdir(parents=True, exist_ok=True)
+        logger.info(f"Opening the result cache `{file_path}`...")
+        self._db = sqlite3.connect(str(file_path), isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "key TEXT PRIMARY KEY, "
+            "relation TEXT NOT NULL, "
+            "result TEXT NOT NULL, "
+            "created REAL NOT NULL)"
+        )
+
+    def key(self, row: Dict) -> str:
+        relation = row["Relation"]
+        content = json.dumps([
+            self._settings,
+            self.prompt_templates.get(relation),
+            row.get("SubjectEntityID"),
+            row["SubjectEntity"],
+            relation,
+        ])
+        return hashlib.sha256(content.encode()).hexdigest()
+
+    def get_many(self, rows: List[Dict]) -> List[Optional[Dict]]:
+        """The cached result of every row, or None where it is missing."""
+        keys = [self.key(row) for row in rows]
+        found = {}
+        # Stay below SQLite's limit on the number of query parameters
+        for start in range(0, len(keys), 512):
+            batch = keys[start:start + 512]
+            found.update(self._db.execute(
+                "SELECT key, result FROM results WHERE key IN "
+                f"({', '.join('?' * len(batch))})",
+                batch
+            ).fetchall())
+
+        results = []
+        for key in keys:
+            result = found.get(key)
+            if result is None:
+                self.misses += 1
+                results.append(None)
+            else:
+                self.hits += 1
+                results.append(json.loads(result))
+        profiler.count("result_cache_hits",
+                       sum(result is not None for result in results))
+        return results
+
+    def put(self, row: Dict, result: Dict):
+        self._db.execute(
+            "INSERT OR REPLACE INTO results (key, relation, result, created) "
+            "VALUES (?, ?, ?, ?)",
+            (self.key(row), row["Relation"], json.dumps(result), time.time())
+        )
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups > 0 else 0.0,
+        }
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
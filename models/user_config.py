@@ -1,9 +1,6 @@
+import importlib
 from enum import Enum
 
-from models.baseline_fill_mask_model import FillMaskModel
-from models.baseline_generation_model import GenerationModel
-from models.baseline_llama_3_chat_model import Llama3ChatModel
-
 
 class Models(Enum):
     BASELINE_FILL_MASK = "baseline_fill_mask"
@@ -13,13 +10,26 @@ class Models(Enum):
     # Add more models here
 
     @staticmethod
-    def get_model(model_name: str):
-        model = Models(model_name)
-        if model == Models.BASELINE_FILL_MASK:
-            return FillMaskModel
-        elif model == Models.BASELINE_GENERATION:
-            return GenerationModel
-        elif model == Models.BASELINE_LLAMA_3_CHAT:
-            return Llama3ChatModel
-        else:
+    def get_model_path(model_name: str) -> str:
+        """The `module:class` entry point of a model, without importing it."""
+        try:
+            return MODEL_ENTRY_POINTS[Models(model_name)]
+        except (KeyError, ValueError):
             raise ValueError(f"Model `{model_name}` not found.")
+
+    @staticmethod
+    def get_model(model_name: str):
+        # Import only the selected model, so that the heavy dependencies of
+        # the others (torch, transformers, ...) are not loaded
+        module_name, class_name = Models.get_model_path(model_name).split(":")
+        return getattr(importlib.import_module(module_name), class_name)
+
+
+# Entry points of the models, imported on demand by `Models.get_model`
+MODEL_ENTRY_POINTS = {
+    Models.BASELINE_FILL_MASK: "models.baseline_fill_mask_model:FillMaskModel",
+    Models.BASELINE_GENERATION:
+        "models.baseline_generation_model:GenerationModel",
+    Models.BASELINE_LLAMA_3_CHAT:
+        "models.baseline_llama_3_chat_model:Llama3ChatModel",
+}
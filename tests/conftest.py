@@ -0,0 +1,9 @@
+import pytest
+
+from benchmarks.run_benchmarks import build_tiny_models
+
+
+@pytest.fixture(scope="session")
+def tiny_models(tmp_path_factory):
+    """Tiny random BERT and GPT-2 models, built once per test session."""
+    return build_tiny_models(tmp_path_factory.mktemp("models"))
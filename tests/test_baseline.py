@@ -0,0 +1,135 @@
+import json
+import sys
+
+import pytest
+
+import baseline
+
+
+class EchoModel:
+    """Predicts the subject entity ID of every row as its only object."""
+
+    def generate_predictions(self, inputs):
+        return [{**row, "ObjectEntitiesID": [row["SubjectEntityID"]]}
+                for row in inputs]
+
+    def close(self):
+        pass
+
+
+def write_jsonl(file_path, rows):
+    with open(file_path, "w") as f:
+        for row in rows:
+            f.write(json.dumps(row) + "\n")
+
+
+def read_jsonl(file_path):
+    return list(baseline.iter_jsonl(file_path))
+
+
+@pytest.fixture
+def run(tmp_path, monkeypatch):
+    config_file = tmp_path / "config.yaml"
+    config_file.write_text('model: "echo"\n')
+    monkeypatch.setattr(baseline, "load_model",
+                        lambda *args, **kwargs: EchoModel())
+
+    def run(input_file, output_file, *options):
+        monkeypatch.setattr(sys, "argv", [
+            "baseline.py", "-c", str(config_file), "-i", str(input_file),
+            "-o", str(output_file), *options])
+        baseline.main()
+        return read_jsonl(output_file)
+
+    return run
+
+
+def test_stream_keeps_repeated_keys_across_chunks(tmp_path, run):
+    rows = [
+        {"SubjectEntityID": "Q1", "SubjectEntity": "a", "Relation": "r"},
+        {"SubjectEntityID": "Q2", "SubjectEntity": "b", "Relation": "r"},
+        {"SubjectEntityID": "Q1", "SubjectEntity": "a", "Relation": "r"},
+    ]
+    input_file = tmp_path / "input.jsonl"
+    write_jsonl(input_file, rows)
+
+    default = run(input_file, tmp_path / "default.jsonl")
+    streamed = run(input_file, tmp_path / "streamed.jsonl",
+                   "--stream", "--chunk_size", "1")
+
+    assert len(default) == 3
+    assert streamed == default
+
+
+def test_resume_skips_exactly_the_written_rows(tmp_path, run):
+    rows = [{"SubjectEntityID": f"Q{i}", "SubjectEntity": str(i),
+             "Relation": "r"} for i in range(5)]
+    input_file = tmp_path / "input.jsonl"
+    write_jsonl(input_file, rows)
+    expected = run(input_file, tmp_path / "expected.jsonl")
+
+    # A crashed run: two complete rows and a partial third one
+    output_file = tmp_path / "output.jsonl"
+    with open(output_file, "w") as f:
+        f.write("".join(json.dumps(row) + "\n" for row in expected[:2]))
+        f.write(json.dumps(expected[2])[:10])
+
+    resumed = run(input_file, output_file, "--stream", "--chunk_size", "1",
+                  "--resume")
+
+    assert resumed == expected
+
+
+def test_server_runs_skip_the_result_cache(tmp_path, run):
+    cache_file = tmp_path / "results.sqlite"
+    (tmp_path / "config.yaml").write_text(
+        f'model: "echo"\nresult_cache_file: "{cache_file}"\n')
+    rows = [{"SubjectEntityID": "Q1", "SubjectEntity": "a", "Relation": "r"}]
+    input_file = tmp_path / "input.jsonl"
+    write_jsonl(input_file, rows)
+
+    run(input_file, tmp_path / "cached.jsonl")
+    assert cache_file.exists()
+    cache_file.unlink()
+
+    run(input_file, tmp_path / "served.jsonl", "--server",
+        "http://127.0.0.1:8765")
+    assert not cache_file.exists()
+
+
+def test_failed_model_load_keeps_the_output(tmp_path, run, monkeypatch):
+    input_file = tmp_path / "input.jsonl"
+    write_jsonl(input_file, [
+        {"SubjectEntityID": "Q1", "SubjectEntity": "a", "Relation": "r"}])
+    output_file = tmp_path / "output.jsonl"
+    expected = run(input_file, output_file)
+
+    def load_model(*args, **kwargs):
+        raise RuntimeError("out of memory")
+
+    monkeypatch.setattr(baseline, "load_model", load_model)
+    for options in [(), ("--stream",), ("--checkpoint_every", "1")]:
+        with pytest.raises(RuntimeError):
+            run(input_file, output_file, *options)
+        assert read_jsonl(output_file) == expected
+
+
+def test_resume_refuses_raw_outputs(tmp_path, run, capsys):
+    raw_outputs_file = tmp_path / "raw.parquet"
+    (tmp_path / "config.yaml").write_text(
+        f'model: "echo"\nraw_outputs_file: "{raw_outputs_file}"\n')
+    input_file = tmp_path / "input.jsonl"
+    write_jsonl(input_file, [
+        {"SubjectEntityID": "Q1", "SubjectEntity": "a", "Relation": "r"}])
+    output_file = tmp_path / "output.jsonl"
+    output_file.write_text("")
+
+    with pytest.raises(SystemExit):
+        run(input_file, output_file, "--resume")
+    assert "raw_outputs_file" in capsys.readouterr().err
+    assert output_file.read_text() == ""
+
+    # Without an output to resume, the run predicts every row
+    output_file.unlink()
+    assert run(input_file, output_file, "--resume") == \
+        EchoModel().generate_predictions(read_jsonl(input_file))
@@ -0,0 +1,55 @@
+import json
+import sys
+
+import pytest
+
+import convert_format
+from models.columnar import COLUMNS, ColumnarWriter, iter_columnar_rows, \
+    read_columnar_file
+
+ROWS = [
+    {"SubjectEntityID": "Q1", "SubjectEntity": "a", "Relation": "r1",
+     "ObjectEntities": ["x", "y"], "ObjectEntitiesID": ["Q2", "Q3"]},
+    {"SubjectEntityID": "Q4", "SubjectEntity": "b", "Relation": "r2",
+     "ObjectEntities": [], "ObjectEntitiesID": []},
+    {"SubjectEntityID": None, "SubjectEntity": "a", "Relation": "r2",
+     "ObjectEntities": None, "ObjectEntitiesID": None},
+    {"SubjectEntityID": "Q5", "SubjectEntity": "c", "Relation": "r1",
+     "ObjectEntities": ["y", None, "z"], "ObjectEntitiesID": ["Q3", "Q3",
+                                                              "Q6"]},
+    {"SubjectEntityID": "Q1", "SubjectEntity": "a", "Relation": "r1",
+     "ObjectEntities": ["x"], "ObjectEntitiesID": ["Q2"]},
+]
+
+
+def convert(monkeypatch, input_file, output_file, *options):
+    monkeypatch.setattr(sys, "argv", [
+        "convert_format.py", "-i", str(input_file), "-o", str(output_file),
+        *options])
+    convert_format.main()
+
+
+@pytest.mark.parametrize("suffix", [".arrow", ".feather", ".parquet"])
+def test_round_trip(tmp_path, monkeypatch, suffix):
+    input_file = tmp_path / "input.jsonl"
+    input_file.write_text("".join(json.dumps(row) + "\n" for row in ROWS))
+
+    columnar_file = tmp_path / f"rows{suffix}"
+    output_file = tmp_path / "output.jsonl"
+    # Batches of two rows, so that the dictionaries grow between batches
+    convert(monkeypatch, input_file, columnar_file, "--batch_size", "2")
+    convert(monkeypatch, columnar_file, output_file)
+
+    assert list(iter_columnar_rows(columnar_file)) == ROWS
+    with open(output_file) as f:
+        assert [json.loads(line) for line in f] == ROWS
+
+
+@pytest.mark.parametrize("suffix", [".arrow", ".parquet"])
+def test_empty_file_has_all_columns(tmp_path, suffix):
+    writer = ColumnarWriter(tmp_path / f"rows{suffix}")
+    writer.close()
+
+    table = read_columnar_file(tmp_path / f"rows{suffix}")
+    assert table.num_rows == 0
+    assert table.column_names == list(COLUMNS)
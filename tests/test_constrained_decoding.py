@@ -0,0 +1,67 @@
+import re
+
+import pytest
+import torch
+
+from models.constrained_decoding import AnswerTries, ConstrainedAnswer
+
+VOCABULARY = {}
+
+
+def tokenize(texts):
+    """Split into words, spaces and commas, one token ID each."""
+    return [[VOCABULARY.setdefault(token, len(VOCABULARY))
+             for token in re.findall(r"\w+|\s|,", text)] for text in texts]
+
+
+@pytest.fixture
+def tries():
+    return AnswerTries({"Paris": "Q90", "Paris, Texas": "Q830149",
+                        "Texas": "Q1439", "Lyon": "Q456"}, tokenize)
+
+
+def decode(tries, text):
+    answer = ConstrainedAnswer(tries)
+    for token_id in tokenize([text])[0]:
+        allowed = answer.allowed_token_ids(torch.device("cpu"))
+        assert allowed is not None and token_id in allowed.tolist(), text
+        answer.advance(token_id)
+    return answer
+
+
+def allowed(answer):
+    return set(answer.allowed_token_ids(torch.device("cpu")).tolist())
+
+
+@pytest.mark.parametrize("text, wikidata_ids", [
+    (" Paris", ["Q90"]),
+    # The longest label wins over "Paris" + "Texas"
+    (" Paris, Texas", ["Q830149"]),
+    (" Paris, Lyon", ["Q90", "Q456"]),
+    (" Paris, Texas, Lyon", ["Q830149", "Q456"]),
+])
+def test_label_that_prefixes_another(tries, text, wikidata_ids):
+    answer = decode(tries, text)
+    assert answer.can_end()
+    assert answer.wikidata_ids() == wikidata_ids
+
+
+def test_separator_and_longer_label_are_both_allowed(tries):
+    answer = decode(tries, " Paris,")
+    # " Texas" continues both "Paris, Texas" and a second label
+    assert allowed(answer) == set(tokenize([" "])[0])
+    assert not answer.can_end()
+
+
+def test_end_after_label(tries):
+    answer = decode(tries, " Lyon")
+    answer.advance(len(VOCABULARY) + 1)
+    assert answer.allowed_token_ids(torch.device("cpu")) is None
+    assert answer.wikidata_ids() == ["Q456"]
+
+
+def test_none_only_ends(tries):
+    answer = decode(tries, " None")
+    assert answer.can_end()
+    assert allowed(answer) == set()
+    assert answer.wikidata_ids() == []
@@ -0,0 +1,203 @@
+import json
+import sqlite3
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+from models.disambiguation import RateLimiter, WikidataDisambiguator
+from models.disambiguation_cache import DisambiguationCache
+
+IDS = {"Paris": "Q90", "Berlin": "Q64", "Rome": "Q220", "Madrid": "Q2807"}
+
+
+class StubWikidata(ThreadingHTTPServer):
+    """
+    Answers `wbsearchentities` with the IDs in `ids`, after `num_failures`
+    responses with `failure_status` per search. The responses of earlier
+    searches are delayed more, so that concurrent results arrive out of
+    order.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, ids=IDS, num_failures=1, failure_status=429,
+                 retry_after=None):
+        super().__init__(("127.0.0.1", 0), StubHandler)
+        self.ids = ids
+        self.num_failures = num_failures
+        self.failure_status = failure_status
+        self.retry_after = retry_after
+        self.requests = {}
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/w/api.php"
+
+
+class StubHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        search = parse_qs(urlparse(self.path).query)["search"][0]
+        server = self.server
+        with server.lock:
+            attempt = server.requests.get(search, 0)
+            server.requests[search] = attempt + 1
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight,
+                                       server.in_flight)
+        try:
+            if attempt < server.num_failures:
+                self.send_response(server.failure_status)
+                if server.retry_after is not None:
+                    self.send_header("Retry-After", server.retry_after)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            time.sleep(0.05 * (len(server.ids)
+                               - list(server.ids).index(search)))
+            body = json.dumps(
+                {"search": [{"id": server.ids[search]}]}).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def stub():
+    servers = []
+
+    def stub(**kwargs):
+        server = StubWikidata(**kwargs)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+
+    yield stub
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture
+def pauses(monkeypatch):
+    """The back-off of every 429 response, in seconds."""
+    pauses = []
+    pause = RateLimiter.pause
+
+    def record(self, seconds):
+        pauses.append(seconds)
+        pause(self, seconds)
+
+    monkeypatch.setattr(RateLimiter, "pause", record)
+    return pauses
+
+
+@pytest.mark.parametrize("retry_after, backoff", [(None, 0.05),
+                                                  ("0.1", 0.1)])
+def test_lookup_many_retries_after_429(stub, pauses, retry_after, backoff):
+    server = stub(retry_after=retry_after)
+    disambiguator = WikidataDisambiguator(api_url=server.url, max_workers=4,
+                                          backoff_factor=0.05)
+    items = ["Rome", "Paris", "Madrid", "Paris", "Berlin", "42", "None"]
+
+    try:
+        results = disambiguator.lookup_many(items)
+    finally:
+        disambiguator.close()
+
+    # Every label was searched once, and retried once after the 429
+    assert server.requests == {label: 2 for label in IDS}
+    assert pauses == [backoff] * len(IDS)
+    assert disambiguator.stats()["http_calls"] == 2 * len(IDS)
+    assert disambiguator.stats()["http_errors"] == 0
+    assert server.max_in_flight > 1
+
+    # The results follow the order of the items
+    assert list(results.items()) == [
+        ("Rome", "Q220"), ("Paris", "Q90"), ("Madrid", "Q2807"),
+        ("Berlin", "Q64"), ("42", "42"), ("None", "")]
+
+
+def test_lookup_many_gives_up_after_the_retries(stub, monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(time, "sleep", sleeps.append)
+    server = stub(num_failures=10, failure_status=503)
+    disambiguator = WikidataDisambiguator(api_url=server.url, max_workers=4,
+                                          max_retries=2, backoff_factor=0.5)
+
+    try:
+        results = disambiguator.lookup_many(["Paris", "Rome"])
+        # Failed searches are not cached
+        assert disambiguator.cache.get("Paris") is None
+    finally:
+        disambiguator.close()
+
+    # They fall back to the surface string
+    assert results == {"Paris": "Paris", "Rome": "Rome"}
+    assert server.requests == {"Paris": 3, "Rome": 3}
+    assert sorted(sleeps) == [0.5, 0.5, 1.0, 1.0]
+    assert disambiguator.stats()["http_calls"] == 6
+    assert disambiguator.stats()["http_errors"] == 2
+
+
+def test_lookup_many_searches_and_caches_the_label(stub, tmp_path):
+    # The search is case-sensitive here, so each variant is searched as is
+    server = stub(ids={"Paris": "Q90", "paris": "Q167646"}, num_failures=0)
+    cache_file = tmp_path / "wikidata.sqlite"
+    items = ["Paris", "paris", " Paris", "Paris"]
+    expected = {"Paris": "Q90", "paris": "Q167646", " Paris": "Q90"}
+
+    disambiguator = WikidataDisambiguator(
+        cache=DisambiguationCache(cache_file), api_url=server.url)
+    try:
+        assert disambiguator.lookup_many(items) == expected
+    finally:
+        disambiguator.close()
+    assert server.requests == {"Paris": 1, "paris": 1}
+
+    # A new process finds both labels in the cache file
+    disambiguator = WikidataDisambiguator(
+        cache=DisambiguationCache(cache_file), api_url=server.url)
+    try:
+        assert disambiguator.lookup_many(items) == expected
+        assert disambiguator.lookup("paris") == "Q167646"
+    finally:
+        disambiguator.close()
+    assert server.requests == {"Paris": 1, "paris": 1}
+
+
+def test_cache_drops_the_entries_of_normalized_labels(tmp_path):
+    cache_file = tmp_path / "wikidata.sqlite"
+    db = sqlite3.connect(cache_file)
+    db.execute("CREATE TABLE lookups (language TEXT NOT NULL, "
+               "label TEXT NOT NULL, qid TEXT NOT NULL, "
+               "created REAL NOT NULL, accessed REAL NOT NULL, "
+               "PRIMARY KEY (language, label))")
+    db.execute("INSERT INTO lookups VALUES ('en', 'paris', 'Q90', ?, ?)",
+               (time.time(), time.time()))
+    db.commit()
+    db.close()
+
+    cache = DisambiguationCache(cache_file)
+    assert cache.get("paris") is None
+    cache.put("paris", "Q167646")
+    cache.close()
+
+    cache = DisambiguationCache(cache_file)
+    assert cache.get("paris") == "Q167646"
+    assert cache.get("Paris") is None
+    cache.close()
@@ -0,0 +1,313 @@
+import json
+import sys
+from itertools import accumulate
+
+import pandas as pd
+import pytest
+
+import evaluate
+from models.columnar import ColumnarWriter
+
+GT_ROWS = [
+    {"SubjectEntity": "a", "Relation": "r1", "ObjectEntitiesID": ["Q1", "Q2"]},
+    {"SubjectEntity": "b", "Relation": "r1", "ObjectEntitiesID": []},
+    {"SubjectEntity": "a", "Relation": "r2", "ObjectEntitiesID": ["Q3"]},
+    {"SubjectEntity": "c", "Relation": "r2", "ObjectEntitiesID": ["Q1"]},
+    # A duplicated pair: the last row wins
+    {"SubjectEntity": "c", "Relation": "r2",
+     "ObjectEntitiesID": ["Q4", "Q5", "Q4"]},
+    {"SubjectEntity": "d", "Relation": "r3", "ObjectEntitiesID": []},
+]
+PRED_ROWS = [
+    {"SubjectEntity": "c", "Relation": "r2", "ObjectEntitiesID": ["Q1"]},
+    {"SubjectEntity": "a", "Relation": "r1",
+     "ObjectEntitiesID": ["Q1", "Q1", "Q9"]},
+    {"SubjectEntity": "b", "Relation": "r1", "ObjectEntitiesID": ["Q2"]},
+    {"SubjectEntity": "a", "Relation": "r2", "ObjectEntitiesID": []},
+    {"SubjectEntity": "d", "Relation": "r3", "ObjectEntitiesID": []},
+    {"SubjectEntity": "c", "Relation": "r2", "ObjectEntitiesID": ["Q5"]},
+    # Not in the ground truth
+    {"SubjectEntity": "e", "Relation": "r1", "ObjectEntitiesID": ["Q1"]},
+]
+
+
+def expected_scores(pred_rows=PRED_ROWS, gt_rows=GT_ROWS) -> pd.DataFrame:
+    return pd.DataFrame(evaluate.evaluate_per_sr_pair(pred_rows, gt_rows))
+
+
+def assert_scores_equal(scores, expected):
+    pd.testing.assert_frame_equal(scores.reset_index(drop=True), expected,
+                                  check_dtype=False)
+
+
+@pytest.fixture(autouse=True)
+def wide_output():
+    # Print every column of the results table
+    with pd.option_context("display.max_columns", None,
+                           "display.width", 1000):
+        yield
+
+
+def expected_output(pred_rows=PRED_ROWS, gt_rows=GT_ROWS) -> str:
+    """The output of the original `main`, from the per-pair functions."""
+    scores = evaluate.evaluate_per_sr_pair(pred_rows, gt_rows)
+    results = evaluate.format_results(
+        evaluate.macro_average_per_relation(scores),
+        evaluate.micro_average_per_relation(scores),
+        evaluate.prediction_statistics(scores))
+    return f"{results}\n"
+
+
+def run(monkeypatch, capsys, pred_file, gt_file, *options) -> str:
+    monkeypatch.setattr(sys, "argv", [
+        "evaluate.py", "-p", str(pred_file), "-g", str(gt_file), *options])
+    evaluate.main()
+    return capsys.readouterr().out
+
+
+def write_rows(file_path, rows):
+    if file_path.suffix == ".jsonl":
+        file_path.write_text("".join(json.dumps(row) + "\n" for row in rows))
+    else:
+        writer = ColumnarWriter(file_path, batch_size=2)
+        for row in rows:
+            writer.write(row)
+        writer.close()
+    return file_path
+
+
+@pytest.mark.parametrize("pred_suffix, gt_suffix", [
+    (".arrow", ".arrow"),
+    (".parquet", ".parquet"),
+    (".arrow", ".jsonl"),
+    (".jsonl", ".parquet"),
+])
+def test_columnar_scores(tmp_path, pred_suffix, gt_suffix):
+    pred_file = write_rows(tmp_path / f"pred{pred_suffix}", PRED_ROWS)
+    gt_file = write_rows(tmp_path / f"gt{gt_suffix}", GT_ROWS)
+
+    scores = evaluate.columnar_scores(evaluate.read_table(pred_file),
+                                      evaluate.read_table(gt_file))
+
+    assert_scores_equal(scores, expected_scores())
+
+
+def test_columnar_scores_missing_prediction(tmp_path):
+    pred_rows = [row for row in PRED_ROWS if row["SubjectEntity"] != "b"]
+    pred_file = write_rows(tmp_path / "pred.arrow", pred_rows)
+    gt_file = write_rows(tmp_path / "gt.arrow", GT_ROWS)
+
+    with pytest.raises(KeyError):
+        expected_scores(pred_rows)
+    with pytest.raises(KeyError, match="'b', 'r1'"):
+        evaluate.columnar_scores(evaluate.read_table(pred_file),
+                                 evaluate.read_table(gt_file))
+
+
+@pytest.mark.parametrize("pred_suffix", [".jsonl", ".arrow", ".parquet"])
+@pytest.mark.parametrize("gt_suffix", [".jsonl", ".arrow", ".parquet"])
+def test_main_with_any_file_format(tmp_path, monkeypatch, capsys,
+                                   pred_suffix, gt_suffix):
+    pred_file = write_rows(tmp_path / f"pred{pred_suffix}", PRED_ROWS)
+    gt_file = write_rows(tmp_path / f"gt{gt_suffix}", GT_ROWS)
+
+    assert run(monkeypatch, capsys, pred_file, gt_file) == expected_output()
+
+
+def expected_table(pred_rows=PRED_ROWS, gt_rows=GT_ROWS) -> pd.DataFrame:
+    scores = evaluate.evaluate_per_sr_pair(pred_rows, gt_rows)
+    return evaluate.format_results(
+        evaluate.macro_average_per_relation(scores),
+        evaluate.micro_average_per_relation(scores),
+        evaluate.prediction_statistics(scores))
+
+
+EMPTY_GT_ROWS = [{**row, "ObjectEntitiesID": []} for row in GT_ROWS]
+EMPTY_PRED_ROWS = [{**row, "ObjectEntitiesID": []} for row in PRED_ROWS]
+
+
+@pytest.mark.parametrize("pred_rows, gt_rows", [
+    (PRED_ROWS, GT_ROWS),
+    (EMPTY_PRED_ROWS, GT_ROWS),
+    (PRED_ROWS, EMPTY_GT_ROWS),
+    (EMPTY_PRED_ROWS, EMPTY_GT_ROWS),
+])
+def test_scores_per_sr_pair(pred_rows, gt_rows):
+    scores = evaluate.scores_per_sr_pair(pred_rows, gt_rows)
+
+    assert_scores_equal(scores, expected_scores(pred_rows, gt_rows))
+    pd.testing.assert_frame_equal(evaluate.results_table(scores),
+                                  expected_table(pred_rows, gt_rows))
+
+
+def test_scores_per_sr_pair_missing_prediction():
+    pred_rows = [row for row in PRED_ROWS if row["SubjectEntity"] != "b"]
+
+    with pytest.raises(KeyError):
+        expected_scores(pred_rows)
+    with pytest.raises(KeyError, match="'b', 'r1'"):
+        evaluate.scores_per_sr_pair(pred_rows, GT_ROWS)
+
+
+def test_incremental_scores(tmp_path):
+    cache_file = tmp_path / "scores.json"
+
+    scores = evaluate.incremental_scores(PRED_ROWS, GT_ROWS, cache_file)
+    assert_scores_equal(scores, expected_scores())
+
+    # Change the predictions of one relation: r1 is re-evaluated, the
+    # other relations come from the cache
+    pred_rows = [
+        {**row, "ObjectEntitiesID": ["Q2"]} if row["Relation"] == "r1"
+        else row for row in PRED_ROWS
+    ]
+    cached = json.loads(cache_file.read_text())
+    cached["r2"]["scores"]["tp"] = [-1] * len(cached["r2"]["scores"]["tp"])
+    cache_file.write_text(json.dumps(cached))
+
+    scores = evaluate.incremental_scores(pred_rows, GT_ROWS, cache_file)
+    changed = expected_scores(pred_rows)
+    assert_scores_equal(scores[scores["Relation"] != "r2"],
+                        changed[changed["Relation"] != "r2"]
+                        .reset_index(drop=True))
+    assert (scores.loc[scores["Relation"] == "r2", "tp"] == -1).all()
+
+    # Without the tampered entry, every relation matches again
+    cache_file.unlink()
+    scores = evaluate.incremental_scores(pred_rows, GT_ROWS, cache_file)
+    assert_scores_equal(scores, changed)
+    scores = evaluate.incremental_scores(pred_rows, GT_ROWS, cache_file)
+    assert_scores_equal(scores, changed)
+
+
+def test_incremental_scores_forget_relations(tmp_path):
+    cache_file = tmp_path / "scores.json"
+    evaluate.incremental_scores(PRED_ROWS, GT_ROWS, cache_file)
+
+    gt_rows = [row for row in GT_ROWS if row["Relation"] != "r3"]
+    scores = evaluate.incremental_scores(PRED_ROWS, gt_rows, cache_file)
+
+    assert_scores_equal(scores, expected_scores(gt_rows=gt_rows))
+    assert set(json.loads(cache_file.read_text())) == {"r1", "r2"}
+
+
+@pytest.mark.parametrize("options", [(), ("--cache_file", "scores.json")])
+def test_main_matches_per_pair_functions(tmp_path, monkeypatch, capsys,
+                                         options):
+    monkeypatch.chdir(tmp_path)
+    pred_file = write_rows(tmp_path / "pred.jsonl", PRED_ROWS)
+    gt_file = write_rows(tmp_path / "gt.jsonl", GT_ROWS)
+
+    for _ in range(2):
+        assert run(monkeypatch, capsys, pred_file, gt_file,
+                   *options) == expected_output()
+
+
+@pytest.mark.parametrize("num_shards", [1, 3, 20])
+@pytest.mark.parametrize("pred_rows, gt_rows", [
+    (PRED_ROWS, GT_ROWS),
+    (EMPTY_PRED_ROWS, GT_ROWS),
+    (PRED_ROWS, EMPTY_GT_ROWS),
+])
+def test_streaming_scores(tmp_path, pred_rows, gt_rows, num_shards):
+    pred_file = write_rows(tmp_path / "pred.jsonl", pred_rows)
+    index = evaluate.GroundTruthIndex.from_file(
+        write_rows(tmp_path / "gt.jsonl", gt_rows))
+
+    scores = evaluate.streaming_scores(pred_file, index, num_shards)
+
+    assert_scores_equal(scores, expected_scores(pred_rows, gt_rows))
+
+
+def test_streaming_scores_duplicate_across_shards(tmp_path):
+    pred_file = write_rows(tmp_path / "pred.jsonl", PRED_ROWS)
+    index = evaluate.GroundTruthIndex.from_file(
+        write_rows(tmp_path / "gt.jsonl", GT_ROWS))
+
+    # The first and the last prediction of c/r2 are in different shards
+    shards = evaluate.shard_offsets(pred_file, 3)
+    line_starts = [0, *accumulate(
+        len(line) for line in pred_file.read_bytes().splitlines(True))]
+
+    def shard_of(offset):
+        return next(i for i, (start, end) in enumerate(shards)
+                    if start <= offset < end)
+
+    assert shard_of(line_starts[0]) != shard_of(line_starts[5])
+
+    assert_scores_equal(evaluate.streaming_scores(pred_file, index, 3),
+                        expected_scores())
+
+
+@pytest.mark.parametrize("num_shards", [1, 3])
+def test_streaming_scores_missing_prediction(tmp_path, num_shards):
+    pred_rows = [row for row in PRED_ROWS if row["SubjectEntity"] != "b"]
+    pred_file = write_rows(tmp_path / "pred.jsonl", pred_rows)
+    index = evaluate.GroundTruthIndex.from_file(
+        write_rows(tmp_path / "gt.jsonl", GT_ROWS))
+
+    with pytest.raises(KeyError, match="'b', 'r1'"):
+        evaluate.streaming_scores(pred_file, index, num_shards)
+
+
+@pytest.mark.parametrize("options", [("--stream",), ("--shards", "3")])
+def test_main_streaming(tmp_path, monkeypatch, capsys, options):
+    pred_file = write_rows(tmp_path / "pred.jsonl", PRED_ROWS)
+    gt_file = write_rows(tmp_path / "gt.jsonl", GT_ROWS)
+
+    assert run(monkeypatch, capsys, pred_file, gt_file,
+               *options) == expected_output()
+
+
+RUNS = {"run1": PRED_ROWS, "run2": EMPTY_PRED_ROWS, "run3": PRED_ROWS[::-1]}
+
+
+def assert_runs_match(comparison, names, runs):
+    assert comparison["Run"].unique().tolist() == names
+    for name, pred_rows in zip(names, runs):
+        table = comparison[comparison["Run"] == name]
+        pd.testing.assert_frame_equal(
+            table.drop(columns="Run").set_index("Relation"),
+            expected_table(pred_rows), check_names=False)
+
+
+@pytest.mark.parametrize("num_jobs", [1, 2])
+def test_compare_runs(tmp_path, num_jobs):
+    pred_files = [write_rows(tmp_path / f"{name}.jsonl", rows)
+                  for name, rows in RUNS.items()]
+    index = evaluate.GroundTruthIndex.from_file(
+        write_rows(tmp_path / "gt.jsonl", GT_ROWS))
+
+    comparison = evaluate.compare_runs(pred_files, index, num_jobs)
+
+    assert_runs_match(comparison, list(RUNS), list(RUNS.values()))
+
+
+def test_compare_runs_with_the_same_names(tmp_path):
+    pred_files = []
+    for name in RUNS:
+        (tmp_path / name).mkdir()
+        pred_files.append(write_rows(tmp_path / name / "pred.jsonl",
+                                     RUNS[name]))
+    index = evaluate.GroundTruthIndex.from_file(
+        write_rows(tmp_path / "gt.jsonl", GT_ROWS))
+
+    comparison = evaluate.compare_runs(pred_files, index)
+
+    assert_runs_match(comparison, [str(f) for f in pred_files],
+                      list(RUNS.values()))
+
+
+@pytest.mark.parametrize("output", ["runs.csv", "runs.parquet"])
+def test_main_compare_runs(tmp_path, monkeypatch, capsys, output):
+    for name, rows in RUNS.items():
+        write_rows(tmp_path / f"{name}.jsonl", rows)
+    gt_file = write_rows(tmp_path / "gt.jsonl", GT_ROWS)
+    output = tmp_path / output
+
+    run(monkeypatch, capsys, tmp_path / "run*.jsonl", gt_file,
+        "-j", "2", "-o", str(output))
+
+    comparison = (pd.read_parquet(output) if output.suffix == ".parquet"
+                  else pd.read_csv(output))
+    assert_runs_match(comparison, list(RUNS), list(RUNS.values()))
@@ -0,0 +1,123 @@
+import random
+
+import pytest
+import torch
+
+from models.baseline_generation_model import GenerationModel
+
+ROWS = [
+    ("Germany", "countryLandBordersCountry"),
+    ("Albert Einstein", "personHasCityOfDeath"),
+    ("Nobel Prize in Physics", "awardWonBy"),
+    ("Toyota", "companyTradesAtStockExchange"),
+    ("Friends", "seriesHasNumberOfEpisodes"),
+]
+
+
+@pytest.fixture
+def make_model(tiny_models):
+    models = []
+
+    def make_model(**config):
+        model = GenerationModel({
+            "llm_path": str(tiny_models["gpt2"]),
+            "prompt_templates_file": "prompt_templates/question_prompts.csv",
+            "train_data_file": "data/train.jsonl",
+            "use_quantization": False,
+            "device": "cpu",
+            "few_shot": 2,
+            "batch_size": 2,
+            "max_new_tokens": 12,
+            **config,
+        })
+        models.append(model)
+        return model
+
+    yield make_model
+    for model in models:
+        model.close()
+
+
+def generate(model, prompts):
+    """The new texts of `generate()` with the model's stop strings."""
+    encoded = model.tokenizer(prompts, padding=True, return_tensors="pt")
+    with torch.inference_mode():
+        output_ids = model.llm.generate(
+            **encoded,
+            max_new_tokens=model.max_new_tokens,
+            pad_token_id=model.tokenizer.pad_token_id,
+            stop_strings=model.stop_strings,
+            tokenizer=model.tokenizer,
+        )
+    return model.tokenizer.batch_decode(
+        output_ids[:, encoded["input_ids"].shape[1]:],
+        skip_special_tokens=True)
+
+
+@pytest.mark.parametrize("settings", [
+    {},
+    {"repetition_penalty": 1.5, "no_repeat_ngram_size": 2},
+])
+def test_decode_matches_generate(make_model, settings):
+    model = make_model(stop_strings=[])
+    model.llm.generation_config.update(do_sample=False, **settings)
+    random.seed(0)
+    prompts = [model.create_prompt(subject, relation)
+               for subject, relation in ROWS]
+    unstopped = model.generate_batched(prompts)
+
+    # A stop string in the middle of the first output
+    model = make_model(stop_strings=["\n", unstopped[0][1:3]])
+    model.llm.generation_config.update(do_sample=False, **settings)
+    expected = generate(model, prompts)
+    outputs = model.generate_batched(prompts)
+
+    assert outputs == expected
+    assert len(outputs[0]) < len(unstopped[0])
+
+
+LABELS = {"Germany": "Q183", "France": "Q142", "Spain": "Q29",
+          "Saint Kitts and Nevis": "Q763"}
+
+
+@pytest.mark.parametrize("prefix_caching", [False, True])
+def test_constrained_decoding_only_emits_labels(make_model, tmp_path,
+                                                prefix_caching):
+    labels_file = tmp_path / "labels.tsv"
+    labels_file.write_text("".join(
+        f"{wikidata_id}\t{label}\tcountryLandBordersCountry\n"
+        for label, wikidata_id in LABELS.items()))
+    model = make_model(max_new_tokens=24, prefix_caching=prefix_caching,
+                       constrained_relations=["countryLandBordersCountry"],
+                       constrained_label_sources=[str(labels_file)])
+    inputs = [{"SubjectEntityID": f"Q{i}", "SubjectEntity": subject,
+               "Relation": relation}
+              for i, (subject, relation) in enumerate(ROWS)]
+    inputs += [{"SubjectEntityID": f"Q{i}", "SubjectEntity": subject,
+                "Relation": "countryLandBordersCountry"}
+               for i, subject in enumerate(["Italy", "Chad", "Peru"])]
+
+    random.seed(0)
+    constraints = model.create_constraints(inputs)
+    texts = [None] * len(inputs)
+    for batch, batch_texts in model.iter_generate_outputs(
+            inputs, constraints=constraints):
+        for i, text in zip(batch, batch_texts):
+            texts[i] = text
+
+    for inp, constraint, text in zip(inputs, constraints, texts):
+        if inp["Relation"] != "countryLandBordersCountry":
+            assert constraint is None
+            continue
+        answer = model.truncate_at_stop(text)
+        assert answer.startswith(model.answer_prefix)
+        if answer == " None":
+            assert constraint.wikidata_ids() == []
+            continue
+        # Complete labels, the last one possibly cut off by the length
+        *complete, last = answer[1:].split(", ")
+        assert all(label in LABELS for label in complete)
+        assert any(label.startswith(last) for label in LABELS)
+        assert constraint.wikidata_ids() == list(dict.fromkeys(
+            LABELS[label] for label in complete + [last]
+            if label in LABELS))
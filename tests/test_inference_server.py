@@ -0,0 +1,135 @@
+import http.client
+import json
+import threading
+
+import pytest
+
+from models.inference_server import InferenceClient, InferenceServer, \
+    MicroBatcher
+
+
+class EchoModel:
+    """Predicts the subject entity ID of every row as its only object."""
+
+    def generate_predictions(self, inputs):
+        return [{**row, "ObjectEntitiesID": [row["SubjectEntityID"]]}
+                for row in inputs]
+
+
+def make_rows(ids):
+    return [{"SubjectEntityID": f"Q{i}", "SubjectEntity": str(i),
+             "Relation": "r"} for i in ids]
+
+
+def test_batcher_coalesces_concurrent_requests():
+    started = threading.Event()
+    release = threading.Event()
+    batches = []
+
+    def predict(rows):
+        batches.append([row["SubjectEntityID"] for row in rows])
+        started.set()
+        release.wait()
+        return EchoModel().generate_predictions(rows)
+
+    batcher = MicroBatcher(predict, max_batch_size=8, max_wait=0.0)
+    try:
+        first = batcher.submit(make_rows([0]))
+        started.wait()
+        # These requests wait while the first batch is being predicted
+        second = batcher.submit(make_rows([1, 2]))
+        third = batcher.submit(make_rows([3, 4]))
+        release.set()
+
+        results = [future.result() for future in first + second + third]
+    finally:
+        release.set()
+        batcher.close()
+
+    assert batches == [["Q0"], ["Q1", "Q2", "Q3", "Q4"]]
+    assert results == EchoModel().generate_predictions(make_rows(range(5)))
+    assert batcher.stats() == {"requests": 3, "rows": 5, "batches": 2}
+
+
+def test_batcher_isolates_a_failing_row():
+    def predict(rows):
+        if any(row["SubjectEntityID"] == "Q1" for row in rows):
+            raise ValueError("bad row")
+        return EchoModel().generate_predictions(rows)
+
+    batcher = MicroBatcher(predict, max_batch_size=8, max_wait=0.1)
+    try:
+        futures = batcher.submit(make_rows([0, 1, 2]))
+        with pytest.raises(ValueError):
+            futures[1].result()
+        results = [futures[0].result(), futures[2].result()]
+    finally:
+        batcher.close()
+
+    assert results == EchoModel().generate_predictions(make_rows([0, 2]))
+
+
+@pytest.fixture
+def serve():
+    servers = []
+
+    def serve(**kwargs):
+        server = InferenceServer(EchoModel(), model_name="echo", **kwargs)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        servers.append((server, thread))
+        return server
+
+    yield serve
+    for server, thread in servers:
+        server.shutdown()
+        thread.join()
+        server.close()
+
+
+def post(server, body: bytes):
+    host, port = server.httpd.server_address[:2]
+    connection = http.client.HTTPConnection(host, port, timeout=10)
+    try:
+        connection.request("POST", "/predict", body=body,
+                           headers={"Content-Type": "application/json"})
+        response = connection.getresponse()
+        return response.status, json.loads(response.read())
+    finally:
+        connection.close()
+
+
+@pytest.mark.parametrize("body", [
+    b"not json",
+    json.dumps({"inputs": make_rows([0])}).encode(),
+    json.dumps({"rows": [{"SubjectEntity": "a", "Relation": "r"}]}).encode(),
+    json.dumps({"rows": ["Q0"]}).encode(),
+])
+def test_malformed_rows_are_rejected(serve, body):
+    server = serve(port=0)
+    status, result = post(server, body)
+    assert status == 400
+    assert "Invalid request" in result["error"]
+    assert server.batcher.stats()["rows"] == 0
+
+
+@pytest.mark.parametrize("transport", ["tcp", "unix"])
+def test_client_round_trip(serve, tmp_path, transport):
+    if transport == "tcp":
+        server = serve(port=0)
+    else:
+        server = serve(unix_socket=str(tmp_path / "server.sock"))
+
+    rows = make_rows(range(5))
+    client = InferenceClient(server.address, request_size=2)
+    try:
+        assert client.model_name == "echo"
+        results = list(client.generate_predictions(rows))
+        # The server answers an unsupported method with an HTML page
+        with pytest.raises(RuntimeError, match="501"):
+            client._request("PUT", "/predict", {"rows": rows})
+    finally:
+        client.close()
+
+    assert results == EchoModel().generate_predictions(rows)
+    assert server.batcher.stats()["rows"] == 5
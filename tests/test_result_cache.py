@@ -0,0 +1,96 @@
+import pytest
+
+from models.result_cache import ResultCache
+
+ROW = {"SubjectEntityID": "Q1", "SubjectEntity": "a", "Relation": "r1"}
+RESULT = {**ROW, "ObjectEntitiesID": ["Q2"]}
+
+
+@pytest.fixture
+def files(tmp_path):
+    templates_file = tmp_path / "templates.csv"
+    templates_file.write_text(
+        "Relation,PromptTemplate\n"
+        "r1,What is r1 of {subject_entity}?\n"
+        "r2,What is r2 of {subject_entity}?\n")
+    train_file = tmp_path / "train.jsonl"
+    train_file.write_text("{}\n")
+    labels_file = tmp_path / "labels.tsv"
+    labels_file.write_text("Q2\tb\n")
+    return templates_file, train_file, labels_file
+
+
+@pytest.fixture
+def config(tmp_path, files):
+    templates_file, train_file, labels_file = files
+    return {
+        "model": "generation",
+        "result_cache_file": str(tmp_path / "results.sqlite"),
+        "prompt_templates_file": str(templates_file),
+        "train_data_file": str(train_file),
+        "label_index_sources": [str(labels_file)],
+    }
+
+
+def cached(config):
+    cache = ResultCache(config["result_cache_file"], config)
+    try:
+        return cache.get_many([ROW])[0]
+    finally:
+        cache.close()
+
+
+@pytest.fixture
+def put(config):
+    cache = ResultCache(config["result_cache_file"], config)
+    cache.put(ROW, RESULT)
+    cache.close()
+
+
+def test_hit_with_unchanged_settings(config, put):
+    assert cached(config) == RESULT
+    assert cached({**config, "batch_size": 64}) == RESULT
+
+
+def test_prefix_caching_changes_the_key(config, put):
+    assert cached({**config, "prefix_caching": True}) is None
+
+
+def test_template_of_another_relation_changes_the_key(config, files, put):
+    templates_file = files[0]
+    templates_file.write_text(
+        templates_file.read_text().replace("What is r2", "Which r2"))
+    assert cached(config) is None
+
+
+def test_template_of_another_relation_without_few_shot_pool(config, files):
+    config = {key: value for key, value in config.items()
+              if key != "train_data_file"}
+    cache = ResultCache(config["result_cache_file"], config)
+    cache.put(ROW, RESULT)
+    cache.close()
+
+    templates_file = files[0]
+    templates_file.write_text(
+        templates_file.read_text().replace("What is r2", "Which r2"))
+    assert cached(config) == RESULT
+
+
+def test_edited_label_source_changes_the_key(config, files, put):
+    labels_file = files[2]
+    labels_file.write_text("Q3\tb\n")
+    assert cached(config) is None
+
+
+def test_edited_constrained_label_source_changes_the_key(config, files):
+    labels_file = files[2]
+    config = {**config, "label_index_sources": [],
+              "constrained_relations": ["r1"],
+              "constrained_label_sources": [str(labels_file)]}
+    cache = ResultCache(config["result_cache_file"], config)
+    cache.put(ROW, RESULT)
+    cache.close()
+
+    assert cached(config) == RESULT
+    labels_file.write_text("Q3\tb\n")
+    assert cached(config) is None
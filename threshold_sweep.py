@@ -0,0 +1,210 @@
+import argparse
+import glob
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from evaluate import prf_from_counts, read_rows, sorted_unique
+
+ALL_RELATIONS = "*** All Relations ***"
+
+
+def sweep_thresholds(raw: pd.DataFrame, gt_rows: List[Dict],
+                     thresholds, top_k: Optional[int] = None) -> pd.DataFrame:
+    """
+    Evaluate the raw top-k outputs of a FillMaskModel at many thresholds at
+    once, without re-running the model.
+
+    Like `FillMaskModel.generate_predictions`, a token is predicted at
+    threshold t if its score is above t, its rank is below `top_k` and it
+    resolved to a Wikidata ID. Every distinct (pair, object) is mapped to the
+    number of thresholds below its best score, and cumulative counts over that
+    level give the true positives and predictions of every pair at every
+    threshold in one pass.
+
+    Returns one row per relation (and all relations) and threshold.
+    """
+    thresholds = np.sort(np.asarray(thresholds, dtype=np.float64))
+    num_thresholds = len(thresholds)
+
+    # Like `rows_to_dict`, the last row of a duplicated pair wins
+    gt_dict = {(r["SubjectEntity"], r["Relation"]): r["ObjectEntitiesID"]
+               for r in gt_rows}
+    pairs = list(gt_dict)
+    pair_ids = {pair: i for i, pair in enumerate(pairs)}
+    num_pairs = len(pairs)
+
+    # Tokens that resolved to an ID within the top-k, for the evaluated pairs
+    raw = raw[raw["ObjectEntityID"] != ""]
+    if top_k is not None:
+        raw = raw[raw["Rank"] < top_k]
+    pred_pairs = np.fromiter(
+        (pair_ids.get(pair, -1)
+         for pair in zip(raw["SubjectEntity"], raw["Relation"])),
+        dtype=np.int64, count=len(raw))
+    known = pred_pairs >= 0
+    pred_pairs = pred_pairs[known]
+    pred_objects = raw["ObjectEntityID"].to_numpy(dtype=object)[known]
+    scores = raw["Score"].to_numpy(dtype=np.float64)[known]
+
+    # Encode every (pair, object) as one integer key
+    gt_objects = [list(set(gt_dict[pair])) for pair in pairs]
+    gt_lengths = [len(x) for x in gt_objects]
+    codes, uniques = pd.factorize(
+        np.concatenate([
+            np.array([qid for x in gt_objects for qid in x], dtype=object),
+            pred_objects,
+        ]),
+        use_na_sentinel=False,
+    )
+    num_codes = max(len(uniques), 1)
+    num_gt_objects = sum(gt_lengths)
+    gt_keys = sorted_unique(
+        np.repeat(np.arange(num_pairs, dtype=np.int64), gt_lengths)
+        * num_codes + codes[:num_gt_objects])
+    pred_keys = pred_pairs * num_codes + codes[num_gt_objects:]
+
+    # Keep the best score of every distinct (pair, object)
+    order = np.lexsort((-scores, pred_keys))
+    pred_keys = pred_keys[order]
+    scores = scores[order]
+    first = np.concatenate(([True], pred_keys[1:] != pred_keys[:-1])) \
+        if len(pred_keys) > 0 else np.zeros(0, dtype=bool)
+    pred_keys = pred_keys[first]
+    scores = scores[first]
+    is_tp = np.isin(pred_keys, gt_keys, assume_unique=True)
+
+    # An object is predicted at the thresholds strictly below its score
+    levels = np.searchsorted(thresholds, scores, side="left")
+    pred_pairs = pred_pairs[order][first]
+
+    def counts_per_threshold(mask) -> np.ndarray:
+        counts = np.zeros((num_pairs, num_thresholds + 1), dtype=np.int64)
+        np.add.at(counts, (pred_pairs[mask], levels[mask]), 1)
+        # Objects with a level above j are predicted at threshold j
+        return np.cumsum(counts[:, ::-1], axis=1)[:, ::-1][:, 1:]
+
+    total_pred = counts_per_threshold(slice(None))
+    tp = counts_per_threshold(is_tp)
+    total_gt = np.bincount(gt_keys // num_codes, minlength=num_pairs)
+    p, r, f1 = prf_from_counts(tp, total_pred, total_gt[:, None])
+
+    # Aggregate the pairs per relation, then over all relations
+    rel_codes, relations = pd.factorize(
+        np.array([pair[1] for pair in pairs], dtype=object), sort=True)
+    num_relations = len(relations)
+
+    def per_relation(values) -> np.ndarray:
+        sums = np.zeros((num_relations + 1,) + values.shape[1:])
+        np.add.at(sums, rel_codes, values)
+        sums[-1] = values.sum(axis=0)
+        return sums
+
+    num_pairs_per_relation = per_relation(np.ones(num_pairs))[:, None]
+    sum_tp = per_relation(tp)
+    sum_pred = per_relation(total_pred)
+    sum_gt = per_relation(np.broadcast_to(total_gt[:, None], tp.shape))
+    micro_p, micro_r, micro_f1 = prf_from_counts(sum_tp, sum_pred, sum_gt)
+
+    metrics = {
+        "macro-p": per_relation(p) / num_pairs_per_relation,
+        "macro-r": per_relation(r) / num_pairs_per_relation,
+        "macro-f1": per_relation(f1) / num_pairs_per_relation,
+        "micro-p": micro_p,
+        "micro-r": micro_r,
+        "micro-f1": micro_f1,
+        "avg. #preds": sum_pred / num_pairs_per_relation,
+        "#empty preds": per_relation(total_pred == 0).astype(int),
+    }
+
+    names = list(relations) + [ALL_RELATIONS]
+    return pd.DataFrame({
+        "Relation": np.repeat(names, num_thresholds),
+        "threshold": np.tile(thresholds, len(names)),
+        **{name: values.ravel() for name, values in metrics.items()},
+    })
+
+
+def best_thresholds(sweep: pd.DataFrame,
+                    metric: str = "macro-f1") -> pd.DataFrame:
+    """The best threshold (and top-k) per relation; ties go to the lowest."""
+    best = sweep.loc[sweep.groupby("Relation", sort=False)[metric].idxmax()]
+    return best.set_index("Relation")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Sweep the threshold of a FillMaskModel over its saved "
+                    "raw top-k outputs")
+
+    parser.add_argument(
+        "-r", "--raw_outputs",
+        type=str,
+        nargs="+",
+        required=True,
+        help="Path to the raw top-k outputs (`raw_outputs_file` of the "
+             "configuration). Several files or glob patterns are combined, "
+             "e.g. the parts saved by the workers of --num_workers"
+    )
+    parser.add_argument(
+        "-g", "--ground_truth",
+        type=str,
+        required=True,
+        help="Path to the ground truth file (JSONL or columnar)"
+    )
+    parser.add_argument(
+        "-t", "--thresholds",
+        type=float,
+        nargs="+",
+        default=np.round(np.arange(0, 1, 0.01), 2).tolist(),
+        help="Thresholds to evaluate (default: 0.00 to 0.99 in steps of 0.01)"
+    )
+    parser.add_argument(
+        "-k", "--top_k",
+        type=int,
+        nargs="+",
+        help="Values of top-k to evaluate, up to the saved top-k "
+             "(default: all saved tokens)"
+    )
+    parser.add_argument(
+        "-m", "--metric",
+        type=str,
+        default="macro-f1",
+        help="Metric to maximize per relation"
+    )
+    parser.add_argument(
+        "-o", "--output",
+        type=str,
+        help="Save the full sweep to a .csv or .parquet file"
+    )
+
+    args = parser.parse_args()
+
+    raw_files = []
+    for pattern in args.raw_outputs:
+        raw_files.extend(sorted(glob.glob(pattern)) or [pattern])
+    raw = pd.concat([pd.read_parquet(raw_file) for raw_file in raw_files],
+                    ignore_index=True)
+    gt_rows = read_rows(args.ground_truth)
+
+    sweeps = []
+    for top_k in args.top_k or [None]:
+        sweep = sweep_thresholds(raw, gt_rows, args.thresholds, top_k)
+        sweep.insert(1, "top_k",
+                     top_k if top_k is not None else int(raw["Rank"].max()) + 1)
+        sweeps.append(sweep)
+    sweep = pd.concat(sweeps, ignore_index=True)
+
+    print(best_thresholds(sweep, args.metric).round(3).to_string())
+
+    if args.output:
+        if Path(args.output).suffix == ".parquet":
+            sweep.to_parquet(args.output, index=False)
+        else:
+            sweep.to_csv(args.output, index=False)
+
+
+if __name__ == "__main__":
+    main()